@@ -0,0 +1,160 @@
+-- Schema updates for the SUADA database (suada_5)
+--
+-- Tables and columns added on top of the suada_4 dump (suada_4.sql).
+-- Apply in order on an existing database:
+--	mysql -u meteo -p -h fs002 suada_5 < db/suada_updates.sql
+-- ------------------------------------------------------
+
+--
+-- Table structure for table `NWP_IN_3D_PACKED`
+--
+-- One row per (SensorID, Datetime) holding the whole model profile.
+-- Temperature, Pressure, Height and WV_Mixing_ratio are the NWP_IN_3D
+-- level values (same units) packed as little-endian float32 arrays,
+-- Levels is the number of values in each array.
+--
+
+CREATE TABLE IF NOT EXISTS `NWP_IN_3D_PACKED` (
+  `SensorID` int(11) NOT NULL,
+  `Datetime` datetime NOT NULL,
+  `Timestamp` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  `Levels` smallint(6) NOT NULL,
+  `Latitude` float DEFAULT NULL,
+  `Longitude` float DEFAULT NULL,
+  `Temperature` blob NOT NULL,
+  `Pressure` blob NOT NULL,
+  `Height` blob DEFAULT NULL,
+  `WV_Mixing_ratio` blob DEFAULT NULL,
+  PRIMARY KEY (`SensorID`,`Datetime`),
+  CONSTRAINT `fk_NWP_IN_3D_PACKED_SENSOR?ID?` FOREIGN KEY (`SensorID`) REFERENCES `SENSOR` (`ID`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+--
+-- Table structure for table `COMPARISON_STATS`
+--
+-- Monthly comparison of a source (SourceID: WRF model or radiosonde)
+-- with the GNSS reference (RefSourceID) per station, filled by
+-- python/compare.py. Parameter is 'IWV' or 'ZTD'; with d = source - GNSS:
+-- Sum_D, Sum_D2, Sum_X, Sum_Y, Sum_X2, Sum_Y2, Sum_XY are the sums of d, d^2,
+-- source, GNSS, source^2, GNSS^2 and source*GNSS over the N matched pairs,
+-- Last_Datetime is the last compared epoch (for incremental updates).
+--
+
+CREATE TABLE IF NOT EXISTS `COMPARISON_STATS` (
+  `StationID` int(11) NOT NULL,
+  `Month` date NOT NULL,
+  `Parameter` varchar(8) NOT NULL,
+  `RefSourceID` int(11) NOT NULL,
+  `SourceID` int(11) NOT NULL,
+  `Timestamp` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  `N` int(11) NOT NULL,
+  `Sum_D` double NOT NULL,
+  `Sum_D2` double NOT NULL,
+  `Sum_X` double NOT NULL,
+  `Sum_Y` double NOT NULL,
+  `Sum_X2` double NOT NULL,
+  `Sum_Y2` double NOT NULL,
+  `Sum_XY` double NOT NULL,
+  `Bias` float DEFAULT NULL,
+  `RMSE` float DEFAULT NULL,
+  `Std` float DEFAULT NULL,
+  `Corr` float DEFAULT NULL,
+  `Last_Datetime` datetime NOT NULL,
+  PRIMARY KEY (`StationID`,`Month`,`Parameter`,`RefSourceID`,`SourceID`),
+  KEY `fk_COMPARISON_STATS_SOURCE(ID)` (`SourceID`),
+  KEY `fk_COMPARISON_STATS_REF_SOURCE(ID)` (`RefSourceID`),
+  CONSTRAINT `fk_COMPARISON_STATS_SOURCE?ID?` FOREIGN KEY (`SourceID`) REFERENCES `SOURCE` (`ID`),
+  CONSTRAINT `fk_COMPARISON_STATS_REF_SOURCE?ID?` FOREIGN KEY (`RefSourceID`) REFERENCES `SOURCE` (`ID`),
+  CONSTRAINT `fk_COMPARISON_STATS_STATION?ID?` FOREIGN KEY (`StationID`) REFERENCES `STATION` (`ID`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+--
+-- Table structure for table `COMPARISON_MATCHED`
+--
+-- The epochs of the compared source (Datetime) that are already in
+-- the sums of COMPARISON_STATS. python/compare.py re-reads a window
+-- behind Last_Datetime and skips these epochs, so a model epoch whose
+-- GNSS value arrives later is still compared, and only once.
+--
+
+CREATE TABLE IF NOT EXISTS `COMPARISON_MATCHED` (
+  `StationID` int(11) NOT NULL,
+  `Datetime` datetime NOT NULL,
+  `Parameter` varchar(8) NOT NULL,
+  `RefSourceID` int(11) NOT NULL,
+  `SourceID` int(11) NOT NULL,
+  PRIMARY KEY (`Parameter`,`RefSourceID`,`SourceID`,`StationID`,`Datetime`),
+  KEY `fk_COMPARISON_MATCHED_STATION(ID)` (`StationID`),
+  CONSTRAINT `fk_COMPARISON_MATCHED_STATION?ID?` FOREIGN KEY (`StationID`) REFERENCES `STATION` (`ID`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+--
+-- Table structure for table `NWP_IN_DOMAIN`
+--
+-- Nested domain the model values of a sensor and time were taken from
+-- (python/ncdf2db.py -m d01,d02,d03: the finest domain containing the
+-- station). Domain is the file domain ('d01', 'd02', ...), DX the grid
+-- spacing [m], I and J the south_north and west_east grid indices.
+--
+
+CREATE TABLE IF NOT EXISTS `NWP_IN_DOMAIN` (
+  `SensorID` int(11) NOT NULL,
+  `Datetime` datetime NOT NULL,
+  `Timestamp` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  `Domain` varchar(8) NOT NULL,
+  `DX` float DEFAULT NULL,
+  `I` int(11) DEFAULT NULL,
+  `J` int(11) DEFAULT NULL,
+  PRIMARY KEY (`SensorID`,`Datetime`),
+  CONSTRAINT `fk_NWP_IN_DOMAIN_SENSOR` FOREIGN KEY (`SensorID`) REFERENCES `SENSOR` (`ID`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+--
+-- Table structure for table `PROFILE_COMPARISON`
+--
+-- Model profiles (SourceID, NWP_IN_3D or NWP_IN_3D_PACKED) against the
+-- radiosondes (RefSourceID, RADIOSONDE_IN), filled by
+-- python/sondeinterp.py. Level_Set is 'standard' (standard pressure
+-- levels, model and sonde interpolated in log-pressure) or 'sonde'
+-- (the levels of the sounding, model interpolated). Temperature [C],
+-- Height [m], MixR [g/kg], Pressure [hPa].
+--
+
+CREATE TABLE IF NOT EXISTS `PROFILE_COMPARISON` (
+  `StationID` int(11) NOT NULL,
+  `SourceID` int(11) NOT NULL,
+  `RefSourceID` int(11) NOT NULL,
+  `Datetime` datetime NOT NULL,
+  `Level_Set` varchar(8) NOT NULL,
+  `Pressure` float NOT NULL,
+  `Timestamp` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  `Model_Temperature` float DEFAULT NULL,
+  `Model_Height` float DEFAULT NULL,
+  `Model_MixR` float DEFAULT NULL,
+  `Sonde_Temperature` float DEFAULT NULL,
+  `Sonde_Height` float DEFAULT NULL,
+  `Sonde_MixR` float DEFAULT NULL,
+  PRIMARY KEY (`StationID`,`SourceID`,`RefSourceID`,`Datetime`,`Level_Set`,`Pressure`),
+  CONSTRAINT `fk_PROFILE_COMPARISON_STATION` FOREIGN KEY (`StationID`) REFERENCES `STATION` (`ID`),
+  CONSTRAINT `fk_PROFILE_COMPARISON_SOURCE` FOREIGN KEY (`SourceID`) REFERENCES `SOURCE` (`ID`),
+  CONSTRAINT `fk_PROFILE_COMPARISON_REF_SOURCE` FOREIGN KEY (`RefSourceID`) REFERENCES `SOURCE` (`ID`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+--
+-- Table structure for table `INGEST_HASH`
+--
+-- MD5 of the rows (NWP_IN_1D, NWP_IN_3D, NWP_OUT, NWP_IN_3D_PACKED)
+-- that python/ncdf2db.py --skip-unchanged has written for a sensor
+-- and epoch of a source (see python/blockhash.py). Blocks with the
+-- same hash are not sent again on a rerun.
+--
+
+CREATE TABLE IF NOT EXISTS `INGEST_HASH` (
+  `SourceID` int(11) NOT NULL,
+  `SensorID` int(11) NOT NULL,
+  `Datetime` datetime NOT NULL,
+  `Hash` binary(16) NOT NULL,
+  PRIMARY KEY (`SourceID`,`Datetime`,`SensorID`),
+  CONSTRAINT `fk_INGEST_HASH_SOURCE` FOREIGN KEY (`SourceID`) REFERENCES `SOURCE` (`ID`),
+  CONSTRAINT `fk_INGEST_HASH_SENSOR` FOREIGN KEY (`SensorID`) REFERENCES `SENSOR` (`ID`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
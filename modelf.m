@@ -1,3 +1,4 @@
+% Superseded by python/recompute.py (NWP_OUT from the stored profiles).
 % define function which we execute in matlab command window
 function par=modelf;
 
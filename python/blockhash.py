@@ -0,0 +1,99 @@
+# blockhash.py
+# Content hashes of the ingested rows, to skip unchanged rows on reruns.
+#
+# A block is everything process_station writes for one sensor and
+# epoch of a source: its NWP_IN_1D, NWP_IN_3D, NWP_OUT and
+# NWP_IN_3D_PACKED rows. With ncdf2db.py --skip-unchanged the rows of
+# a station go first to a block (new_block), its MD5 (digest) is
+# compared with the hash stored in INGEST_HASH (see
+# db/suada_updates.sql) and only changed blocks are passed to the
+# writers (forward). The new hashes are written with the rows of the
+# file, so a rerun over ingested files sends no rows at all and the
+# Timestamp columns of the unchanged rows are kept.
+#
+# The hash is taken from the rows computed from the files: rows
+# changed or deleted in the database by other means are not noticed
+# (run without --skip-unchanged to write them again).
+
+import datetime
+import hashlib
+import struct
+import numpy as np
+import dbwriter
+
+
+# Tables of a block (and 'packed', the NWP_IN_3D_PACKED rows):
+block_tables = ('NWP_IN_1D', 'NWP_IN_3D', 'NWP_OUT')
+
+
+# A BlockBuffer collects the rows of one table of
+# a block (BatchWriter interface, never sends them):
+class BlockBuffer(dbwriter.BatchWriter):
+
+	def __init__(self, table):
+		dbwriter.BatchWriter.__init__(self, None, table)
+
+	def add(self, row):
+		self.rows.append(tuple(row))
+
+	def flush(self):
+		return 0
+
+
+# Define a procedure that creates the writers of a block
+# (the same keys as ncdf2db.new_writers):
+def new_block():
+	block = dict((table, BlockBuffer(table)) for table in block_tables)
+	block['packed'] = []
+	return block
+
+
+# Define a procedure that encodes one value of a row
+# (the same bytes in Python 2 and 3):
+def encode_value(value):
+	if value is None:
+		return b'N'
+	if isinstance(value, (bool, np.bool_)):
+		return b'B' + (b'1' if value else b'0')
+	if isinstance(value, (int, np.integer)) or type(value).__name__ == 'long':
+		return b'I' + str(int(value)).encode('ascii')
+	if isinstance(value, (float, np.floating)):
+		return b'F' + struct.pack('<d', float(value))
+	if isinstance(value, (datetime.datetime, datetime.date)):
+		return b'D' + value.isoformat().encode('ascii')
+	if isinstance(value, bytes):
+		return b'S' + value
+	if isinstance(value, bytearray):
+		return b'S' + bytes(value)
+	return b'U' + value.encode('utf-8')
+
+
+# Define a procedure that returns the MD5 (16 bytes)
+# of all rows of a block:
+def digest(block):
+	md5 = hashlib.md5()
+	for table in block_tables + ('packed',):
+		rows = block[table] if table == 'packed' else block[table].rows
+		md5.update(table.encode('ascii') + struct.pack('<I', len(rows)))
+		for row in rows:
+			for value in row:
+				data = encode_value(value)
+				md5.update(struct.pack('<I', len(data)) + data)
+	return md5.digest()
+
+
+# Define a procedure that passes the rows of
+# a block to the writers (ncdf2db.new_writers):
+def forward(block, writers):
+	for table in block_tables:
+		for row in block[table].rows:
+			writers[table].add(row)
+	writers['packed'].extend(block['packed'])
+
+
+# Define a procedure that reads the stored hashes of the
+# sensors of a source at one epoch (SensorID -> hash):
+def load(cur, source_id, date):
+	cur.execute("select SensorID, Hash from INGEST_HASH \
+		where SourceID = %s and Datetime = %s", [source_id, date])
+	return dict((row[0], bytes(row[1])) for row in cur.fetchall())
@@ -0,0 +1,304 @@
+# climatology.py
+# Monthly and seasonal climatologies of WRF runs.
+#
+# The model files are streamed in time order, one time step at
+# a time; only the running statistics are kept in memory. For every
+# calendar month and season (DJF, MAM, JJA, SON) and every selected
+# field the count, mean and the sum of squared deviations (Welford)
+# are updated per grid cell and per station. The files are split into
+# chunks of consecutive files that are aggregated in parallel
+# (multiprocessing) and the partial statistics are merged
+# (RunningStats.merge).
+#
+# Fields: IWV [kg/m^2], ZTD, ZHD, ZWD [m] (computed as in ncdf2db.py)
+# or any 2D variable of the model files (T2, PSFC, PBLH, ...).
+#
+# The results are written to <output>_monthly.nc and
+# <output>_seasonal.nc: <field>_mean, <field>_std and <field>_count
+# on the grid and station_<field>_mean, _std, _count for the stations
+# of the station list (Model_Stations.cfg: name latitude longitude id).
+#
+# Usage:
+# climatology.py -b <basedir> [./] -p <prefix> [wrfout_d02] -f <fields> [IWV,ZTD]
+#	-o <output> [climatology] [-i <stations>] [-n <processes>] [1]
+
+import sys, getopt
+import multiprocessing
+import numpy as np
+import columns
+import kernels
+import ncreader
+from ncdf2db import listfiles
+from extract import read_stations
+
+
+# Fields computed from the 3D fields and the 2D fields they need:
+derived_fields = ('IWV', 'ZTD', 'ZHD', 'ZWD')
+
+# Season of every month (1..12) and the season names:
+seasons = ('DJF', 'MAM', 'JJA', 'SON')
+month_season = dict((month, ((month % 12) // 3)) for month in range(1, 13))
+
+
+# Running count, mean and sum of squared deviations
+# of an array of values (NaN values are skipped):
+class RunningStats(object):
+
+	def __init__(self, shape):
+		self.count = np.zeros(shape)
+		self.mean = np.zeros(shape)
+		self.M2 = np.zeros(shape)
+
+	# Add one sample of every element (Welford):
+	def add(self, values):
+		values = np.asarray(values, dtype=float)
+		valid = ~np.isnan(values)
+		self.count += valid
+		delta = np.where(valid, values - self.mean, 0.)
+		self.mean += np.where(valid, delta / np.maximum(self.count, 1), 0.)
+		self.M2 += np.where(valid, delta * (values - self.mean), 0.)
+
+	# Add the statistics of another part (Chan et al.):
+	def merge(self, other):
+		count = self.count + other.count
+		delta = other.mean - self.mean
+		with np.errstate(invalid='ignore', divide='ignore'):
+			weight = np.where(count > 0, other.count / count, 0.)
+		self.mean = self.mean + delta * weight
+		self.M2 = self.M2 + other.M2 + delta * delta * self.count * weight
+		self.count = count
+
+	def std(self):
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return np.where(self.count > 1, np.sqrt(self.M2 / np.maximum(self.count - 1, 1)), np.nan)
+
+	def means(self):
+		return np.where(self.count > 0, self.mean, np.nan)
+
+
+# The statistics of all fields for every month and season,
+# on the grid and at the stations:
+class Climatology(object):
+
+	def __init__(self, names, grid_shape, nstations):
+		self.names = tuple(names)
+		self.grid_shape = tuple(grid_shape)
+		self.nstations = nstations
+		self.stats = {}
+		self.steps = 0
+		self.first = None
+		self.last = None
+
+	def _stats(self, key, name, shape):
+		if not (key, name) in self.stats:
+			self.stats[(key, name)] = RunningStats(shape)
+		return self.stats[(key, name)]
+
+	# Add the fields of one time step:
+	def add(self, date, grid_values, station_values):
+		for key in (('month', date.month), ('season', month_season[date.month])):
+			for name in self.names:
+				self._stats(key, name, self.grid_shape).add(grid_values[name])
+				if self.nstations:
+					self._stats(key, 'station_' + name, (self.nstations,)).add(station_values[name])
+		self.steps += 1
+		self.first = date if self.first is None else min(self.first, date)
+		self.last = date if self.last is None else max(self.last, date)
+
+	def merge(self, other):
+		for key, stats in other.stats.items():
+			if key in self.stats:
+				self.stats[key].merge(stats)
+			else:
+				self.stats[key] = stats
+		self.steps += other.steps
+		for date in (other.first, other.last):
+			if date is not None:
+				self.first = date if self.first is None else min(self.first, date)
+				self.last = date if self.last is None else max(self.last, date)
+
+
+# Define a procedure that computes the selected fields on the
+# whole grid for time index t of an open model file. lat is the
+# latitude of the grid cells [deg]:
+def grid_fields(ncfile, t, names, lat):
+	values = {}
+	if any(name in derived_fields for name in names):
+		col = dict((name, np.rollaxis(np.asarray(ncfile.variables[name][t], dtype=float), 0, 3)) for name in columns.fields_3d)
+		IWV = kernels.profile_physics(col['T'], col['P'], col['PB'], col['PH'], col['PHB'], col['QVAPOR'])['IWV']
+		press = np.asarray(ncfile.variables['PSFC'][t], dtype=float)/100.
+		HGT = np.asarray(ncfile.variables['HGT'][t], dtype=float)
+		T2 = np.asarray(ncfile.variables['T2'][t], dtype=float)
+		ZHD = columns.zhd(press, lat, HGT)
+		ZWD = columns.zwd(IWV, columns.mean_temperature(T2))
+		derived = {'IWV' : IWV, 'ZHD' : ZHD, 'ZWD' : ZWD, 'ZTD' : ZHD + ZWD}
+	for name in names:
+		if name in derived_fields:
+			values[name] = derived[name]
+		else:
+			values[name] = np.asarray(ncfile.variables[name][t], dtype=float)
+	return values
+
+
+# Define a procedure that aggregates a chunk of files
+# (runs in the worker processes). Returns the Climatology
+# of the chunk and the grid coordinates:
+def aggregate_files(args):
+	files, names, stations = args
+	clim = None
+	coords = None
+	for file in files:
+		print('Processing: {}'.format(file))
+		ncfile = ncreader.open_dataset(file)
+		try:
+			lat = np.asarray(ncfile.variables['XLAT'][0], dtype=float)
+			lon = np.asarray(ncfile.variables['XLONG'][0], dtype=float)
+			if clim is None:
+				i0, j0, inside = columns.grid_index(columns.grid_params(ncfile),
+					[station['latt'] for station in stations],
+					[station['long'] for station in stations])
+				clim = Climatology(names, lat.shape, len(stations))
+				coords = {'XLAT' : lat, 'XLONG' : lon, 'i0' : i0, 'j0' : j0, 'inside' : inside}
+			i0 = np.clip(coords['i0'], 0, lat.shape[0] - 1)
+			j0 = np.clip(coords['j0'], 0, lat.shape[1] - 1)
+			for t, date in enumerate(columns.file_times(ncfile)):
+				values = grid_fields(ncfile, t, names, lat)
+				station_values = dict((name, np.where(coords['inside'], values[name][i0, j0], np.nan)) for name in names)
+				clim.add(date, values, station_values)
+		finally:
+			ncfile.close()
+	return clim, coords
+
+
+# Define a procedure that splits the files into
+# nchunks chunks of consecutive files:
+def split_chunks(files, nchunks):
+	nchunks = max(1, min(nchunks, len(files)))
+	bounds = np.linspace(0, len(files), nchunks + 1).astype(int)
+	return [files[bounds[c]:bounds[c + 1]] for c in range(nchunks)]
+
+
+# Define a procedure that aggregates all files, in parallel
+# over nproc chunks, and merges the chunks in time order:
+def aggregate(files, names, stations, nproc=1):
+	chunks = split_chunks(files, nproc)
+	jobs = [(chunk, names, stations) for chunk in chunks]
+	if nproc > 1:
+		pool = multiprocessing.Pool(nproc)
+		try:
+			parts = pool.map(aggregate_files, jobs)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		parts = [aggregate_files(job) for job in jobs]
+	clim, coords = None, None
+	for part, part_coords in parts:
+		if part is None:
+			continue
+		if clim is None:
+			clim, coords = part, part_coords
+		else:
+			clim.merge(part)
+	return clim, coords
+
+
+# Define a procedure that writes the monthly or seasonal
+# statistics (kind 'month' or 'season') to a netCDF file:
+def write_netcdf(filename, clim, coords, stations, kind):
+	from netCDF4 import Dataset as netcdf
+	if kind == 'month':
+		keys = list(range(1, 13))
+	else:
+		keys = list(range(len(seasons)))
+	ny, nx = clim.grid_shape
+	out = netcdf(filename, 'w')
+	try:
+		out.createDimension(kind, len(keys))
+		out.createDimension('south_north', ny)
+		out.createDimension('west_east', nx)
+		if kind == 'month':
+			var = out.createVariable('month', 'i4', (kind,))
+			var[:] = keys
+		else:
+			out.createDimension('name_length', 3)
+			var = out.createVariable('season', 'S1', (kind, 'name_length'))
+			var[:] = np.array([list(name) for name in seasons], dtype='S1')
+		for name in ('XLAT', 'XLONG'):
+			var = out.createVariable(name, 'f4', ('south_north', 'west_east'))
+			var[:] = coords[name]
+		if len(stations):
+			out.createDimension('station', len(stations))
+			var = out.createVariable('station_id', 'i4', ('station',))
+			var[:] = [station['id'] for station in stations]
+			for name, key in (('station_lat', 'latt'), ('station_lon', 'long')):
+				var = out.createVariable(name, 'f4', ('station',))
+				var[:] = [station[key] for station in stations]
+
+		for name in clim.names:
+			for prefix, dims, shape in (('', ('south_north', 'west_east'), clim.grid_shape), ('station_', ('station',), (len(stations),))):
+				if prefix and not len(stations):
+					continue
+				empty = RunningStats(shape)
+				stats = [clim.stats.get(((kind, key), prefix + name), empty) for key in keys]
+				for suffix, values in (('mean', [s.means() for s in stats]), ('std', [s.std() for s in stats]), ('count', [s.count for s in stats])):
+					var = out.createVariable(prefix + name + '_' + suffix, 'f4', (kind,) + dims, fill_value=np.float32(np.nan) if suffix != 'count' else None, zlib=True)
+					var[:] = np.array(values)
+		out.first_time = str(clim.first)
+		out.last_time = str(clim.last)
+		out.time_steps = clim.steps
+	finally:
+		out.close()
+
+
+def usage():
+	print('climatology.py -b <basedir> [./] -p <prefix> [wrfout_d02] -f <fields> [IWV,ZTD] -o <output> [climatology] -i <stations> -n <processes> [1]')
+
+
+def main(argv):
+	basedir = './'
+	prefix = 'wrfout_d02'
+	names = ['IWV', 'ZTD']
+	output = 'climatology'
+	stationfile = ''
+	nproc = 1
+	try:
+		opts, args = getopt.getopt(argv, "hb:p:f:o:i:n:", ["basedir=", "prefix=", "fields=", "output=", "stations=", "processes="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-b", "--basedir"):
+			basedir = arg
+		elif opt in ("-p", "--prefix"):
+			prefix = arg
+		elif opt in ("-f", "--fields"):
+			names = [name for name in arg.split(',') if name]
+		elif opt in ("-o", "--output"):
+			output = arg
+		elif opt in ("-i", "--stations"):
+			stationfile = arg
+		elif opt in ("-n", "--processes"):
+			nproc = int(arg)
+
+	flist = listfiles(basedir, prefix)
+	if not len(flist):
+		print('No candidates for import files found ...')
+		sys.exit(1)
+	stations = read_stations(stationfile) if stationfile else []
+	print('{} files, {} stations, fields: {}'.format(len(flist), len(stations), ', '.join(names)))
+
+	clim, coords = aggregate(flist, names, stations, nproc)
+	if clim is None:
+		print('No time steps aggregated')
+		sys.exit(1)
+	for kind, suffix in (('month', '_monthly.nc'), ('season', '_seasonal.nc')):
+		write_netcdf(output + suffix, clim, coords, stations, kind)
+		print('Written: {}{}'.format(output, suffix))
+	print('{} time steps from {} to {}'.format(clim.steps, clim.first, clim.last))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
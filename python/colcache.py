@@ -0,0 +1,224 @@
+# colcache.py
+# Cache of the station columns extracted from the model files.
+#
+# For every model file the columns of the stations (T, P, PB, PH,
+# PHB, QVAPOR and the surface fields of columns.fields_1d), the valid
+# time and the grid geometry (i0, j0, latitude, longitude) are kept
+# in one small .npz file. A new formula or output can then be computed
+# from the cache (ncdf2db.py --from-cache) without opening the
+# multi-GB model files again.
+#
+# An entry is named <file name>.<file key>.<station key>.npz:
+# the file key is built from the path, size and modification time
+# of the model file, the station key from the station list (id,
+# latitude, longitude) and the country. The cache is bounded by size:
+# the least recently used entries are removed first.
+
+import os
+import hashlib
+import numpy as np
+import columns
+
+
+suffix = '.npz'
+default_size = 1024 # MB
+
+
+# Define a procedure that returns the key of a model file
+# (changes when the file is replaced or rewritten):
+def file_key(filename):
+	st = os.stat(filename)
+	identity = '{}|{}|{}'.format(os.path.realpath(filename), st.st_size, int(st.st_mtime))
+	return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+
+# Define a procedure that returns the key of a station set:
+def station_key(stations, country='All'):
+	h = hashlib.sha1(country.encode('utf-8'))
+	for station in sorted(stations, key=lambda station: station['id']):
+		h.update('|{}:{:.5f}:{:.5f}'.format(station['id'], station['latt'], station['long']).encode('utf-8'))
+	return h.hexdigest()[:16]
+
+
+def entry_path(cachedir, filename, stations, country='All'):
+	name = '.'.join((os.path.basename(filename), file_key(filename), station_key(stations, country)))
+	return os.path.join(cachedir, name + suffix)
+
+
+# Define a procedure that loads a cache entry.
+# Returns a dictionary with 'time' (the Times string), 'source'
+# (the model file), the geometry arrays 'id', 'i0', 'j0', 'latt', 'long'
+# and the station columns of every field (arrays [station] or
+# [station, level]), or None if there is no usable entry:
+def load(path):
+	try:
+		with np.load(path) as npz:
+			entry = dict((name, npz[name]) for name in npz.files)
+	except (IOError, OSError, ValueError):
+		return None
+	entry['time'] = str(entry['time'])
+	entry['source'] = str(entry['source'])
+	# Mark the entry as recently used:
+	try:
+		os.utime(path, None)
+	except OSError:
+		pass
+	return entry
+
+
+# Define a procedure that looks up the entry of a model file
+# for the station set. Without an entry of this set, the columns
+# are taken from an entry of the file for a larger set (see
+# lookup_subset). None if they are not cached yet:
+def lookup(cachedir, filename, stations, country='All'):
+	path = entry_path(cachedir, filename, stations, country)
+	if not os.path.exists(path):
+		return lookup_subset(cachedir, filename, stations)
+	return load(path)
+
+
+# Define a procedure that keeps the stations ids
+# (in this order) of an entry:
+def subset(entry, ids):
+	index = dict((stationId, n) for n, stationId in enumerate(entry['id']))
+	rows = np.array([index[stationId] for stationId in ids], dtype=int)
+	n = len(entry['id'])
+	result = {}
+	for name, values in entry.items():
+		if isinstance(values, np.ndarray) and values.ndim and values.shape[0] == n:
+			result[name] = values[rows]
+		else:
+			result[name] = values
+	return result
+
+
+# Define a procedure that looks for an entry of the model file
+# with all stations of the set (at the same coordinates) and
+# returns the columns of these stations (None if there is none):
+def lookup_subset(cachedir, filename, stations):
+	if not os.path.isdir(cachedir) or not len(stations):
+		return None
+	start = '.'.join((os.path.basename(filename), file_key(filename))) + '.'
+	ids = [station['id'] for station in stations]
+	for path in entries(cachedir, start):
+		entry = load(path)
+		if entry is None:
+			continue
+		index = dict((stationId, n) for n, stationId in enumerate(entry['id']))
+		if not all(station['id'] in index
+				and abs(entry['latt'][index[station['id']]] - station['latt']) < 1e-5
+				and abs(entry['long'][index[station['id']]] - station['long']) < 1e-5 for station in stations):
+			continue
+		return subset(entry, ids)
+	return None
+
+
+# Define a procedure that writes the entry of a model file and
+# removes the least recently used entries above max_size MB:
+def store(cachedir, filename, stations, country, entry, max_size=default_size):
+	if not os.path.isdir(cachedir):
+		os.makedirs(cachedir)
+	path = entry_path(cachedir, filename, stations, country)
+	arrays = dict(entry)
+	arrays['time'] = np.array(entry['time'])
+	arrays['source'] = np.array(entry['source'])
+	# Write to a temporary file first, so that readers
+	# never see a half-written entry:
+	tmp = path + '.tmp'
+	with open(tmp, 'wb') as f:
+		np.savez_compressed(f, **arrays)
+	os.rename(tmp, path)
+	evict(cachedir, max_size)
+	return path
+
+
+# Define a procedure that returns the cache entries
+# of the model files starting with prefix, sorted by name:
+def entries(cachedir, prefix=''):
+	if not os.path.isdir(cachedir):
+		return []
+	return sorted(os.path.join(cachedir, name) for name in os.listdir(cachedir)
+		if name.startswith(prefix) and name.endswith(suffix))
+
+
+# Define a procedure that returns the model file and the
+# station ids of an entry without loading its columns
+# (None if the entry can not be read):
+def entry_info(path):
+	try:
+		with np.load(path) as npz:
+			return str(npz['source']), set(int(stationId) for stationId in npz['id'])
+	except (IOError, OSError, ValueError, KeyError):
+		return None
+
+
+# Define a procedure that selects the entries computed again by
+# ncdf2db.py --from-cache from the entry paths: one entry per model
+# file, preferably of the current version of the file (if it still
+# exists) and of the station set, else the entry with the most
+# stations of the set; the newest one if several are left. Entries
+# of older versions of a file and of other station sets would
+# otherwise overwrite each other's rows. Sorted by name:
+def replay_entries(paths, stations, country='All'):
+	key = station_key(stations, country)
+	ids = set(station['id'] for station in stations)
+	current = {}
+	found = {}
+	for path in paths:
+		info = entry_info(path)
+		if info is None:
+			continue
+		source, entry_ids = info
+		if not source in current:
+			current[source] = file_key(source) if os.path.exists(source) else None
+		name = os.path.basename(path)[:-len(suffix)].split('.')
+		rank = (name[-2] == current[source], name[-1] == key, len(ids & entry_ids), os.path.getmtime(path))
+		if not source in found or rank > found[source][0]:
+			found[source] = (rank, path)
+	return sorted(path for rank, path in found.values())
+
+
+# Define a procedure that removes the least recently
+# used entries until the cache is below max_size MB:
+def evict(cachedir, max_size=default_size):
+	files = []
+	for path in entries(cachedir):
+		st = os.stat(path)
+		files.append((st.st_mtime, st.st_size, path))
+	total = sum(size for mtime, size, path in files)
+	for mtime, size, path in sorted(files):
+		if total <= max_size * 1024 * 1024:
+			break
+		try:
+			os.remove(path)
+			total -= size
+		except OSError:
+			pass
+	return total
+
+
+# Define a procedure that extracts the entry of the stations
+# (the same dictionary as load returns) from an open model file.
+# grids is an optional dictionary that keeps the grid indices
+# of the stations for every grid seen before:
+def extract(ncfile, filename, stations, grids=None):
+	lats = [station['latt'] for station in stations]
+	lons = [station['long'] for station in stations]
+	grid = columns.grid_params(ncfile)
+	key = (tuple(sorted(grid.items())), station_key(stations))
+	if grids is not None and key in grids:
+		i0, j0, inside = grids[key]
+	else:
+		i0, j0, inside = columns.grid_index(grid, lats, lons)
+		if grids is not None:
+			grids[key] = (i0, j0, inside)
+	selected = np.nonzero(inside)[0]
+	entry = columns.read_columns(ncfile, columns.fields_1d + columns.fields_3d, i0[selected], j0[selected])
+	entry['time'] = ncfile.variables['Times'][0].tobytes().decode('ascii')
+	entry['source'] = os.path.realpath(filename)
+	entry['id'] = np.array([stations[s]['id'] for s in selected], dtype=int)
+	entry['i0'] = i0[selected]
+	entry['j0'] = j0[selected]
+	entry['latt'] = np.array([lats[s] for s in selected], dtype=float)
+	entry['long'] = np.array([lons[s] for s in selected], dtype=float)
+	return entry
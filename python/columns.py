@@ -0,0 +1,246 @@
+# columns.py
+# Station columns of WRF model fields.
+#
+# The stations are located on the model grid once per file
+# (grid_index) and their columns are taken from every field with
+# a single gather (gather). The moist thermodynamics of
+# ncdf2db.process_station (tk, mixing ratio, IWV) is computed for
+# all stations and levels at once with array operations
+# (profile_physics).
+
+import datetime
+import numpy as np
+import wrf
+
+
+# Define global variables:
+t_kelvin = 273.15
+Rd = 287.0
+Cp = 7.0 * Rd / 2.0
+Rd_Cp = Rd / Cp # dimensionless
+Rv = 461.51
+# IWV is integrated over the layers k = 0 .. iwv_top_layer
+# (between levels k and k+1, as in modelf.m):
+iwv_top_layer = 41
+# Reference height of the IWV_500 products [m]:
+iwv_ref_height = 500.
+# Scale height [km] and factor of IWV_500_Swiss (modelf.m):
+swiss_H = 2.11
+swiss_a = 1.02
+
+# Surface (1D) and profile (3D) fields read for every station:
+fields_1d = ('T2', 'Q2', 'PSFC', 'PBLH', 'HGT', 'RAINC', 'RAINNC', 'SNOWNC', 'GRAUPELNC', 'HAILNC')
+fields_3d = ('T', 'P', 'PB', 'PH', 'PHB', 'QVAPOR')
+
+
+# Define a procedure that returns the grid parameters
+# of a WRF file needed by wrf.ll_to_ij:
+def grid_params(ncfile):
+	return {
+		'truelat1'    : ncfile.TRUELAT1,
+		'truelat2'    : ncfile.TRUELAT2,
+		'ref_lat'     : ncfile.CEN_LAT,
+		'ref_lon'     : ncfile.CEN_LON,
+		'stand_lon'   : ncfile.STAND_LON,
+		'dx'          : ncfile.DX,
+		'dy'          : ncfile.DY,
+		'west_east'   : ncfile.dimensions['west_east'].size,
+		'south_north' : ncfile.dimensions['south_north'].size
+		}
+
+
+# Define a procedure that returns the valid times
+# of all time steps in a WRF file (Times variable):
+def file_times(ncfile):
+	times = []
+	for t in range(len(ncfile.variables['Times'])):
+		strDateTime = ncfile.variables['Times'][t].tobytes().decode('ascii')
+		times.append(datetime.datetime.strptime(strDateTime, '%Y-%m-%d_%H:%M:%S'))
+	return times
+
+
+# Define a procedure that locates the stations on the grid.
+# lats, lons are the station coordinates. Returns the arrays
+# i0 (south_north), j0 (west_east) and a mask of the stations
+# that are inside the grid (same indices as in ncdf2db.main):
+def grid_index(grid, lats, lons):
+	n = len(lats)
+	i0 = np.zeros(n, dtype=int)
+	j0 = np.zeros(n, dtype=int)
+	for s in range(n):
+		indx = wrf.ll_to_ij(1, grid['truelat1'], grid['truelat2'], grid['stand_lon'], grid['dx'], grid['dy'], grid['ref_lat'], grid['ref_lon'], lats[s], lons[s])
+		j0[s] = grid['west_east'] // 2 + indx[0] - 1
+		i0[s] = grid['south_north'] // 2 + indx[1] - 1
+	inside = (i0 >= 0) & (i0 < grid['south_north']) & (j0 >= 0) & (j0 < grid['west_east'])
+	return i0, j0, inside
+
+
+# Define a procedure that takes the columns of the
+# stations (i0, j0) from a field at time index t.
+# Returns a (native float64) array [station] for 2D fields
+# and [station, level] for 3D fields:
+def gather(variable, i0, j0, t=0):
+	values = variable[t]
+	return np.rollaxis(np.asarray(values[..., i0, j0], dtype=float), -1)
+
+
+# Define a procedure that reads the columns of the given
+# fields for all stations. Missing fields are left out:
+def read_columns(ncfile, names, i0, j0, t=0):
+	columns = {}
+	for name in names:
+		if name in ncfile.variables:
+			columns[name] = gather(ncfile.variables[name], i0, j0, t)
+	return columns
+
+
+# Define a procedure that computes zenith hydrostatic delay [m]
+# from pressure [hPa], latitude [deg] and height [m]:
+def zhd(press, lat, height):
+	return (0.0022768*press)/(1.-0.00266*np.cos(2*lat*(3.1416/180.))-(0.00028*height/1000.))
+
+
+# Define a procedure that computes the weighted mean
+# temperature Tm [K] from the 2m temperature T2 [K]:
+def mean_temperature(T2):
+	return 70.2 + 0.72 * T2
+
+
+# Define a procedure that computes zenith wet delay [m]
+# from IWV [kg/m^2] and Tm [K]:
+def zwd(IWV, Tm):
+	k1 = (10**6) / ( Rv*(((3.766 * 10**5)/Tm) + 22.) )
+	return IWV/(k1*100.) # Divided by 100 to convert from [cm] to [m].
+
+
+# Define a procedure that computes the profile values
+# and IWV for all stations at once from the WRF columns
+# [station, level] (the same equations as in process_station):
+# tk [C], Pair [hPa], hgth [m], QV [g/kg] on the mass levels,
+# rho [kg/m^3] - water vapour density, IWV [kg/m^2].
+def profile_physics(T, P, PB, PH, PHB, QVAPOR):
+	nz = T.shape[-1]
+	theta = T + 300.
+	Pair = (P + PB)/100.
+	tk = theta * ((100.*Pair/100000.)**(Rd_Cp)) - t_kelvin
+	QV = QVAPOR*1000.
+	hgth = (PH[..., :nz] + PHB[..., :nz])/9.81
+
+	# Specific humidity from QVAPOR*1000., partial pressure
+	# of water vapour [hPa] and water vapour density:
+	q = QV / (QV + 1.)
+	e = (Pair * q) / (0.622 + (0.378 * q))
+	TT = theta * (((P + PB)/100000.)**(2./7.))
+	rho = e / (Rv * TT)
+
+	IWV_cum = cumulative_iwv(rho, hgth)
+
+	return {
+		'tk'      : tk,
+		'Pair'    : Pair,
+		'hgth'    : hgth,
+		'QV'      : QV,
+		'rho'     : rho,
+		'IWV_cum' : IWV_cum,
+		'IWV'     : IWV_cum[..., -1]
+		}
+
+
+# Define a procedure that computes the same values as
+# profile_physics from the stored profiles (NWP_IN_3D or
+# NWP_IN_3D_PACKED) [profile, level]: tk [C], Pair [hPa],
+# hgth [m], QV [g/kg]. The temperature of the level is
+# tk + t_kelvin (Rd_Cp is 2/7 as in profile_physics):
+def stored_profile_physics(tk, Pair, hgth, QV):
+	tk = np.asarray(tk, dtype=float)
+	Pair = np.asarray(Pair, dtype=float)
+	hgth = np.asarray(hgth, dtype=float)
+	QV = np.asarray(QV, dtype=float)
+
+	q = QV / (QV + 1.)
+	e = (Pair * q) / (0.622 + (0.378 * q))
+	rho = e / (Rv * (tk + t_kelvin))
+
+	IWV_cum = cumulative_iwv(rho, hgth)
+
+	return {
+		'tk'      : tk,
+		'Pair'    : Pair,
+		'hgth'    : hgth,
+		'QV'      : QV,
+		'rho'     : rho,
+		'IWV_cum' : IWV_cum,
+		'IWV'     : IWV_cum[..., -1]
+		}
+
+
+# Define a procedure that integrates the water vapour density
+# rho [kg/m^3] along the level heights hgth [m] (trapezoids between
+# the levels k and k+1 for k = 0 .. iwv_top_layer). Returns the
+# cumulative IWV [kg/m^2] from the lowest level up to every level
+# (0 at the lowest level, the total IWV at the last one):
+def cumulative_iwv(rho, hgth):
+	nz = rho.shape[-1]
+	top = min(iwv_top_layer + 1, nz - 1)
+	delta_height = np.abs(hgth[..., 1:top + 1] - hgth[..., :top])
+	layers = ((rho[..., :top] + rho[..., 1:top + 1]) / 2.) * delta_height
+	IWV_cum = np.zeros(rho.shape[:-1] + (top + 1,))
+	IWV_cum[..., 1:] = np.cumsum(layers, axis=-1)
+	return IWV_cum
+
+
+# Define a procedure that interpolates the cumulative IWV
+# [station, level] linearly in height to the heights z [m]
+# (one per station). Below the lowest level it is 0,
+# above the last level the total IWV:
+def iwv_below(IWV_cum, hgth, z):
+	IWV_cum = np.atleast_2d(IWV_cum)
+	h = np.atleast_2d(hgth)[:, :IWV_cum.shape[-1]]
+	z = np.broadcast_to(np.asarray(z, dtype=float), IWV_cum.shape[:1])
+	rows = np.arange(IWV_cum.shape[0])
+	hi = np.clip((h < z[:, None]).sum(axis=-1), 1, h.shape[-1] - 1)
+	lo = hi - 1
+	dh = h[rows, hi] - h[rows, lo]
+	with np.errstate(invalid='ignore', divide='ignore'):
+		weight = np.clip(np.where(dh > 0, (z - h[rows, lo]) / dh, 0.), 0., 1.)
+	return IWV_cum[rows, lo] + weight * (IWV_cum[rows, hi] - IWV_cum[rows, lo])
+
+
+# Define a procedure that computes the partial column IWV
+# [kg/m^2] between the heights bottom and top [m]
+# (None - from the lowest / to the last level):
+def partial_iwv(IWV_cum, hgth, bottom=None, top=None):
+	IWV_cum = np.atleast_2d(IWV_cum)
+	upper = IWV_cum[:, -1] if top is None else iwv_below(IWV_cum, hgth, top)
+	lower = 0. if bottom is None else iwv_below(IWV_cum, hgth, bottom)
+	return upper - lower
+
+
+# Define a procedure that computes the IWV products of NWP_OUT
+# from the output of profile_physics, for all stations at once:
+# IWV_500_Profile - IWV above iwv_ref_height (500 m),
+# IWV_500_Swiss   - IWV reduced to 500 m with the scale height
+#                   formula of modelf.m,
+# IWV_Max_Height  - middle height of the layer with the largest
+#                   IWV (modelf.m: the lowest height if it is
+#                   the first layer).
+# With station_height [m] also IWV_Station - IWV above the station:
+def iwv_products(prof, station_height=None):
+	IWV_cum = np.atleast_2d(prof['IWV_cum'])
+	h = np.atleast_2d(prof['hgth'])[:, :IWV_cum.shape[-1]]
+	IWV = IWV_cum[:, -1]
+	rows = np.arange(IWV_cum.shape[0])
+
+	layers = np.diff(IWV_cum, axis=-1)
+	m = np.argmax(layers, axis=-1)
+	max_height = np.where(m == 0, h[:, 0], (h[rows, m] + h[rows, m + 1]) / 2.)
+
+	products = {
+		'IWV'             : IWV,
+		'IWV_500_Profile' : partial_iwv(IWV_cum, h, iwv_ref_height),
+		'IWV_500_Swiss'   : swiss_a * IWV * np.exp(((h[:, 0] / 1000.) - 0.5) / swiss_H),
+		'IWV_Max_Height'  : max_height
+		}
+	if station_height is not None:
+		products['IWV_Station'] = partial_iwv(IWV_cum, h, station_height)
+	return products
@@ -0,0 +1,452 @@
+# compare.py
+# Comparison of GNSS derived IWV and ZTD with the WRF model
+# (NWP_OUT, NWP_IN_1D) and the radiosondes (RADIOSONDE_OUT).
+#
+# The series of all selected stations are read in bulk, the model
+# (or radiosonde) epochs are matched to the nearest GNSS epoch of the
+# same station (within a tolerance) and bias, RMSE, std and
+# correlation are computed per station, month and source.
+#
+# The results go to COMPARISON_STATS (see db/suada_updates.sql).
+# Next to the statistics the table keeps the sums they are computed
+# from and the last compared epoch, so a new run only reads the epochs
+# from a window before the last one and adds them to the stored sums
+# instead of recomputing the full history. The compared epochs are kept
+# in COMPARISON_MATCHED: epochs of the window that are already in the
+# sums are skipped, the others (e.g. whose GNSS value came late) are
+# compared.
+#
+# Usage:
+# compare.py -d <env> -g <gnss_source> -s <source_name>[,<source_name>...]
+#	[-m <met_source>] [-k <kind>] [-p <parameter>] [-c <country>]
+#	[-t <tolerance>] [-w <window>] [-f <from>]
+
+import sys, getopt
+import datetime
+import numpy as np
+import suadadb
+
+
+# Define global variables:
+t_kelvin = 273.15
+Rv = 461.51
+
+# Parameters that can be compared for each kind of source:
+kind_parameters = {
+	'nwp'   : ('IWV', 'ZTD'),
+	'sonde' : ('IWV',)
+	}
+
+# Names of the stored sums, in the order of the table columns:
+sum_names = ('Sum_D', 'Sum_D2', 'Sum_X', 'Sum_Y', 'Sum_X2', 'Sum_Y2', 'Sum_XY')
+
+
+# Define a procedure that converts the fetched rows
+# (StationID, Datetime, value) to arrays:
+# station IDs, epochs in seconds since 1970 and values.
+# Rows with missing values are dropped:
+def rows_to_series(rows):
+	st = np.array([row[0] for row in rows], dtype=np.int64)
+	t = np.array([row[1] for row in rows], dtype='datetime64[s]').astype(np.int64)
+	v = np.array([row[2] for row in rows], dtype=float)
+	ok = np.isfinite(v)
+	return st[ok], t[ok], v[ok]
+
+
+# Define a procedure that computes the model ZTD [m]
+# from ZHD [m], IWV [kg/m^2] and 2m temperature [C]
+# (same formulas as in ncdf2db.process_station_tro):
+def model_ztd(zhd, iwv, temp):
+	Tm = 70.2 + 0.72 * (temp + t_kelvin)
+	k1 = (10**6) / (Rv * (((3.766 * 10**5) / Tm) + 22.))
+	return zhd + iwv / (k1 * 100.)
+
+
+# Define a procedure that selects the GNSS reference series
+# sorted by station and epoch. IWV is taken from GNSS_OUT,
+# ZTD from GNSS_IN (through the sensors of the GNSS source):
+def fetch_gnss(cur, parameter, source_id, met_source_id, station_ids, date_from):
+	if parameter == 'IWV':
+		cond, params = suadadb.in_condition('StationID', station_ids)
+		sql = "select StationID, Datetime, IWV from GNSS_OUT \
+			where SourceGpsID = %s and Datetime >= %s" + cond
+		params = [source_id, date_from] + params
+		if met_source_id is not None:
+			sql = sql + " and SourceMetID = %s"
+			params.append(met_source_id)
+		cur.execute(sql + " order by StationID, Datetime, SourceMetID", params)
+	else:
+		cond, params = suadadb.in_condition('sen.StationID', station_ids)
+		cur.execute("select sen.StationID, g.Datetime, g.ZTD from GNSS_IN as g \
+			join SENSOR as sen on sen.ID = g.SensorID \
+			where sen.SourceID = %s and g.Datetime >= %s" + cond + " \
+			order by sen.StationID, g.Datetime", [source_id, date_from] + params)
+	st, t, v = rows_to_series(cur.fetchall())
+	# Keep one value per station and epoch:
+	first = np.ones(len(st), dtype=bool)
+	first[1:] = (st[1:] != st[:-1]) | (t[1:] != t[:-1])
+	return st[first], t[first], v[first]
+
+
+# Define a procedure that selects the series of the
+# compared source sorted by station and epoch:
+# kind 'nwp'   - IWV from NWP_OUT, ZTD from NWP_OUT and NWP_IN_1D,
+# kind 'sonde' - IWV from RADIOSONDE_OUT.
+def fetch_source(cur, parameter, kind, source_id, station_ids, date_from):
+	if kind == 'sonde':
+		cond, params = suadadb.in_condition('StationID', station_ids)
+		cur.execute("select StationID, Datetime, IWV from RADIOSONDE_OUT \
+			where SourceRadID = %s and Datetime >= %s" + cond + " \
+			order by StationID, Datetime", [source_id, date_from] + params)
+		return rows_to_series(cur.fetchall())
+
+	if parameter == 'IWV':
+		cond, params = suadadb.in_condition('StationID', station_ids)
+		cur.execute("select StationID, Datetime, IWV from NWP_OUT \
+			where SourceModID = %s and Datetime >= %s" + cond + " \
+			order by StationID, Datetime", [source_id, date_from] + params)
+		return rows_to_series(cur.fetchall())
+
+	cond, params = suadadb.in_condition('o.StationID', station_ids)
+	cur.execute("select o.StationID, o.Datetime, i.ZHD, o.IWV, i.Temperature from NWP_OUT as o \
+		join SENSOR as sen on sen.StationID = o.StationID and sen.SourceID = o.SourceModID \
+		join NWP_IN_1D as i on i.SensorID = sen.ID and i.Datetime = o.Datetime \
+		where o.SourceModID = %s and o.Datetime >= %s" + cond + " \
+		order by o.StationID, o.Datetime", [source_id, date_from] + params)
+	rows = cur.fetchall()
+	zhd = np.array([row[2] for row in rows], dtype=float)
+	iwv = np.array([row[3] for row in rows], dtype=float)
+	temp = np.array([row[4] for row in rows], dtype=float)
+	ztd = model_ztd(zhd, iwv, temp)
+	return rows_to_series([(row[0], row[1], ztd[n]) for n, row in enumerate(rows)])
+
+
+# Define a procedure that matches every epoch of the compared
+# series (other) with the nearest epoch of the reference series
+# (ref) of the same station. Both series must be sorted by
+# station and epoch. Pairs further apart than tolerance [s]
+# are dropped. Returns station IDs, epochs of the compared
+# series, compared values (x) and reference values (y):
+def align_nearest(ref, other, tolerance):
+	rst, rt, rv = ref
+	ost, ot, ov = other
+	if not len(rst) or not len(ost):
+		empty = np.zeros(0)
+		return ost[:0], ot[:0], empty, empty
+
+	# One sorted key for (station, epoch), so that all
+	# stations are matched with a single searchsorted:
+	t0 = min(rt.min(), ot.min())
+	span = max(rt.max(), ot.max()) - t0 + 2 * tolerance + 1
+	rkey = rst * span + (rt - t0)
+	okey = ost * span + (ot - t0)
+
+	idx = np.searchsorted(rkey, okey)
+	lo = np.clip(idx - 1, 0, len(rkey) - 1)
+	hi = np.clip(idx, 0, len(rkey) - 1)
+	best = np.where(np.abs(rkey[hi] - okey) < np.abs(okey - rkey[lo]), hi, lo)
+	ok = (rst[best] == ost) & (np.abs(rkey[best] - okey) <= tolerance)
+	return ost[ok], ot[ok], ov[ok], rv[best[ok]]
+
+
+# Define a procedure that sums up the matched pairs per
+# station and month. d = x - y is the difference between
+# the compared source (x) and the GNSS reference (y).
+# Returns a dictionary of arrays with one value per group:
+def group_sums(st, t, x, y):
+	month = t.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+	keys, inverse = np.unique(st * 100000 + month, return_inverse=True)
+	ngroups = len(keys)
+	d = x - y
+	sums = {
+		'StationID' : keys // 100000,
+		'Month'     : keys % 100000,
+		'N'         : np.bincount(inverse, minlength=ngroups).astype(np.int64),
+		'Sum_D'     : np.bincount(inverse, weights=d, minlength=ngroups),
+		'Sum_D2'    : np.bincount(inverse, weights=d * d, minlength=ngroups),
+		'Sum_X'     : np.bincount(inverse, weights=x, minlength=ngroups),
+		'Sum_Y'     : np.bincount(inverse, weights=y, minlength=ngroups),
+		'Sum_X2'    : np.bincount(inverse, weights=x * x, minlength=ngroups),
+		'Sum_Y2'    : np.bincount(inverse, weights=y * y, minlength=ngroups),
+		'Sum_XY'    : np.bincount(inverse, weights=x * y, minlength=ngroups)
+		}
+	last = np.zeros(ngroups, dtype=np.int64)
+	last.fill(np.iinfo(np.int64).min)
+	np.maximum.at(last, inverse, t)
+	sums['Last'] = last
+	return sums
+
+
+# Define a procedure that computes bias, RMSE, std and
+# correlation from the sums (arrays, one value per group):
+def statistics(sums):
+	n = sums['N'].astype(float)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		bias = sums['Sum_D'] / n
+		rmse = np.sqrt(sums['Sum_D2'] / n)
+		std = np.sqrt(np.maximum(sums['Sum_D2'] / n - bias * bias, 0.))
+		cov = n * sums['Sum_XY'] - sums['Sum_X'] * sums['Sum_Y']
+		var_x = n * sums['Sum_X2'] - sums['Sum_X'] ** 2
+		var_y = n * sums['Sum_Y2'] - sums['Sum_Y'] ** 2
+		corr = cov / np.sqrt(var_x * var_y)
+	corr[(n < 2) | ~np.isfinite(corr)] = np.nan
+	return bias, rmse, std, corr
+
+
+# Define a procedure that converts a month index
+# (months since 1970-01) to the first day of the month:
+def month_date(month):
+	return datetime.date(1970 + int(month) // 12, int(month) % 12 + 1, 1)
+
+
+# Define a procedure that returns the last compared epoch
+# [s since 1970] for every station (as sorted arrays):
+def get_watermarks(cur, parameter, ref_id, source_id):
+	cur.execute("select StationID, max(Last_Datetime) from COMPARISON_STATS \
+		where Parameter = %s and RefSourceID = %s and SourceID = %s \
+		group by StationID order by StationID", [parameter, ref_id, source_id])
+	rows = cur.fetchall()
+	st = np.array([row[0] for row in rows], dtype=np.int64)
+	t = np.array([row[1] for row in rows], dtype='datetime64[s]').astype(np.int64)
+	return st, t
+
+
+# Define a procedure that returns the compared epochs
+# (COMPARISON_MATCHED) of the stations from date_from
+# as arrays of station IDs and epochs [s since 1970]:
+def get_matched(cur, parameter, ref_id, source_id, station_ids, date_from):
+	cond, params = suadadb.in_condition('StationID', station_ids)
+	cur.execute("select StationID, Datetime from COMPARISON_MATCHED \
+		where Parameter = %s and RefSourceID = %s and SourceID = %s \
+		and Datetime >= %s" + cond, [parameter, ref_id, source_id, date_from] + params)
+	rows = cur.fetchall()
+	st = np.array([row[0] for row in rows], dtype=np.int64)
+	t = np.array([row[1] for row in rows], dtype='datetime64[s]').astype(np.int64)
+	return st, t
+
+
+# Define a procedure that records the compared epochs
+# of the matched pairs in COMPARISON_MATCHED:
+def store_matched(cur, parameter, ref_id, source_id, st, t):
+	rows = [(int(st[n]), np.datetime64(int(t[n]), 's').astype(datetime.datetime), parameter, ref_id, source_id) for n in range(len(st))]
+	if len(rows):
+		cur.executemany("insert ignore into COMPARISON_MATCHED (StationID, \
+			Datetime, \
+			Parameter, \
+			RefSourceID, \
+			SourceID)\
+			values (%s, %s, %s, %s, %s)", rows)
+
+
+# Define a procedure that adds the sums already stored in
+# COMPARISON_STATS to the new sums of the same groups:
+def merge_stored(cur, parameter, ref_id, source_id, sums):
+	if not len(sums['N']):
+		return sums
+	cond, params = suadadb.in_condition('StationID', np.unique(sums['StationID']))
+	cur.execute("select StationID, Month, N, " + ', '.join(sum_names) + ", Last_Datetime \
+		from COMPARISON_STATS \
+		where Parameter = %s and RefSourceID = %s and SourceID = %s and Month >= %s" + cond,
+		[parameter, ref_id, source_id, month_date(sums['Month'].min())] + params)
+	index = {}
+	for g in range(len(sums['N'])):
+		index[(int(sums['StationID'][g]), int(sums['Month'][g]))] = g
+	for row in cur.fetchall():
+		month = (row[1].year - 1970) * 12 + row[1].month - 1
+		g = index.get((int(row[0]), month))
+		if g is None:
+			continue
+		sums['N'][g] += row[2]
+		for s, name in enumerate(sum_names):
+			sums[name][g] += row[3 + s]
+		last = np.datetime64(row[3 + len(sum_names)], 's').astype(np.int64)
+		sums['Last'][g] = max(sums['Last'][g], last)
+	return sums
+
+
+# Define a procedure that inserts (or updates)
+# the sums and statistics of all groups:
+def store(cur, parameter, ref_id, source_id, sums):
+	bias, rmse, std, corr = statistics(sums)
+
+	def value(x):
+		return None if not np.isfinite(x) else float(x)
+
+	rows = []
+	for g in range(len(sums['N'])):
+		last = np.datetime64(int(sums['Last'][g]), 's').astype(datetime.datetime)
+		rows.append([int(sums['StationID'][g]),
+			month_date(sums['Month'][g]),
+			parameter,
+			ref_id,
+			source_id,
+			int(sums['N'][g])] +
+			[float(sums[name][g]) for name in sum_names] +
+			[value(bias[g]), value(rmse[g]), value(std[g]), value(corr[g]), last])
+	if not len(rows):
+		return 0
+	cur.executemany("insert into COMPARISON_STATS (StationID, \
+		Month, \
+		Parameter, \
+		RefSourceID, \
+		SourceID, \
+		N, " + ', '.join(sum_names) + ", \
+		Bias, \
+		RMSE, \
+		Std, \
+		Corr, \
+		Last_Datetime)\
+		values (" + ', '.join(['%s'] * (11 + len(sum_names))) + ") on duplicate key update\
+		N = values(N), " + ', '.join(['{0} = values({0})'.format(name) for name in sum_names]) + ",\
+		Bias = values(Bias),\
+		RMSE = values(RMSE),\
+		Std = values(Std),\
+		Corr = values(Corr),\
+		Last_Datetime = values(Last_Datetime)", rows)
+	return len(rows)
+
+
+# Define a procedure that compares one parameter of one
+# source with the GNSS reference for the given stations.
+# The epochs from window [s] before the last stored epoch
+# (all epochs from date_from for new stations) that are not
+# yet in COMPARISON_MATCHED are compared:
+def compare_source(cur, parameter, kind, ref_id, met_id, source_id, station_ids, date_from, tolerance, window):
+	wm_st, wm_t = get_watermarks(cur, parameter, ref_id, source_id)
+	compared = set(wm_st.tolist())
+	known = [sid for sid in station_ids if sid in compared]
+	new = [sid for sid in station_ids if not sid in compared]
+
+	parts = []
+	for group, start in ((known, None), (new, date_from)):
+		if not len(group):
+			continue
+		if start is None:
+			# Read the window before the oldest watermark of the
+			# group (epochs whose GNSS value came after the last
+			# run), with enough margin to match its first epochs:
+			start = np.datetime64(int(wm_t.min()) - window - tolerance, 's').astype(datetime.datetime)
+		ref = fetch_gnss(cur, parameter, ref_id, met_id, group, start)
+		other = fetch_source(cur, parameter, kind, source_id, group, start)
+
+		# Drop the epochs that are already in the stored sums:
+		ost, ot, ov = other
+		mst, mt = get_matched(cur, parameter, ref_id, source_id, group, start)
+		if len(mst) and len(ost):
+			t0 = min(mt.min(), ot.min())
+			span = max(mt.max(), ot.max()) - t0 + 1
+			seen = np.isin(ost * span + (ot - t0), mst * span + (mt - t0))
+			other = (ost[~seen], ot[~seen], ov[~seen])
+
+		parts.append(align_nearest(ref, other, tolerance))
+
+	if not len(parts):
+		return 0
+	st, t, x, y = [np.concatenate([part[i] for part in parts]) for i in range(4)]
+	print('{} {} pairs matched for source id {}'.format(len(st), parameter, source_id))
+	if not len(st):
+		return 0
+	sums = merge_stored(cur, parameter, ref_id, source_id, group_sums(st, t, x, y))
+	store_matched(cur, parameter, ref_id, source_id, st, t)
+	return store(cur, parameter, ref_id, source_id, sums)
+
+
+def usage():
+	print('compare.py -d <env> -g <gnss_source> -s <source_name>[,<source_name>...] [-m <met_source>] [-k <kind>] [nwp] [-p <parameter>] [all] [-c <country>] [All] [-t <tolerance>] [15 (minutes)] [-w <window>] [48 (hours)] [-f <from>] [1900-01-01]')
+
+
+def main(argv):
+	# -d <env> - database ('dev' or 'prod'),
+	# -g <gnss_source> - source of the GNSS reference (GNSS_OUT, GNSS_IN),
+	# -m <met_source> - meteo source of GNSS_OUT (optional),
+	# -s <source_name> - compared sources, comma separated,
+	# -k <kind> - 'nwp' (NWP_OUT, NWP_IN_1D) or 'sonde' (RADIOSONDE_OUT),
+	# -p <parameter> - 'IWV', 'ZTD' or 'all',
+	# -c <country> - compare the stations of one country only,
+	# -t <tolerance> - maximum time difference of a pair [minutes],
+	# -w <window> - epochs re-read before the last compared one [hours]
+	# (GNSS values that arrive later than this are not compared),
+	# -f <from> - first epoch for stations that were never compared.
+	env = ''
+	gnss_source = ''
+	met_source = ''
+	source_names = []
+	kind = 'nwp'
+	parameter = 'all'
+	country = 'All'
+	tolerance = 15
+	window = 48
+	date_from = datetime.datetime(1900, 1, 1)
+
+	try:
+		opts, args = getopt.getopt(argv, "hd:g:m:s:k:p:c:t:w:f:", ["env=", "gnss_source=", "met_source=", "source_name=", "kind=", "parameter=", "country=", "tolerance=", "window=", "from="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-d", "--env"):
+			env = arg
+		elif opt in ("-g", "--gnss_source"):
+			gnss_source = arg
+		elif opt in ("-m", "--met_source"):
+			met_source = arg
+		elif opt in ("-s", "--source_name"):
+			source_names = [name for name in arg.split(',') if name]
+		elif opt in ("-k", "--kind"):
+			kind = arg
+		elif opt in ("-p", "--parameter"):
+			parameter = arg
+		elif opt in ("-c", "--country"):
+			country = arg
+		elif opt in ("-t", "--tolerance"):
+			tolerance = int(arg)
+		elif opt in ("-w", "--window"):
+			window = int(arg)
+		elif opt in ("-f", "--from"):
+			date_from = datetime.datetime.strptime(arg, '%Y-%m-%d')
+
+	if env == '' or gnss_source == '' or not len(source_names):
+		print('Error: You must specify the database, the GNSS source and the compared sources! (-d <env> -g <gnss_source> -s <source_name>)')
+		sys.exit(2)
+	if not kind in kind_parameters:
+		print('Error: Not a possible kind {}'.format(kind))
+		sys.exit(2)
+	if parameter == 'all':
+		parameters = kind_parameters[kind]
+	elif parameter in kind_parameters[kind]:
+		parameters = (parameter,)
+	else:
+		print('Error: Parameter {} can not be compared for kind {}'.format(parameter, kind))
+		sys.exit(2)
+
+	try:
+		db = suadadb.connect(env)
+		cur = db.cursor()
+	except Exception as e:
+		print('Failed to establish connection: {0}'.format(e))
+		sys.exit(1)
+
+	source_ids = suadadb.get_source_ids(cur, [gnss_source, met_source] + source_names)
+	for name in [gnss_source] + source_names + ([met_source] if met_source else []):
+		if not name in source_ids:
+			print('Error: Can not find source_id for source_name: {}'.format(name))
+			sys.exit(1)
+	ref_id = source_ids[gnss_source]
+	met_id = source_ids[met_source] if met_source else None
+	station_ids = suadadb.get_station_ids(cur, country)
+	print('{} stations, GNSS source id: {}'.format(len(station_ids), ref_id))
+
+	for name in source_names:
+		for p in parameters:
+			count = compare_source(cur, p, kind, ref_id, met_id, source_ids[name], station_ids, date_from, tolerance * 60, window * 3600)
+			db.commit()
+			print('Source: {} Parameter: {} -> {} station/month rows updated'.format(name, p, count))
+
+	cur.close()
+	db.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,236 @@
+# dbwriter.py
+# Batched inserts into the SUADA tables.
+#
+# Rows are collected per table and sent with one executemany
+# "insert ... on duplicate key update" statement per batch,
+# instead of one statement (and one commit) per row.
+#
+# A WriterPool sends the rows of every table from its own thread
+# with its own connection (TableWriter), so a large table (NWP_IN_3D)
+# does not hold up the others. Every writer commits its own
+# transactions at a barrier (one per file): the barrier is passed
+# when all writers have committed the rows sent before it.
+
+import threading
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+# Columns of the model tables written by the ingest scripts.
+# For every table: (column names, primary key columns).
+tables = {
+	'NWP_IN_1D' : (('SensorID', 'Datetime', 'Temperature', 'Pressure', 'Altitude', 'Latitude', 'Longitude', 'ZHD', 'PBL', 'Precipitation'),
+		('SensorID', 'Datetime')),
+	'NWP_IN_3D' : (('SensorID', 'Datetime', 'Level', 'Temperature', 'Pressure', 'Latitude', 'Longitude', 'Height', 'WV_Mixing_ratio'),
+		('SensorID', 'Datetime', 'Level')),
+	'NWP_IN_3D_PACKED' : (('SensorID', 'Datetime', 'Levels', 'Latitude', 'Longitude', 'Temperature', 'Pressure', 'Height', 'WV_Mixing_ratio'),
+		('SensorID', 'Datetime')),
+	'NWP_OUT'   : (('StationID', 'SourceModID', 'Datetime', 'IWV', 'IWV_500_Swiss', 'IWV_500_Profile', 'IWV_Max_Height'),
+		('StationID', 'SourceModID', 'Datetime')),
+	'NWP_IN_DOMAIN' : (('SensorID', 'Datetime', 'Domain', 'DX', 'I', 'J'),
+		('SensorID', 'Datetime')),
+	'GNSS_IN' : (('SensorID', 'Datetime', 'ZTD', 'Sigma_ZTD', 'Gradient_N', 'Gradient_E', 'Sigma_Grad_N', 'Sigma_Grad_E'),
+		('SensorID', 'Datetime')),
+	'PROFILE_COMPARISON' : (('StationID', 'SourceID', 'RefSourceID', 'Datetime', 'Level_Set', 'Pressure',
+			'Model_Temperature', 'Model_Height', 'Model_MixR', 'Sonde_Temperature', 'Sonde_Height', 'Sonde_MixR'),
+		('StationID', 'SourceID', 'RefSourceID', 'Datetime', 'Level_Set', 'Pressure')),
+	'RADIOSONDE_IN_IWV' : (('StationID', 'SourceID', 'Datetime', 'IWV'),
+		('StationID', 'SourceID', 'Datetime')),
+	'INGEST_HASH' : (('SourceID', 'SensorID', 'Datetime', 'Hash'),
+		('SourceID', 'SensorID', 'Datetime'))
+	}
+
+
+# Define a procedure that builds the
+# "insert ... on duplicate key update" statement
+# for the given table, columns and key columns:
+def upsert_sql(table, columns, keys):
+	update = [column for column in columns if not column in keys]
+	sql = "insert into " + table + " (" + ', '.join(columns) + ") values (" + ', '.join(['%s'] * len(columns)) + ")"
+	if len(update):
+		sql = sql + " on duplicate key update " + ', '.join(['{0} = values({0})'.format(column) for column in update])
+	else:
+		sql = sql + " on duplicate key update " + keys[0] + " = " + keys[0]
+	return sql
+
+
+# Define a procedure that sends rows to a table
+# with one executemany per batch_size rows:
+def upsert_many(cur, table, columns, keys, rows, batch_size=5000):
+	sql = upsert_sql(table, columns, keys)
+	for start in range(0, len(rows), batch_size):
+		cur.executemany(sql, rows[start:start + batch_size])
+	return len(rows)
+
+
+# A BatchWriter collects rows for one table and sends them
+# with executemany when batch_size rows are waiting (or on flush).
+# Commits are left to the caller (db.commit()).
+class BatchWriter(object):
+
+	def __init__(self, cur, table, columns=None, keys=None, batch_size=5000):
+		if columns is None:
+			columns, keys = tables[table]
+		self.cur = cur
+		self.table = table
+		self.columns = tuple(columns)
+		self.keys = tuple(keys)
+		self.batch_size = batch_size
+		self.sql = upsert_sql(table, self.columns, self.keys)
+		self.rows = []
+		self.written = 0
+
+	# Add one row (values in the order of self.columns):
+	def add(self, row):
+		self.rows.append(tuple(row))
+		if len(self.rows) >= self.batch_size:
+			self.flush()
+
+	# Add a dictionary column -> value:
+	def add_dict(self, values):
+		self.add([values[column] for column in self.columns])
+
+	# Send the waiting rows:
+	def flush(self):
+		if len(self.rows):
+			self.cur.executemany(self.sql, self.rows)
+			self.written += len(self.rows)
+			self.rows = []
+		return self.written
+
+
+# A Barrier is passed when count writers have arrived.
+# wait returns the errors of the writers (table -> error):
+class Barrier(object):
+
+	def __init__(self, count):
+		self.count = count
+		self.errors = {}
+		self.cond = threading.Condition()
+
+	def arrive(self, table, error=None):
+		with self.cond:
+			self.count -= 1
+			if error is not None:
+				self.errors[table] = error
+			self.cond.notify_all()
+
+	def wait(self):
+		with self.cond:
+			while self.count > 0:
+				self.cond.wait()
+		return self.errors
+
+
+# A TableWriter thread sends the batches of one table through its
+# own connection (connect returns a new one) and commits at every
+# barrier. After an error the batches are skipped (rolled back)
+# until the next barrier, which gets the error:
+class TableWriter(threading.Thread):
+
+	def __init__(self, connect, table, queue_size=8):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.connect = connect
+		self.table = table
+		columns, keys = tables[table]
+		self.sql = upsert_sql(table, columns, keys)
+		# Bounded: the producer waits when the writer falls behind:
+		self.queue = queue.Queue(queue_size)
+		self.db = None
+		self.error = None
+		self.written = 0
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+			kind, payload = item
+			if kind == 'rows' and self.error is None:
+				try:
+					self.send(payload)
+				except Exception as e:
+					self.fail(e)
+			elif kind == 'barrier':
+				if self.error is None and self.db is not None:
+					try:
+						self.db.commit()
+					except Exception as e:
+						self.fail(e)
+				payload.arrive(self.table, self.error)
+				self.error = None
+		if self.db is not None:
+			self.db.close()
+
+	def send(self, rows):
+		if self.db is None:
+			self.db = self.connect()
+		cur = self.db.cursor()
+		try:
+			cur.executemany(self.sql, rows)
+		finally:
+			cur.close()
+		self.written += len(rows)
+
+	# Roll back and reconnect with the next batch:
+	def fail(self, e):
+		self.error = repr(e)
+		try:
+			self.db.rollback()
+			self.db.close()
+		except Exception:
+			pass
+		self.db = None
+
+
+# A WriterPool keeps one TableWriter (and connection) per table,
+# started with the first rows of the table:
+class WriterPool(object):
+
+	def __init__(self, connect, queue_size=8):
+		self.connect = connect
+		self.queue_size = queue_size
+		self.threads = {}
+
+	# Send a batch of rows of a table (see tables):
+	def append(self, table, rows):
+		if not len(rows):
+			return 0
+		if not table in self.threads:
+			self.threads[table] = TableWriter(self.connect, table, self.queue_size)
+			self.threads[table].start()
+		self.threads[table].queue.put(('rows', list(rows)))
+		return len(rows)
+
+	# Returns a Barrier passed when all writers have
+	# committed the rows sent so far:
+	def barrier(self):
+		barrier = Barrier(len(self.threads))
+		for thread in self.threads.values():
+			thread.queue.put(('barrier', barrier))
+		return barrier
+
+	def close(self):
+		for thread in self.threads.values():
+			thread.queue.put(None)
+		for thread in self.threads.values():
+			thread.join()
+		self.threads = {}
+
+
+# A PoolWriter has the interface of BatchWriter
+# but sends its batches to the writer of the pool:
+class PoolWriter(BatchWriter):
+
+	def __init__(self, pool, table, batch_size=5000):
+		BatchWriter.__init__(self, None, table, batch_size=batch_size)
+		self.pool = pool
+
+	def flush(self):
+		if len(self.rows):
+			self.pool.append(self.table, self.rows)
+			self.written += len(self.rows)
+			self.rows = []
+		return self.written
@@ -0,0 +1,128 @@
+# domains.py
+# Ingestion of nested WRF domains (d01, d02, d03, ...) in one run.
+#
+# The files of all domains with the same valid time are opened
+# together. Every station is located on each grid (columns.grid_index)
+# and assigned to the finest domain (smallest DX) that contains it;
+# each domain is then read only for the columns of its own stations.
+# The result is one entry per valid time (the same dictionary as
+# colcache.extract returns) with the domain of every station in
+# entry['domain'], which is stored in NWP_IN_DOMAIN.
+
+import os
+import re
+import glob
+import numpy as np
+import columns
+import colcache
+import dbwriter
+import ncreader
+
+
+# Define a procedure that returns the domain-less prefix
+# of a file prefix (wrfout_d02 -> wrfout):
+def base_prefix(prefix):
+	return re.sub(r'_d\d\d$', '', prefix)
+
+
+# Define a procedure that groups the files of the domains
+# by valid time. Returns a list (sorted by valid time) of
+# dictionaries domain -> file:
+def group_files(basedir, prefix, domains):
+	base = base_prefix(prefix)
+	groups = {}
+	for domain in domains:
+		start = base + '_' + domain + '_'
+		for file in glob.glob(os.path.join(basedir, start + '*')):
+			valid = os.path.basename(file)[len(start):]
+			groups.setdefault(valid, {})[domain] = file
+	return [groups[valid] for valid in sorted(groups)]
+
+
+# Define a procedure that extracts the entry of the stations
+# from the files of one valid time (dictionary domain -> file).
+# grids keeps the grid indices between calls (see colcache.extract):
+def extract_domains(files, stations, grids=None):
+	if grids is None:
+		grids = {}
+	lats = [station['latt'] for station in stations]
+	lons = [station['long'] for station in stations]
+	skey = colcache.station_key(stations)
+
+	# Locate the stations on every grid and keep,
+	# for every station, the domain with the smallest DX:
+	opened = {}
+	indices = {}
+	try:
+		best = np.full(len(stations), -1, dtype=int)
+		best_dx = np.full(len(stations), np.inf)
+		order = sorted(files)
+		for d, domain in enumerate(order):
+			ncfile = ncreader.open_dataset(files[domain])
+			opened[domain] = ncfile
+			grid = columns.grid_params(ncfile)
+			key = (tuple(sorted(grid.items())), skey)
+			if not key in grids:
+				grids[key] = columns.grid_index(grid, lats, lons)
+			i0, j0, inside = grids[key]
+			indices[domain] = (i0, j0, grid['dx'])
+			finer = inside & (grid['dx'] < best_dx)
+			best[finer] = d
+			best_dx[finer] = grid['dx']
+
+		# Read every domain for its stations only:
+		parts = []
+		for d, domain in enumerate(order):
+			selected = np.nonzero(best == d)[0]
+			if not len(selected):
+				continue
+			i0, j0, dx = indices[domain]
+			col = columns.read_columns(opened[domain], columns.fields_1d + columns.fields_3d, i0[selected], j0[selected])
+			parts.append((domain, selected, i0[selected], j0[selected], dx, col))
+		time = opened[order[-1]].variables['Times'][0].tobytes().decode('ascii')
+	finally:
+		for ncfile in opened.values():
+			ncfile.close()
+
+	# Merge the parts in the order of the stations:
+	selected = np.concatenate([part[1] for part in parts]) if len(parts) else np.zeros(0, dtype=int)
+	sort = np.argsort(selected)
+	entry = {}
+	names = set()
+	for part in parts:
+		names.update(part[5])
+	for name in names:
+		values = [part[5][name] for part in parts if name in part[5]]
+		if len(values) != len(parts):
+			raise ValueError('Field {} is missing in some of the domains'.format(name))
+		if len(set(value.shape[1:] for value in values)) != 1:
+			raise ValueError('Field {} has different levels in the domains'.format(name))
+		entry[name] = np.concatenate(values)[sort]
+	entry['time'] = time
+	entry['source'] = ','.join(os.path.realpath(files[domain]) for domain in order)
+	entry['id'] = np.array([stations[s]['id'] for s in selected], dtype=int)[sort]
+	entry['i0'] = np.concatenate([part[2] for part in parts] + [np.zeros(0, dtype=int)])[sort]
+	entry['j0'] = np.concatenate([part[3] for part in parts] + [np.zeros(0, dtype=int)])[sort]
+	entry['latt'] = np.array([lats[s] for s in selected], dtype=float)[sort]
+	entry['long'] = np.array([lons[s] for s in selected], dtype=float)[sort]
+	entry['domain'] = np.array([part[0] for part in parts for s in part[1]])[sort]
+	entry['dx'] = np.array([part[4] for part in parts for s in part[1]], dtype=float)[sort]
+	return entry
+
+
+# Define a procedure that builds the NWP_IN_DOMAIN rows
+# with the domain of every station of an entry (sensors maps
+# StationID -> SensorID):
+def domain_rows(entry, sensors, date):
+	rows = []
+	for n, stationId in enumerate(entry['id']):
+		if stationId in sensors:
+			rows.append((sensors[stationId], date, str(entry['domain'][n]), float(entry['dx'][n]), int(entry['i0'][n]), int(entry['j0'][n])))
+	return rows
+
+
+# Define a procedure that stores the domain of every
+# station of an entry in NWP_IN_DOMAIN:
+def write_domains(cur, entry, sensors, date):
+	names, keys = dbwriter.tables['NWP_IN_DOMAIN']
+	return dbwriter.upsert_many(cur, 'NWP_IN_DOMAIN', names, keys, domain_rows(entry, sensors, date))
@@ -0,0 +1,211 @@
+# extract.py
+# Direct extraction of the station values from the WRF model files.
+#
+# Replaces the GrADS step of the text path (txt2db/parse_1Dv4.gs and
+# txt2db/parse_3Dv4.gs dump nearest grid point values as text, which
+# txt2db/1Dv4.py and txt2db/3Dv4.py parse back). The same variables
+# (T2, PSFC, HGT, PBLH, RAINC + RAINNC, tk, pressure, height, QVAPOR)
+# are read straight from the model files for the stations in the
+# station list (Model_Stations.cfg: name latitude longitude station_id)
+# and written to NWP_IN_1D and NWP_IN_3D (or NWP_IN_3D_PACKED)
+# for every time step of every file.
+#
+# The values are stored with the units of ncdf2db.py:
+# temperature [C], pressure [hPa], height [m], mixing ratio [g/kg].
+#
+# Usage:
+# extract.py -b <basedir> [./] -p <prefix> [wrfout_d02] -i <stations> [Model_Stations.cfg]
+#	-s <source_name> -d <env> [-l <levels>] [rows]
+
+import sys, getopt
+import numpy as np
+import columns
+import dbwriter
+import kernels
+import ncreader
+import profiles
+import suadadb
+from ncdf2db import listfiles
+
+
+# Define a procedure that reads the station list
+# used by the GrADS scripts (name, latitude, longitude, id):
+def read_stations(filename):
+	stations = []
+	with open(filename) as f:
+		for line in f:
+			values = line.split()
+			if len(values) < 4:
+				continue
+			stations.append({'name':values[0],
+				'latt':float(values[1]),
+				'long':float(values[2]),
+				'id':int(values[3])})
+	return stations
+
+
+# Define a procedure that returns the sensors
+# of the source as a dictionary StationID -> SensorID:
+def get_sensors(cur, source_id):
+	sensors = {}
+	cur.execute("select StationID, ID from SENSOR where SourceID = %s", [source_id])
+	for row in cur.fetchall():
+		sensors[row[0]] = row[1]
+	return sensors
+
+
+# Define a procedure that extracts all time steps of one
+# model file for the stations and adds the rows to the writers:
+def extract_file(ncfile, stations, writers, levels):
+	lats = np.array([station['latt'] for station in stations])
+	lons = np.array([station['long'] for station in stations])
+	i0, j0, inside = columns.grid_index(columns.grid_params(ncfile), lats, lons)
+	for s in np.nonzero(~inside)[0]:
+		print('Station {} is outside the model grid'.format(stations[s]['name']))
+	stations = [station for s, station in enumerate(stations) if inside[s]]
+	i0 = i0[inside]
+	j0 = j0[inside]
+	lats = lats[inside]
+	lons = lons[inside]
+	if not len(stations):
+		return 0
+
+	times = columns.file_times(ncfile)
+	for t, date in enumerate(times):
+		print('Time step: {}'.format(date))
+		col = columns.read_columns(ncfile, columns.fields_1d + columns.fields_3d, i0, j0, t)
+
+		# 1D values:
+		press = col['PSFC']/100.
+		temp = col['T2'] - columns.t_kelvin
+		rain = col['RAINC'] + col['RAINNC']
+		zhd = columns.zhd(press, lats, col['HGT'])
+		for s, station in enumerate(stations):
+			writers['NWP_IN_1D'].add_dict({'SensorID':station['senid'],
+				'Datetime':date,
+				'Temperature':float(temp[s]),
+				'Pressure':float(press[s]),
+				'Altitude':float(col['HGT'][s]),
+				'Latitude':station['latt'],
+				'Longitude':station['long'],
+				'ZHD':float(zhd[s]),
+				'PBL':float(col['PBLH'][s]),
+				'Precipitation':float(rain[s])})
+
+		# 3D values:
+		prof = kernels.profile_physics(col['T'], col['P'], col['PB'], col['PH'], col['PHB'], col['QVAPOR'])
+		nz = prof['tk'].shape[1]
+		for s, station in enumerate(stations):
+			if levels in ('rows', 'both'):
+				for k in range(nz):
+					writers['NWP_IN_3D'].add((station['senid'],
+						date,
+						k,
+						float(prof['tk'][s, k]),
+						float(prof['Pair'][s, k]),
+						station['latt'],
+						station['long'],
+						float(prof['hgth'][s, k]),
+						float(prof['QV'][s, k])))
+			if levels in ('packed', 'both'):
+				writers['packed'].append(profiles.packed_row(station['senid'], date, station['latt'], station['long'],
+					prof['tk'][s],
+					prof['Pair'][s],
+					prof['hgth'][s],
+					prof['QV'][s]))
+	return len(times)
+
+
+def usage():
+	print('extract.py -b <basedir> [./] -p <prefix> [wrfout_d02] -i <stations> [Model_Stations.cfg] -s <source_name> -d <env> -l <levels> [rows]')
+
+
+def main(argv):
+	basedir = './'
+	prefix = 'wrfout_d02'
+	stationfile = 'Model_Stations.cfg'
+	source_name = ''
+	env = ''
+	levels = 'rows'
+	try:
+		opts, args = getopt.getopt(argv, "hb:p:i:s:d:l:", ["basedir=", "prefix=", "stations=", "source_name=", "env=", "levels="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-b", "--basedir"):
+			basedir = arg
+		elif opt in ("-p", "--prefix"):
+			prefix = arg
+		elif opt in ("-i", "--stations"):
+			stationfile = arg
+		elif opt in ("-s", "--source_name"):
+			source_name = arg
+		elif opt in ("-d", "--env"):
+			env = arg
+		elif opt in ("-l", "--levels"):
+			levels = arg
+
+	if source_name == '' or env == '':
+		print('Error: You must specify the source name and the database! (-s <source_name> -d <env>)')
+		sys.exit(2)
+	if not levels in profiles.level_layouts:
+		print('Error: Not a possible levels layout {}'.format(levels))
+		sys.exit(2)
+
+	flist = listfiles(basedir, prefix)
+	if not len(flist):
+		print('No candidates for import files found ...')
+		sys.exit(1)
+
+	try:
+		db = suadadb.connect(env)
+		cur = db.cursor()
+	except Exception as e:
+		print('Failed to establish connection: {0}'.format(e))
+		sys.exit(1)
+
+	source_id = suadadb.get_source_ids(cur, [source_name]).get(source_name, -1)
+	if source_id < 0:
+		print('Error: Can not find source_id for source_name: {}'.format(source_name))
+		sys.exit(1)
+
+	# Keep the stations of the list that have a sensor of the source:
+	sensors = get_sensors(cur, source_id)
+	stations = []
+	for station in read_stations(stationfile):
+		if station['id'] in sensors:
+			station['senid'] = sensors[station['id']]
+			stations.append(station)
+		else:
+			print('Error occured. I can\'t find the sensor for station {} ID: {}'.format(station['name'], station['id']))
+	print('{} stations with sensors of source {}'.format(len(stations), source_name))
+
+	for file in flist:
+		print('Processing: {}'.format(file))
+		writers = {
+			'NWP_IN_1D' : dbwriter.BatchWriter(cur, 'NWP_IN_1D'),
+			'NWP_IN_3D' : dbwriter.BatchWriter(cur, 'NWP_IN_3D'),
+			'packed'    : []
+			}
+		ncfile = ncreader.open_dataset(file)
+		try:
+			extract_file(ncfile, stations, writers, levels)
+			writers['NWP_IN_1D'].flush()
+			writers['NWP_IN_3D'].flush()
+			profiles.write_packed_profiles(cur, writers['packed'])
+			db.commit()
+		except Exception as e:
+			db.rollback()
+			sys.stderr.write('Error occured in extract_file {file}: {error}\n'.format(file = file, error = repr(e)))
+		finally:
+			ncfile.close()
+
+	cur.close()
+	db.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,317 @@
+# fetch.py
+# Download and ingest of the model files from the SUADA server.
+#
+# Instead of fetching every wrfout file with curl and running
+# ncdf2db.py afterwards, the files are downloaded by -j threads at
+# the same time and every completed file is ingested at once
+# (ingestd.Ingestor, the same options as ncdf2db.py) while the next
+# files are still downloading. A download is written to <file>.part
+# and resumed with an HTTP Range request after an interruption; the
+# file is used only when its size matches Content-Length.
+#
+# --max-disk bounds the disk space of the downloaded files: a download
+# starts only when its size fits, the ingested files are removed
+# (with --keep the oldest ingested files are removed when the space
+# is needed). Without -s/-d the files are only downloaded.
+#
+# The files are the arguments, the lines of -i <list> or the
+# links starting with <prefix> on the index page of the base URL.
+#
+# Usage:
+# fetch.py -u <base URL> -p <prefix> [wrfout_d02] -w <datadir> [./]
+#	[-j <downloads>] [4] [--max-disk <MB>] [0 = no limit] [--keep]
+#	[-s <source_name> -d <env>] [-c <country>] [-l <levels>] [-k <cachedir>]
+#	[-i <list>] [file ...]
+
+import sys, os, getopt, re, time
+import threading
+try:
+	import Queue as queue
+	from urllib2 import Request, urlopen
+	from urlparse import urljoin
+except ImportError:
+	import queue
+	from urllib.request import Request, urlopen
+	from urllib.parse import urljoin
+
+
+chunk_size = 1024 * 1024
+retries = 3
+timeout = 60
+
+
+# Define a procedure that lists the files starting with
+# prefix on the index page of the base URL:
+def list_remote(base_url, prefix):
+	page = urlopen(base_url, timeout=timeout).read().decode('utf-8', 'replace')
+	names = re.findall(r'href="(' + re.escape(prefix) + r'[^"/?]*)"', page)
+	return sorted(set(name.replace('%3A', ':').replace('%3a', ':') for name in names))
+
+
+# Define a procedure that returns the size of a remote
+# file (Content-Length of a HEAD request, None if unknown):
+def remote_size(url):
+	request = Request(url)
+	request.get_method = lambda: 'HEAD'
+	response = urlopen(request, timeout=timeout)
+	try:
+		length = response.headers.get('Content-Length')
+	finally:
+		response.close()
+	return int(length) if length is not None else None
+
+
+# Define a procedure that downloads url to path. An existing
+# path + '.part' is resumed with a Range request (started again
+# if the server ignores the range, used as it is if it has the
+# whole file already). Returns the size of the file:
+def download(url, path, size=None):
+	part = path + '.part'
+	offset = os.path.getsize(part) if os.path.exists(part) else 0
+	if size is not None and offset > size:
+		offset = 0
+	if size is not None and offset == size and size > 0:
+		# Completed before a crash, not renamed yet:
+		os.rename(part, path)
+		return size
+	request = Request(url)
+	if offset:
+		request.add_header('Range', 'bytes={}-'.format(offset))
+	response = urlopen(request, timeout=timeout)
+	try:
+		if offset and response.getcode() != 206:
+			offset = 0 # the whole file again
+		with open(part, 'ab' if offset else 'wb') as f:
+			while True:
+				data = response.read(chunk_size)
+				if not data:
+					break
+				f.write(data)
+	finally:
+		response.close()
+	got = os.path.getsize(part)
+	if size is not None and got != size:
+		raise IOError('Size of {} is {} instead of {}'.format(part, got, size))
+	os.rename(part, path)
+	return got
+
+
+# A DiskBudget keeps the bytes of the downloaded files
+# below limit (0 = no limit). reserve waits until the size
+# fits, removing the oldest kept (ingested) files first:
+class DiskBudget(object):
+
+	def __init__(self, limit):
+		self.limit = limit
+		self.used = 0
+		self.kept = []
+		self.cond = threading.Condition()
+
+	def reserve(self, size):
+		with self.cond:
+			# A file larger than the limit waits until nothing else is on disk:
+			while self.limit and self.used > 0 and self.used + size > self.limit:
+				if len(self.kept):
+					path, kept_size = self.kept.pop(0)
+					remove(path)
+					self.used -= kept_size
+					continue
+				self.cond.wait()
+			self.used += size
+
+	def release(self, size):
+		with self.cond:
+			self.used -= size
+			self.cond.notify_all()
+
+	# A file is ingested: remove it or keep it until the space is needed:
+	def ingested(self, path, size, keep):
+		if keep:
+			with self.cond:
+				self.kept.append((path, size))
+				self.cond.notify_all()
+		else:
+			remove(path)
+			self.release(size)
+
+
+def remove(path):
+	try:
+		os.remove(path)
+		print('Removed: {}'.format(path))
+	except OSError:
+		pass
+
+
+# A Fetcher downloads the files with threads workers and puts
+# (name, path, size, error) of every finished file into done:
+class Fetcher(object):
+
+	def __init__(self, base_url, datadir, budget, workers=4):
+		self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+		self.datadir = datadir
+		self.budget = budget
+		self.todo = queue.Queue()
+		self.done = queue.Queue()
+		self.threads = [threading.Thread(target=self.work) for n in range(workers)]
+		for thread in self.threads:
+			thread.daemon = True
+
+	def start(self, names):
+		for name in names:
+			self.todo.put(name)
+		for thread in self.threads:
+			self.todo.put(None)
+			thread.start()
+
+	# Every file gets a result, also after an unexpected error
+	# (the caller waits for one result per file):
+	def work(self):
+		while True:
+			name = self.todo.get()
+			if name is None:
+				return
+			try:
+				result = self.fetch(name)
+			except Exception as e:
+				result = (name, os.path.join(self.datadir, name), 0, repr(e))
+			self.done.put(result)
+
+	# Download one file (retried with an increasing delay):
+	def fetch(self, name):
+		url = urljoin(self.base_url, name)
+		path = os.path.join(self.datadir, name)
+		error = None
+		for attempt in range(retries):
+			reserved = 0
+			try:
+				size = remote_size(url)
+				if size is not None and os.path.exists(path) and os.path.getsize(path) == size:
+					self.budget.reserve(size)
+					return name, path, size, None # downloaded before
+				reserved = size or 0
+				self.budget.reserve(reserved)
+				got = download(url, path, size)
+				if got != reserved:
+					self.budget.reserve(got - reserved) if got > reserved else self.budget.release(reserved - got)
+				print('Downloaded: {} ({} bytes)'.format(name, got))
+				return name, path, got, None
+			except Exception as e:
+				# Also the errors of httplib (e.g. BadStatusLine, IncompleteRead):
+				self.budget.release(reserved)
+				error = repr(e)
+				sys.stderr.write('Error occured in download {file}: {error}\n'.format(file = name, error = error))
+				if attempt + 1 < retries:
+					time.sleep(2 ** attempt)
+		return name, path, 0, error
+
+
+# Define a procedure that reads the file names of a list
+# (one per line, empty lines and # comments are skipped):
+def read_list(filename):
+	with open(filename) as f:
+		return [line.split('#')[0].strip() for line in f if line.split('#')[0].strip()]
+
+
+def usage():
+	print('fetch.py -u <base URL> -p <prefix> [wrfout_d02] -w <datadir> [./] -j <downloads> [4] --max-disk <MB> --keep -s <source_name> -d <env> -c <country> -l <levels> -k <cachedir> -i <list> [file ...]')
+
+
+def main(argv):
+	base_url = ''
+	prefix = 'wrfout_d02'
+	datadir = './'
+	workers = 4
+	max_disk = 0.
+	keep = False
+	listfile = ''
+	job = {}
+	try:
+		opts, args = getopt.getopt(argv, "hu:p:w:j:s:d:c:l:k:i:", ["url=", "prefix=", "datadir=", "downloads=", "max-disk=", "keep", "source_name=", "env=", "country=", "levels=", "cache=", "list="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-u", "--url"):
+			base_url = arg
+		elif opt in ("-p", "--prefix"):
+			prefix = arg
+		elif opt in ("-w", "--datadir"):
+			datadir = arg
+		elif opt in ("-j", "--downloads"):
+			workers = int(arg)
+		elif opt == "--max-disk":
+			max_disk = float(arg)
+		elif opt == "--keep":
+			keep = True
+		elif opt in ("-s", "--source_name"):
+			job['source_name'] = arg
+		elif opt in ("-d", "--env"):
+			job['env'] = arg
+		elif opt in ("-c", "--country"):
+			job['country'] = arg
+		elif opt in ("-l", "--levels"):
+			job['levels'] = arg
+		elif opt in ("-k", "--cache"):
+			job['cache'] = os.path.abspath(arg)
+		elif opt in ("-i", "--list"):
+			listfile = arg
+
+	if base_url == '':
+		print('Error: You must specify the base URL! (-u <base URL>)')
+		sys.exit(2)
+	if ('source_name' in job) != ('env' in job):
+		print('Error: You must specify both the source name and the database to ingest! (-s <source_name> -d <env>)')
+		sys.exit(2)
+	if max_disk > 0 and not 'env' in job:
+		# Only the ingested files make room:
+		print('Error: --max-disk needs the ingest (-s <source_name> -d <env>)')
+		sys.exit(2)
+	if not os.path.isdir(datadir):
+		os.makedirs(datadir)
+
+	if len(args):
+		names = list(args)
+	elif listfile:
+		names = read_list(listfile)
+	else:
+		names = list_remote(base_url, prefix)
+	print('{} files to fetch from {}'.format(len(names), base_url))
+
+	ingestor = None
+	if 'env' in job:
+		import ingestd
+		ingestor = ingestd.Ingestor()
+
+	budget = DiskBudget(max_disk * 1024 * 1024)
+	fetcher = Fetcher(base_url, datadir, budget, workers)
+	fetcher.start(names)
+	failed = 0
+	for n in range(len(names)):
+		name, path, size, error = fetcher.done.get()
+		if error is not None:
+			failed += 1
+			continue
+		if ingestor is None:
+			continue
+		options = dict(job)
+		options['files'] = [path]
+		result = ingestor.submit(options)
+		if result['status'] == 'ok':
+			print('Ingested: {} ({} s)'.format(name, result['seconds']))
+			budget.ingested(path, size, keep)
+		else:
+			# Kept for a rerun, but not counted against the limit:
+			failed += 1
+			budget.release(size)
+	if ingestor is not None:
+		ingestor.close()
+	print('{} files fetched, {} failed'.format(len(names) - failed, failed))
+	if failed:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,115 @@
+# ingest.py
+# Client of the ingest service (ingestd.py).
+#
+# Sends a job with the options of ncdf2db.py to the service,
+# through its Unix socket (-u, waits for the result) or its spool
+# directory (-q, returns at once). Model files given as arguments
+# are ingested instead of the files in basedir with prefix.
+#
+# Usage:
+# ingest.py -u <socket> | -q <spooldir> -b <basedir> -p <prefix> -s <source_name>
+#	-c <country> -d <env> -o <output> -l <levels> -k <cachedir> --from-cache
+#	-m <domains>
+#	--reload [file ...]
+# ingest.py -u <socket> --stop
+
+import sys, os, getopt, json, socket, time
+
+
+def usage():
+	print('ingest.py -u <socket> | -q <spooldir> -b <basedir> -p <prefix> -s <source_name> -c <country> -d <env> -o <output> -l <levels> -k <cachedir> --from-cache -m <domains> --reload --stop [file ...]')
+
+
+# Define a procedure that sends a job through the socket
+# and returns the result of the service:
+def send_job(sockpath, job):
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(sockpath)
+		sock.sendall((json.dumps(job) + '\n').encode('utf-8'))
+		data = b''
+		while not data.endswith(b'\n'):
+			chunk = sock.recv(4096)
+			if not chunk:
+				break
+			data += chunk
+	finally:
+		sock.close()
+	return json.loads(data.decode('utf-8'))
+
+
+# Define a procedure that puts a job into the spool directory.
+# The file is renamed to *.job when complete, so the service
+# never reads a half-written job:
+def spool_job(spooldir, job):
+	name = '{}-{}-{}.job'.format(time.strftime('%Y%m%d%H%M%S'), socket.gethostname(), os.getpid())
+	path = os.path.join(spooldir, name)
+	with open(path + '.tmp', 'w') as f:
+		f.write(json.dumps(job) + '\n')
+	os.rename(path + '.tmp', path)
+	return path
+
+
+def main(argv):
+	sockpath = ''
+	spooldir = ''
+	job = {}
+	try:
+		opts, args = getopt.getopt(argv, "hu:q:b:p:s:c:d:o:l:k:m:", ["socket=", "spool=", "basedir=", "prefix=", "source_name=", "country=", "env=", "output=", "levels=", "cache=", "cache-size=", "from-cache", "domains=", "reload", "stop"])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-u", "--socket"):
+			sockpath = arg
+		elif opt in ("-q", "--spool"):
+			spooldir = arg
+		elif opt in ("-b", "--basedir"):
+			job['basedir'] = os.path.abspath(arg)
+		elif opt in ("-p", "--prefix"):
+			job['prefix'] = arg
+		elif opt in ("-s", "--source_name"):
+			job['source_name'] = arg
+		elif opt in ("-c", "--country"):
+			job['country'] = arg
+		elif opt in ("-d", "--env"):
+			job['env'] = arg
+		elif opt in ("-o", "--output"):
+			job['output'] = arg
+		elif opt in ("-l", "--levels"):
+			job['levels'] = arg
+		elif opt in ("-k", "--cache"):
+			job['cache'] = os.path.abspath(arg)
+		elif opt == "--cache-size":
+			job['cache_size'] = float(arg)
+		elif opt == "--from-cache":
+			job['from_cache'] = True
+		elif opt in ("-m", "--domains"):
+			job['domains'] = arg
+		elif opt == "--reload":
+			job['reload'] = True
+		elif opt == "--stop":
+			job = {'command' : 'stop'}
+
+	if sockpath == '' and spooldir == '':
+		print('Error: You must specify the socket or the spool directory! (-u <socket> -q <spooldir>)')
+		sys.exit(2)
+	if job.get('command') != 'stop':
+		if len(args):
+			job['files'] = [os.path.abspath(arg) for arg in args]
+		# The -o tro files are written in the current directory:
+		job['workdir'] = os.getcwd()
+
+	if sockpath:
+		result = send_job(sockpath, job)
+		print(json.dumps(result))
+		if result.get('status') != 'ok':
+			sys.exit(1)
+	else:
+		print('Queued {}'.format(spool_job(spooldir, job)))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
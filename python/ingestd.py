@@ -0,0 +1,261 @@
+# ingestd.py
+# Resident ingest service for the model files.
+#
+# Starting ncdf2db.py once per file pays every time for the
+# interpreter, the imports, the DB connection, get_source_id and
+# getstations. ingestd.py is started once and keeps the DB
+# connections, the station lists of every source and the grid indices
+# of the stations. Jobs (the options of ncdf2db.py) are accepted as
+# one line of JSON on a local Unix socket and/or as *.job files in a
+# spool directory, and are run one after the other with
+# ncdf2db.ingest_files. Submit jobs with ingest.py.
+#
+# Usage:
+# ingestd.py -u <socket> [-q <spooldir>] [-t <poll seconds>] [5]
+#
+# A job is a JSON object with the keys (ncdf2db.py options):
+# basedir, prefix, source_name, country, env, output, levels,
+# cache, cache_size, from_cache, domains (e.g. "d01,d02,d03"), plus
+# files   - a list of model files (instead of basedir/prefix),
+# workdir - the directory for the -o tro output files,
+# reload  - reload the station list of the source first.
+# {"command": "stop"} stops the service.
+
+import sys, os, getopt, json, time, glob
+try:
+	import SocketServer as socketserver
+except ImportError:
+	import socketserver
+import ncdf2db
+import suadadb
+import colcache
+import domains
+import profiles
+
+
+# Defaults of the job options (the same as in ncdf2db.py):
+defaults = {
+	'basedir'     : './',
+	'prefix'      : 'wrfout_d02',
+	'source_name' : '',
+	'country'     : 'All',
+	'env'         : '',
+	'output'      : 'db',
+	'levels'      : 'rows',
+	'cache'       : '',
+	'cache_size'  : colcache.default_size,
+	'from_cache'  : False,
+	'domains'     : '',
+	'files'       : None,
+	'workdir'     : '',
+	'reload'      : False
+	}
+instrument_name = 'GNSS'
+
+
+# An Ingestor runs the jobs and keeps what they share:
+# the DB connection of every environment, the source id and
+# stations of every (env, source_name, country) and the grid
+# indices of the stations (see colcache.extract).
+class Ingestor(object):
+
+	def __init__(self):
+		self.connections = {}
+		self.registries = {}
+		self.grids = {}
+		self.running = True
+		self.jobs = 0
+
+	# Return the connection of the environment,
+	# reconnect if the server has closed it:
+	def connection(self, env):
+		db = self.connections.get(env)
+		if db is not None:
+			try:
+				db.ping()
+			except Exception:
+				db = None
+		if db is None:
+			db = suadadb.connect(env)
+			self.connections[env] = db
+		return db
+
+	# Return (source_id, stations) of the source:
+	def registry(self, cur, env, source_name, country, reload=False):
+		key = (env, source_name, country)
+		if reload or not key in self.registries:
+			source_id = ncdf2db.get_source_id(cur, source_name)
+			if source_id < 0:
+				raise ValueError('Can not find source_id for source_name: {}'.format(source_name))
+			stations = ncdf2db.getstations(cur, source_name, country, instrument_name)
+			stations = [station for station in stations if (country == 'All') or (country == station['country'])]
+			print('Source id: {} found for source name: {} ({} stations)'.format(source_id, source_name, len(stations)))
+			self.registries[key] = (source_id, stations)
+		return self.registries[key]
+
+	# Run one job, returns the result as a dictionary:
+	def run(self, job):
+		if job.get('command') == 'stop':
+			self.running = False
+			return {'status' : 'ok', 'command' : 'stop'}
+		unknown = [name for name in job if not name in defaults]
+		if len(unknown):
+			raise ValueError('Unknown job options: {}'.format(', '.join(unknown)))
+		options = dict(defaults)
+		options.update(job)
+		if options['source_name'] == '' or options['env'] == '':
+			raise ValueError('You must specify source_name and env')
+		if not options['output'] in ('db', 'tro'):
+			raise ValueError('Not a possible output {}'.format(options['output']))
+		if not options['levels'] in profiles.level_layouts:
+			raise ValueError('Not a possible levels layout {}'.format(options['levels']))
+		if options['from_cache'] and options['cache'] == '':
+			raise ValueError('from_cache needs the cache directory')
+
+		if options['files'] is not None:
+			flist = list(options['files'])
+		elif options['from_cache']:
+			flist = colcache.entries(options['cache'], options['prefix'])
+		elif options['domains']:
+			flist = domains.group_files(options['basedir'], options['prefix'], options['domains'].split(','))
+		else:
+			flist = ncdf2db.listfiles(options['basedir'], options['prefix'])
+
+		start = time.time()
+		cwd = os.getcwd()
+		db = self.connection(options['env'])
+		cur = db.cursor()
+		try:
+			source_id, stations = self.registry(cur, options['env'], options['source_name'], options['country'], options['reload'])
+			if options['workdir']:
+				os.chdir(options['workdir'])
+			files = ncdf2db.ingest_files(db, cur, flist, stations, source_id,
+				options['country'], options['output'], options['levels'],
+				options['cache'], float(options['cache_size']), options['from_cache'], self.grids)
+		finally:
+			os.chdir(cwd)
+			cur.close()
+		self.jobs += 1
+		return {'status' : 'ok', 'files' : files, 'seconds' : round(time.time() - start, 3)}
+
+	# Run a job and turn errors into an error result:
+	def submit(self, job):
+		try:
+			return self.run(job)
+		except Exception as e:
+			sys.stderr.write('Error occured in job {job}: {error}\n'.format(job = json.dumps(job), error = repr(e)))
+			return {'status' : 'error', 'error' : repr(e)}
+
+	def close(self):
+		for db in self.connections.values():
+			try:
+				db.close()
+			except Exception:
+				pass
+		self.connections = {}
+
+
+# Reads one job (a line of JSON) from the socket
+# and writes back the result (a line of JSON):
+class JobHandler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		line = self.rfile.readline()
+		try:
+			job = json.loads(line.decode('utf-8'))
+		except ValueError as e:
+			result = {'status' : 'error', 'error' : 'Bad job: {}'.format(e)}
+		else:
+			result = self.server.ingestor.submit(job)
+		self.wfile.write((json.dumps(result) + '\n').encode('utf-8'))
+
+
+# Define a procedure that runs the *.job files waiting in the
+# spool directory (oldest first). Every job is moved to
+# done/ or failed/ with its result in <name>.result:
+def drain_spool(spooldir, ingestor):
+	for path in sorted(glob.glob(os.path.join(spooldir, '*.job'))):
+		if not ingestor.running:
+			break
+		name = os.path.basename(path)
+		running = path + '.running'
+		try:
+			os.rename(path, running)
+		except OSError:
+			continue # taken by another service
+		try:
+			with open(running) as f:
+				job = json.load(f)
+		except ValueError as e:
+			result = {'status' : 'error', 'error' : 'Bad job: {}'.format(e)}
+		else:
+			result = ingestor.submit(job)
+		target = os.path.join(spooldir, 'done' if result['status'] == 'ok' else 'failed')
+		if not os.path.isdir(target):
+			os.makedirs(target)
+		os.rename(running, os.path.join(target, name))
+		with open(os.path.join(target, name + '.result'), 'w') as f:
+			f.write(json.dumps(result) + '\n')
+
+
+def usage():
+	print('ingestd.py -u <socket> -q <spooldir> -t <poll seconds> [5]')
+
+
+def main(argv):
+	sockpath = ''
+	spooldir = ''
+	poll = 5.
+	try:
+		opts, args = getopt.getopt(argv, "hu:q:t:", ["socket=", "spool=", "poll="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-u", "--socket"):
+			sockpath = arg
+		elif opt in ("-q", "--spool"):
+			spooldir = arg
+		elif opt in ("-t", "--poll"):
+			poll = float(arg)
+
+	if sockpath == '' and spooldir == '':
+		print('Error: You must specify the socket or the spool directory! (-u <socket> -q <spooldir>)')
+		sys.exit(2)
+	if spooldir and not os.path.isdir(spooldir):
+		os.makedirs(spooldir)
+
+	ingestor = Ingestor()
+	server = None
+	if sockpath:
+		if os.path.exists(sockpath):
+			os.remove(sockpath)
+		server = socketserver.UnixStreamServer(sockpath, JobHandler)
+		server.ingestor = ingestor
+		server.timeout = poll
+		print('Listening on {}'.format(sockpath))
+	if spooldir:
+		print('Watching {}'.format(spooldir))
+
+	try:
+		while ingestor.running:
+			if server is not None:
+				server.handle_request()
+			else:
+				time.sleep(poll)
+			if spooldir:
+				drain_spool(spooldir, ingestor)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if server is not None:
+			server.server_close()
+			os.remove(sockpath)
+		ingestor.close()
+		print('Stopped after {} jobs'.format(ingestor.jobs))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,86 @@
+# kernels.py
+# Fused column physics kernel with optional JIT compilation.
+#
+# columns.profile_physics computes tk, mixing ratio, water vapour
+# density and the cumulative IWV with array operations, which builds
+# a dozen temporary arrays of the full [station, level] (or grid)
+# size. _column_physics does the same per column in one loop over
+# the levels. When numba is installed the loop is compiled
+# (njit, parallel over the columns); without numba profile_physics
+# falls back to columns.profile_physics.
+#
+# ncdf2db.py computes the level values and IWV of all stations of a
+# file with profile_physics. Tests of the kernel against
+# columns.profile_physics and the former level loop of
+# ncdf2db.process_station: python -m unittest test_kernels
+
+import numpy as np
+import columns
+
+try:
+	from numba import njit, prange
+	have_jit = True
+except ImportError:
+	prange = range
+	have_jit = False
+
+
+t_kelvin = columns.t_kelvin
+Rd_Cp = columns.Rd_Cp
+Rv = columns.Rv
+
+
+# Define the kernel: one pass over the levels of every column
+# (the same equations as columns.profile_physics). The input arrays
+# are [column, level] (PH and PHB may have one more level), the
+# output arrays are filled in place; IWV_cum has top + 1 levels:
+def _column_physics(T, P, PB, PH, PHB, QVAPOR, tk, Pair, hgth, QV, rho, IWV_cum):
+	n, nz = T.shape
+	top = IWV_cum.shape[1] - 1
+	for s in prange(n):
+		IWV_cum[s, 0] = 0.
+		for k in range(nz):
+			theta = T[s, k] + 300.
+			pa = P[s, k] + PB[s, k]
+			Pair[s, k] = pa/100.
+			tk[s, k] = theta * ((pa/100000.)**Rd_Cp) - t_kelvin
+			QV[s, k] = QVAPOR[s, k]*1000.
+			hgth[s, k] = (PH[s, k] + PHB[s, k])/9.81
+			q = QV[s, k] / (QV[s, k] + 1.)
+			e = (Pair[s, k] * q) / (0.622 + (0.378 * q))
+			rho[s, k] = e / (Rv * (theta * ((pa/100000.)**(2./7.))))
+			# Trapezoid of the layer between k-1 and k:
+			if k >= 1 and k <= top:
+				IWV_cum[s, k] = IWV_cum[s, k-1] + ((rho[s, k-1] + rho[s, k]) / 2.) * abs(hgth[s, k] - hgth[s, k-1])
+
+
+if have_jit:
+	_jit_column_physics = njit(parallel=True, cache=True)(_column_physics)
+
+
+# Define a procedure that runs the kernel (the pure Python version
+# without numba, only useful for the tests) on columns
+# [..., level]. Returns the same dictionary as columns.profile_physics:
+def run_kernel(T, P, PB, PH, PHB, QVAPOR, jit=True):
+	shape = np.shape(T)
+	nz = shape[-1]
+	flat = lambda a: np.ascontiguousarray(np.reshape(a, (-1, np.shape(a)[-1])), dtype=np.float64)
+	T, P, PB, PH, PHB, QVAPOR = [flat(a) for a in (T, P, PB, PH, PHB, QVAPOR)]
+	n = T.shape[0]
+	top = min(columns.iwv_top_layer + 1, nz - 1)
+	out = dict((name, np.empty((n, nz))) for name in ('tk', 'Pair', 'hgth', 'QV', 'rho'))
+	out['IWV_cum'] = np.empty((n, top + 1))
+	kernel = _jit_column_physics if (jit and have_jit) else _column_physics
+	kernel(T, P, PB, PH, PHB, QVAPOR, out['tk'], out['Pair'], out['hgth'], out['QV'], out['rho'], out['IWV_cum'])
+	result = dict((name, np.reshape(values, shape[:-1] + values.shape[-1:])) for name, values in out.items())
+	result['IWV'] = result['IWV_cum'][..., -1]
+	return result
+
+
+# Define a procedure that computes the column physics with the
+# compiled kernel when numba is installed, with NumPy otherwise
+# (use_jit=False forces NumPy):
+def profile_physics(T, P, PB, PH, PHB, QVAPOR, use_jit=True):
+	if use_jit and have_jit:
+		return run_kernel(T, P, PB, PH, PHB, QVAPOR)
+	return columns.profile_physics(T, P, PB, PH, PHB, QVAPOR)
@@ -17,14 +17,25 @@
 
 import sys, getopt
 import glob
+import time
 from tzlocal import get_localzone
 from dateutil import parser
 import datetime
-from netCDF4 import Dataset as netcdf
+import ncreader
 import MySQLdb
 import databaseconfig as cfg
 import numpy as np
 import wrf
+import columns
+import profiles
+import colcache
+import domains
+import kernels
+import dbwriter
+import blockhash
+import suadadb
+from spool import Spool, SpoolWriter
+import shards
 
 
 # Define global variables:
@@ -71,6 +82,71 @@ def getstations(cur, source_name, country, instrument_name):
 	return stations
 
 
+# Define a procedure that selects the stations of several
+# sources with one query. Returns a dictionary
+# source_name -> list of stations (as getstations):
+def getstations_sources(cur, source_names, country, instrument_name):
+	stations = dict((source_name, []) for source_name in source_names)
+	if not len(source_names):
+		return stations
+	try:
+		cur.execute("select st.ID, \
+			st.Name, \
+			crd.Longitude, \
+			crd.Latitude, \
+			crd.Altitude, \
+			sen.ID, \
+			st.Country, \
+			so.Name \
+			from SENSOR as sen left join SOURCE as so ON so.ID = sen.SourceID \
+			left join STATION as st ON st.ID = sen.StationID \
+			left join COORDINATE as crd ON crd.STationID = st.ID \
+			left join INSTRUMENT as instr ON instr.ID = crd.InstrumentID \
+			WHERE so.Name in (" + ', '.join(['%s'] * len(source_names)) + ") \
+			AND instr.Name = %s",
+			list(source_names) + [instrument_name])
+		for row in cur.fetchall():
+			stations[row[7]].append({'id':row[0],
+				'name':row[1],
+				'long':row[2],
+				'latt':row[3],
+				'alt':row[4],
+				'senid':row[5],
+				'country':row[6]})
+	except Exception as e:
+		print('Error at getstations_sources: {}'.format(e))
+
+	return stations
+
+
+# Define a procedure that keeps the stations that have
+# no model rows (NWP_IN_1D or NWP_OUT of the source)
+# between date_from and date_to:
+def stations_without_rows(cur, stations, source_id, date_from, date_to):
+	if not len(stations):
+		return []
+	cond, params = suadadb.in_condition('SensorID', [station['senid'] for station in stations])
+	cur.execute("select distinct SensorID from NWP_IN_1D \
+		where Datetime >= %s and Datetime <= %s" + cond, [date_from, date_to] + params)
+	sensors_1d = set(row[0] for row in cur.fetchall())
+	cond, params = suadadb.in_condition('StationID', [station['id'] for station in stations])
+	cur.execute("select distinct StationID from NWP_OUT \
+		where SourceModID = %s and Datetime >= %s and Datetime <= %s" + cond, [source_id, date_from, date_to] + params)
+	stations_out = set(row[0] for row in cur.fetchall())
+	return [station for station in stations if not (station['senid'] in sensors_1d and station['id'] in stations_out)]
+
+
+# Define a procedure that returns the first and the last
+# valid time in the names of the files (None, None if
+# the names have no valid time):
+def file_period(flist):
+	times = [shards.item_key(item)[0] for item in flist]
+	times = [datetime.datetime.strptime(t, '%Y-%m-%d_%H_%M_%S') for t in times if t]
+	if not len(times):
+		return None, None
+	return min(times), max(times)
+
+
 # Define a procedure that lists files containing data
 # in the selected by the user base directory and prefix:
 def listfiles(basedir, prefix):
@@ -129,7 +205,16 @@ def get_station_name(cur, country):
 # accumulates data for the troposinex txt format into a dictionary.
 # If you change one of these two procedures, 
 # you should also change the other accordingly.
-def process_station(db, cur, station, ncfile, date):
+# col holds the model columns of the station (see columns.read_columns):
+# one value for the 2D fields, the level values of kernels.profile_physics
+# (tk, Pair, hgth, QV) and the NWP_OUT products of columns.iwv_products
+# (IWV, IWV_500_*, IWV_Max_Height; see ingest_files).
+# levels selects where the 3D profile goes (see profiles.level_layouts):
+# NWP_IN_3D rows, one NWP_IN_3D_PACKED row, or both.
+# The rows are added to the batched writers (see new_writers) and
+# sent by the caller (flush_writers), without a commit per station.
+# Returns False if the station failed (its rows may be incomplete):
+def process_station(station, col, date, writers, levels='rows'):
 	result = True
 	try:
 		stationName = station['name']
@@ -145,47 +230,43 @@ def process_station(db, cur, station, ncfile, date):
 		
 		# 1D FIELDS:
 		# T2 [K] - temperature on 2m height:
-		T2 = ncfile.variables['T2'][0]
+		T2 = col['T2']
 		# Pressure, [Pa]:
-		Pressure = ncfile.variables['PSFC'][0]
+		Pressure = col['PSFC']
 		# PBLH, [m] - planatary boundary layer height:
-		PBLH = ncfile.variables['PBLH'][0]
+		PBLH = col['PBLH']
 		# HGT, [m] - 1D height above sea level:
-		HGT = ncfile.variables['HGT'][0]
+		HGT = col['HGT']
 		# The following 4 fields are in [mm]:
-		RAINNC = ncfile.variables['RAINNC'][0]
-		SNOWNC = ncfile.variables['SNOWNC'][0]
-		GRAUPELNC = ncfile.variables['GRAUPELNC'][0]
-		HAILNC = ncfile.variables['HAILNC'][0]
+		RAINNC = col['RAINNC']
+		SNOWNC = col['SNOWNC']
+		GRAUPELNC = col['GRAUPELNC']
+		HAILNC = col['HAILNC']
 		# Precipitation [mm]:
 		Precipitation = RAINNC + SNOWNC + GRAUPELNC + HAILNC
 
-		# 3D FIELDS:
-		# T, [K] - temperature:
-		T = ncfile.variables['T'][0]
-		# P, [Pa] - perturbation pressure:
-		P = ncfile.variables['P'][0]
-		# PB, [Pa] - base state pressure:
-		PB = ncfile.variables['PB'][0]
-		# PHB [m] - base state geopotential height:
-		PHB = ncfile.variables['PHB'][0]
-		# PH [m] - perturbation geopotential height:
-		PH = ncfile.variables['PH'][0]
-		# QVAPOR [kg/kg] - water vapour mixing ratio:
-		QVAPOR = ncfile.variables['QVAPOR'][0]
+		# 3D FIELDS (one value per level, see kernels.profile_physics):
+		# tk, [C] - temperature:
+		tk = col['tk']
+		# Pair, [hPa] - pressure:
+		Pair = col['Pair']
+		# hgth, [m] - height:
+		hgth = col['hgth']
+		# QV, [g/kg] - water vapour mixing ratio:
+		QV = col['QV']
 
 		# Import 1D fields
 		# press, [hPa]:
-		press = Pressure[i0][j0]/100.
+		press = Pressure/100.
 		# height, [m]:
-		heigth = HGT[i0][j0]
+		heigth = HGT
 		# Calculation of zenith hydrostatic delay (zhd):
 		zhd = (0.0022768*(float(press)))/(1.-0.00266*np.cos(2*(float(z0))*(3.1416/180.))-(0.00028*(float(heigth))/1000.))
-		pblh = PBLH[i0][j0]
+		pblh = PBLH
 		# temp, [C]:
-		temp = T2[i0][j0]-t_kelvin
+		temp = T2-t_kelvin
 		# rain, [mm]:
-		rain = Precipitation[i0][j0]
+		rain = Precipitation
 
 		print('Name: {0} [{1}, {2}, {3}] -> [Temperarture [C]: {4}, Pressure [hPa]: {5}, Rain [mm]: {6}, PBL HEIGHT [m]: {7}, Zenit Heigth Delay [x]: {8}] '
 			.format(station['name'],
@@ -198,164 +279,45 @@ def process_station(db, cur, station, ncfile, date):
 			pblh,
 			zhd))
 
-		# SQL commands that insert values
-		# of parameters in the tables.
-		# If there is a dublicate, the existing fileds
-		# are updated.
+		# The rows are added to the batched writers and
+		# upserted by the caller (flush_writers).
 		# 1D data insertion:
 		# add additionaly wind and 1d mixing ratio
-		cur.execute ( "insert into NWP_IN_1D (Datetime, \
-			Temperature, \
-			Pressure, \
-			Altitude, \
-			SensorID, \
-			Latitude, \
-			Longitude, \
-			ZHD, \
-			PBL, \
-			Precipitation)\
-			values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) on duplicate key update\
-			Temperature = %s,\
-			Pressure = %s,\
-			Altitude = %s,\
-			Latitude = %s,\
-			Longitude = %s,\
-			ZHD = %s,\
-			PBL = %s,\
-			Precipitation = %s", [date,
-			temp,
-			press,
-			heigth,
-			sensorId,
-			y0,
-			x0,
-			zhd,
-			pblh,
-			rain,
-			temp,
-			press,
-			heigth,
-			y0,
-			x0,
-			zhd,
-			pblh,
-			rain])
-	
-		# 3D data insertion:
-		bottom_top = len(T)
-		# First, calculation of tk:
-		# Rd, Cp, Rd_Cp are used for 3D calculation of
-		# tk (absolute temperature [K], and then
-		# it's converted to [C]):
-		Rd  = 287.0
-		Cp  = 7.0 * Rd / 2.0
-		Rd_Cp  = Rd / Cp # dimensionless
-		Rv = 461.51
-		# The following Tm and k1 are used for calculation of ZWD and ZTD later:
-		# Tm, [K] - weighted temperature mean:
-		Tm = 70.2 + 0.72 * T2[i0][j0]
-		k1 = (10**6) / ( Rv*(((3.766 * 10**5)/Tm) + 22.) )
-
-		IWV = 0.
-		for k in range(0, bottom_top):
-			# temperature in [K]:
-			theta = T[k][i0][j0] + 300.
-			# Press3d = Pair/100.0 [hPa]
-			Pair = (P[k][i0][j0] + PB[k][i0][j0])/100.
-			# For tk, (... - t_kelvin) converts T to Celsius.
-			# (100.*Pair) is again in [Pa], because
-			# in the formula for tk in should be in [Pa].
-			tk = theta * ((100.*Pair/100000.)**(Rd_Cp)) - t_kelvin
-			# QV, [g/kg] - water vapour mixing ratio:
-			QV = QVAPOR[k][i0][j0]*1000.
-			# Height, [m]:
-			hgth = (PH[k][i0][j0] + PHB[k][i0][j0])/9.81
-
-			# IWV calculations:
-			# (equations from modelf.m)
-			if k <= 41:
-				# Compute specific humidity q1 and q2 from mixing ratio QVAPOR*1000. in [g/kg]:
-				q1 =  (QVAPOR[k][i0][j0] * 1000.) / ( (QVAPOR[k][i0][j0] * 1000.) + 1. )
-				q2 =  (QVAPOR[k+1][i0][j0] * 1000.) / ( (QVAPOR[k+1][i0][j0] * 1000.) + 1. )
-
-				# Compute water vapour partial pressure with model pressure = (P+PB)/100. in [hPa]:
-				# PP = (P[k][i0][j0]+PB[k][i0][j0])
-				e_k   = ( ((P[k][i0][j0]+PB[k][i0][j0]) / 100.)   * q1 ) / ( 0.622 + ( 0.378 * q1 ))
-				e_kp1 = ( ((P[k+1][i0][j0]+PB[k+1][i0][j0]) / 100.) * q2 ) / ( 0.622 + ( 0.378 * q2 ))
-
-				# Compute water vapour density with T [K]
-				# T is perturbation potential temerature TT=T+300. Total Potential temperature [K]
-				# Model level temrature is computed TT = T * ( ((P+PB)/100000.) ^ (2/7)) [K]
-				# TT = (T[k][i0][j0] + 300.) * (( (P[k][i0][j0]+PB[k][i0][j0])/100000. )**(2./7.))
-				# NB to compute the temerature from potential temprature pressure is in [Pa]
-
-				ro_k   = e_k   / ( Rv * ( (T[k][i0][j0] + 300.) * ( ((P[k][i0][j0]+PB[k][i0][j0])/100000.)**(2./7.) ) ) )
-				ro_kp1 = e_kp1 / ( Rv * ( (T[k+1][i0][j0] + 300.) * ( ((P[k+1][i0][j0]+PB[k+1][i0][j0])/100000.)**(2./7.) ) ) )
+		writers['NWP_IN_1D'].add_dict({'SensorID':sensorId,
+			'Datetime':date,
+			'Temperature':temp,
+			'Pressure':press,
+			'Altitude':heigth,
+			'Latitude':y0,
+			'Longitude':x0,
+			'ZHD':zhd,
+			'PBL':pblh,
+			'Precipitation':rain})
 
-				TT = (T[k][i0][j0] + 300.) * (( (P[k][i0][j0]+PB[k][i0][j0])/100000. )**(2./7.))
-				PP = (P[k][i0][j0]+PB[k][i0][j0])/100.
-				# Model level height is computed using geopotenial H=(PH + PHB)/9.81
-				h_k = (PH[k][i0][j0]+PHB[k][i0][j0])/9.81
-				h_kp1 = (PH[k+1][i0][j0]+PHB[k+1][i0][j0])/9.81
-				delta_height = abs(h_kp1 - h_k)
-
-				# Integrated Water Vapour [kg/m^2]:
-				IWV = IWV + ( ((ro_k+ro_kp1) / 2.)  * delta_height )
-
-			#3D data insert:
-			cur.execute ( "insert into NWP_IN_3D (Datetime, \
-				Temperature, \
-				Pressure, \
-				SensorID, \
-				Latitude, \
-				Longitude, \
-				Height, \
-				WV_Mixing_ratio, \
-				Level)\
-				values (%s, %s, %s, %s, %s, %s, %s, %s, %s) on duplicate key update\
-				Temperature = %s,\
-				Pressure = %s,\
-				Latitude = %s,\
-				Longitude = %s,\
-				Height = %s,\
-				WV_Mixing_ratio = %s,\
-				Level = %s", [date,
-				tk,
-				Pair,
-				sensorId,
-				y0,
-				x0,
-				hgth,
-				QV,
-				k,
+		# 3D data insertion:
+		if levels in ('rows', 'both'):
+			for k in range(len(tk)):
+				writers['NWP_IN_3D'].add((sensorId, date, k, tk[k], Pair[k], y0, x0, hgth[k], QV[k]))
+		# Insert IWV and its products into NWP_OUT table
+		# (one pass over the cumulative IWV, see ingest_files):
+		writers['NWP_OUT'].add_dict({'StationID':stationId,
+			'SourceModID':sourceId,
+			'Datetime':date,
+			'IWV':col['IWV'],
+			'IWV_500_Swiss':col['IWV_500_Swiss'],
+			'IWV_500_Profile':col['IWV_500_Profile'],
+			'IWV_Max_Height':col['IWV_Max_Height']})
+		# Packed 3D data insert (one row for the whole profile):
+		if levels in ('packed', 'both'):
+			writers['packed'].append(profiles.packed_row(sensorId, date, y0, x0,
 				tk,
 				Pair,
-				y0,
-				x0,
 				hgth,
-				QV,
-				k]) # insert or update
-			# Insert IWV into NWP_OUT table:
-			cur.execute ( "insert into NWP_OUT (Datetime, \
-				StationID, \
-				SourceModID, \
-				IWV )\
-				values (%s, %s, %s, %s) on duplicate key update\
-				Datetime = %s,\
-				IWV = %s", [
-                                    date,
-				    stationId,
-                                    sourceId,
-				    IWV,
-                                    date,
-                                    IWV
-                                ])
-		db.commit()
-		# commits all data to the specified -d <env>
+				QV))
 
-	
 	except Exception as e:
 		sys.stderr.write('Error occured in process_station: {error}'.format(error = repr(e)))
+		result = False
 	finally:
 		return result
 
@@ -368,7 +330,7 @@ def process_station(db, cur, station, ncfile, date):
 # procedure process_station that inserts data into the SUADA database.
 # If you change one of these two procedures, 
 # you should also change the other accordingly.
-def process_station_tro(station, ncfile, date):
+def process_station_tro(station, col, date):
 	result = True
 	try:
 		stationName = station['name']
@@ -383,53 +345,53 @@ def process_station_tro(station, ncfile, date):
 
 		# 1D FIELDS:
 		# T2, [K]: temperature on 2m height:
-		T2 = ncfile.variables['T2'][0]
+		T2 = col['T2']
 		# Q2, [kg/kg] - specific humidity (will be inserted in tropo txt format):
-		Q2 = ncfile.variables['Q2'][0]
+		Q2 = col['Q2']
 		# Pressure, [Pa]:
-		Pressure = ncfile.variables['PSFC'][0]
+		Pressure = col['PSFC']
 		# PBLH, [m] - planatary boundary layer height:
-		PBLH = ncfile.variables['PBLH'][0]
+		PBLH = col['PBLH']
 		# HGT, [m] - 1D height above sea level
-		HGT = ncfile.variables['HGT'][0]
+		HGT = col['HGT']
 		# The following 4 fields are in [mm]:
-		RAINNC = ncfile.variables['RAINNC'][0]
-		SNOWNC = ncfile.variables['SNOWNC'][0]
-		GRAUPELNC = ncfile.variables['GRAUPELNC'][0]
-		HAILNC = ncfile.variables['HAILNC'][0]
+		RAINNC = col['RAINNC']
+		SNOWNC = col['SNOWNC']
+		GRAUPELNC = col['GRAUPELNC']
+		HAILNC = col['HAILNC']
 		# Precipitation, [mm]:
 		Precipitation = RAINNC + SNOWNC + GRAUPELNC + HAILNC
 		
 		# 3D FIELDS:
 		# T, [K] - temperature:
-		T = ncfile.variables['T'][0]
+		T = col['T']
 		# P, [Pa] - perturbation pressure:
-		P = ncfile.variables['P'][0]
+		P = col['P']
 		# PB, [Pa] - base state pressure
-		PB = ncfile.variables['PB'][0]
+		PB = col['PB']
 		# PHB, [m] - base state geopotential height:
-		PHB = ncfile.variables['PHB'][0]
+		PHB = col['PHB']
 		# PH, [m] - perturbation geopotential height:
-		PH = ncfile.variables['PH'][0]
+		PH = col['PH']
 		# QVAPOR, [kg/kg] - water vapour mixing ratio:
-		QVAPOR = ncfile.variables['QVAPOR'][0]
+		QVAPOR = col['QVAPOR']
 
 		# Import 1D fields
 		# press, [hPa]:
-		press = Pressure[i0][j0]/100.
+		press = Pressure/100.
 		# height, [m]:
-		heigth = HGT[i0][j0]
+		heigth = HGT
 		# Q2_humi, [g/kg]:
-		Q2_humi = Q2[i0][j0]*1000.
+		Q2_humi = Q2*1000.
 		# Calculation of zhd, [m] - zenith hydrostatic delay
 		zhd = (0.0022768*(float(press)))/(1.-0.00266*np.cos(2*(float(z0))*(3.1416/180.))-(0.00028*(float(heigth))/1000.))
 		
 		# pblh, [m] - planatary boundary layer height:
-		pblh = PBLH[i0][j0]
+		pblh = PBLH
 		# temp, [C]:
-		temp = T2[i0][j0]-t_kelvin
+		temp = T2-t_kelvin
 		# rain, [mm]:
-		rain = Precipitation[i0][j0]
+		rain = Precipitation
 	
 		print('Inserting into TROPOSINEX txt format. Name: {0} [{1}, {2}, {3}] -> [Temperarture [C]: {4}, Pressure [hPa]: {5}, Rain [mm]: {6}, PBL HEIGHT [m]: {7}, Zenit Heigth Delay [x]: {8}, Q2 [kg/kg]: {9}] '
 			.format(station['name'],
@@ -455,7 +417,7 @@ def process_station_tro(station, ncfile, date):
 		Rv = 461.51
 		# The following Tm and k1 are used for calculation of ZWD, ZTD later:
 		# Tm, [K] - weighted temperature mean:
-		Tm = 70.2 + 0.72 * T2[i0][j0]
+		Tm = 70.2 + 0.72 * T2
 		k1 = (10**6) / ( Rv*(((3.766 * 10**5)/Tm) + 22.) )
 
 		IWV = 0.
@@ -475,28 +437,28 @@ def process_station_tro(station, ncfile, date):
 		for k in range(0, bottom_top):
 			if k <= 41:
 				# Compute specific humidity q1 and q2 from mixing ratio QVAPOR*1000. in [g/kg]:
-				q1 =  (QVAPOR[k][i0][j0] * 1000.) / ( (QVAPOR[k][i0][j0] * 1000.) + 1. )
-				q2 =  (QVAPOR[k+1][i0][j0] * 1000.) / ( (QVAPOR[k+1][i0][j0] * 1000.) + 1. )
+				q1 =  (QVAPOR[k] * 1000.) / ( (QVAPOR[k] * 1000.) + 1. )
+				q2 =  (QVAPOR[k+1] * 1000.) / ( (QVAPOR[k+1] * 1000.) + 1. )
 
 				# Compute water vapour partial pressure with model pressure = (P+PB)/100. in [hPa]:
-				# PP = (P[k][i0][j0]+PB[k][i0][j0])
-				e_k   = ( ((P[k][i0][j0]+PB[k][i0][j0]) / 100.)   * q1 ) / ( 0.622 + ( 0.378 * q1 ))
-				e_kp1 = ( ((P[k+1][i0][j0]+PB[k+1][i0][j0]) / 100.) * q2 ) / ( 0.622 + ( 0.378 * q2 ))
+				# PP = (P[k]+PB[k])
+				e_k   = ( ((P[k]+PB[k]) / 100.)   * q1 ) / ( 0.622 + ( 0.378 * q1 ))
+				e_kp1 = ( ((P[k+1]+PB[k+1]) / 100.) * q2 ) / ( 0.622 + ( 0.378 * q2 ))
 
 				# Compute water vapour density with T [K]
 				# T is perturbation potential temerature TT=T+300. Total Potential temperature [K]
 				# Model level temrature is computed TT = T * ( ((P+PB)/100000.) ^ (2/7)) [K]
-				# TT = (T[k][i0][j0] + 300.) * (( (P[k][i0][j0]+PB[k][i0][j0])/100000. )**(2./7.))
+				# TT = (T[k] + 300.) * (( (P[k]+PB[k])/100000. )**(2./7.))
 				# NB to compute the temerature from potential temprature pressure is in [Pa]
 
-				ro_k   = e_k   / ( Rv * ( (T[k][i0][j0] + 300.) * ( ((P[k][i0][j0]+PB[k][i0][j0])/100000.)**(2./7.) ) ) )
-				ro_kp1 = e_kp1 / ( Rv * ( (T[k+1][i0][j0] + 300.) * ( ((P[k+1][i0][j0]+PB[k+1][i0][j0])/100000.)**(2./7.) ) ) )
+				ro_k   = e_k   / ( Rv * ( (T[k] + 300.) * ( ((P[k]+PB[k])/100000.)**(2./7.) ) ) )
+				ro_kp1 = e_kp1 / ( Rv * ( (T[k+1] + 300.) * ( ((P[k+1]+PB[k+1])/100000.)**(2./7.) ) ) )
 
-				TT = (T[k][i0][j0] + 300.) * (( (P[k][i0][j0]+PB[k][i0][j0])/100000. )**(2./7.))
-				PP = (P[k][i0][j0]+PB[k][i0][j0])/100.
+				TT = (T[k] + 300.) * (( (P[k]+PB[k])/100000. )**(2./7.))
+				PP = (P[k]+PB[k])/100.
 				# Model level height is computed using geopotenial H=(PH + PHB)/9.81
-				h_k = (PH[k][i0][j0]+PHB[k][i0][j0])/9.81
-				h_kp1 = (PH[k+1][i0][j0]+PHB[k+1][i0][j0])/9.81
+				h_k = (PH[k]+PHB[k])/9.81
+				h_kp1 = (PH[k+1]+PHB[k+1])/9.81
 				delta_height = abs(h_kp1 - h_k)
 
 				# Integrated Water Vapour [kg/m^2]:
@@ -540,25 +502,20 @@ def process_station_tro(station, ncfile, date):
 		return result
 
 
-# Define a procedure that exports the accumulated data
-# from the process_station_tro procedure into
-# TROPOSINEX txt format:
-# ( SINEX_TRO - Solution INdependent EXchange format for
-# TROpospheric and meteorological parameters. )
-def tropo_out(station_data):
-	result = True
-	try:
-		# Insert values of parameters in txt format:
-		# Generating filename as required TROPOSINEX format:
-		for station in station_data:
-			YYYY_st = station['YYYY_st']
-			DOY_st = station['DOY_st']
-			HH_st = station['HH_st']
-			MM_st = station['MM_st']
-			filename = 'SUG1_UNK_UNK_'+YYYY_st+DOY_st+HH_st+MM_st+'_00U_00U.TRO'
-		# Inserting data into the TROPOSINEX format:
-		with open(filename, 'w') as troposinex:
-			troposinex.write('%=TRO \
+# Define a procedure that returns the TROPOSINEX file name
+# for an epoch (the strings of process_station_tro). period is
+# the period of the file: '00U' (one epoch) or '01D' (one day):
+def tro_filename(YYYY_st, DOY_st, HH_st, MM_st, period='00U'):
+	return 'SUG1_UNK_UNK_'+YYYY_st+DOY_st+HH_st+MM_st+'_'+period+'_00U.TRO'
+
+
+# Define the procedures that write the parts of a TROPOSINEX
+# file: the header up to the SITE/ID lines, one SITE/ID line,
+# the blocks up to the TROP/SOLUTION lines, one TROP/SOLUTION
+# line and the end of the file. station is a dictionary
+# returned by process_station_tro:
+def tro_write_header(troposinex):
+	troposinex.write('%=TRO \
 \n\
 \n*---------------------------------------------------------------------------- \
 \n+FILE/REFERENCE \
@@ -588,15 +545,20 @@ def tropo_out(station_data):
 \n+SITE/ID \
 \n*STATION__ _LONGITUDE _LATITUDE_ _HGT_MSL_ \
 ')
-			for station in station_data:
-				troposinex.write('\n{name:12s} {longit:>5.6f} {latt:>5.6f} {alt:>5.6f}'
-					.format(
-					name     = station['station_name'][:12],
-					longit   = station['long'],
-					latt     = station['latt'],
-					alt      = station['alt']
-				))
-			troposinex.write(' \n \
+
+
+def tro_write_site(troposinex, station):
+	troposinex.write('\n{name:12s} {longit:>5.6f} {latt:>5.6f} {alt:>5.6f}'
+		.format(
+		name     = station['station_name'][:12],
+		longit   = station['long'],
+		latt     = station['latt'],
+		alt      = station['alt']
+	))
+
+
+def tro_write_solution_header(troposinex):
+	troposinex.write(' \n \
 \n-SITE/ID \
 \n\
 \n*---------------------------------------------------------------------------- \
@@ -609,6 +571,8 @@ def tropo_out(station_data):
 \n+TROP/SOLUTION \
 \n*STATION__ ____EPOCH___ IWV PRESS HUMSPC TEMPDRY WMTEMP TRODRY TROTOT TROWET \
 ')
+
+
 # FIELD NAMES:
 # Station = station name
 # Epoch   = timestamp YY:DDD:SSSSS
@@ -620,27 +584,53 @@ def tropo_out(station_data):
 # TRODRY  = zhd_mm, [mm]
 # TROTOT  = ZTD_mm, [mm]
 # TROWET  = ZWD_mm, [mm]
-			for station in station_data:
-				troposinex.write('\n {name:9s} {epoch:12s} {IWV:>5.2f} {press:>5.2f} {humi_spc:>5.3f} {temp:>5.1f} {Tm:>5.1f} {TRODRY:>5.1f} {TROTOT:>5.1f} {TROWET:>5.1f}'
-					.format(
-					name     = station['station_name'][:9],
-					epoch    = station['YYYY_st']+':'+station['DOY_st']+':'+station['SSSSS_st'],
-					IWV      = station['IWV'],
-					press    = station['press'],
-					humi_spc = station['Q2_humi'],
-					temp     = station['temp']+t_kelvin,
-					Tm       = station['Tm'],
-					TRODRY   = station['zhd_mm'],
-					TROTOT   = station['ZTD_mm'],
-					TROWET   = station['ZWD_mm']
-				))
-			troposinex.write(' \n \
+def tro_write_solution(troposinex, station):
+	troposinex.write('\n {name:9s} {epoch:12s} {IWV:>5.2f} {press:>5.2f} {humi_spc:>5.3f} {temp:>5.1f} {Tm:>5.1f} {TRODRY:>5.1f} {TROTOT:>5.1f} {TROWET:>5.1f}'
+		.format(
+		name     = station['station_name'][:9],
+		epoch    = station['YYYY_st']+':'+station['DOY_st']+':'+station['SSSSS_st'],
+		IWV      = station['IWV'],
+		press    = station['press'],
+		humi_spc = station['Q2_humi'],
+		temp     = station['temp']+t_kelvin,
+		Tm       = station['Tm'],
+		TRODRY   = station['zhd_mm'],
+		TROTOT   = station['ZTD_mm'],
+		TROWET   = station['ZWD_mm']
+	))
+
+
+def tro_write_footer(troposinex):
+	troposinex.write(' \n \
 \n-TROP/SOLUTION \
 \n\
 \n%=ENDTRO \
 \n\
 ')
-			troposinex.close()
+
+
+# Define a procedure that exports the accumulated data
+# from the process_station_tro procedure into
+# TROPOSINEX txt format:
+# ( SINEX_TRO - Solution INdependent EXchange format for
+# TROpospheric and meteorological parameters. )
+# Without filename the file is named after the (last) epoch.
+def tropo_out(station_data, filename=None):
+	result = True
+	try:
+		# Generating filename as required TROPOSINEX format:
+		if filename is None:
+			for station in station_data:
+				filename = tro_filename(station['YYYY_st'], station['DOY_st'], station['HH_st'], station['MM_st'])
+		# Inserting data into the TROPOSINEX format:
+		with open(filename, 'w') as troposinex:
+			tro_write_header(troposinex)
+			for station in station_data:
+				tro_write_site(troposinex, station)
+			tro_write_solution_header(troposinex)
+			for station in station_data:
+				tro_write_solution(troposinex, station)
+			tro_write_footer(troposinex)
 
 	except Exception as e:
 		sys.stderr.write('Error occured in tropo_out: {error}'.format(error = repr(e)))
@@ -650,6 +640,261 @@ def tropo_out(station_data):
 
 
 
+# Define a procedure that creates the batched writers
+# used by process_station (with a dbwriter.WriterPool: one
+# writer thread and connection per table). With skip_unchanged
+# the writers also collect the block hashes (see blockhash.py):
+def new_writers(cur, spool=None, pool=None, skip_unchanged=False):
+	if pool is not None:
+		writers = {
+			'NWP_IN_1D' : dbwriter.PoolWriter(pool, 'NWP_IN_1D'),
+			'NWP_IN_3D' : dbwriter.PoolWriter(pool, 'NWP_IN_3D'),
+			'NWP_OUT'   : dbwriter.PoolWriter(pool, 'NWP_OUT'),
+			'packed'    : [],
+			'pool'      : pool
+			}
+	elif spool is not None:
+		writers = {
+			'NWP_IN_1D' : SpoolWriter(spool, 'NWP_IN_1D'),
+			'NWP_IN_3D' : SpoolWriter(spool, 'NWP_IN_3D'),
+			'NWP_OUT'   : SpoolWriter(spool, 'NWP_OUT'),
+			'packed'    : [],
+			'spool'     : spool
+			}
+	else:
+		writers = {
+			'NWP_IN_1D' : dbwriter.BatchWriter(cur, 'NWP_IN_1D'),
+			'NWP_IN_3D' : dbwriter.BatchWriter(cur, 'NWP_IN_3D'),
+			'NWP_OUT'   : dbwriter.BatchWriter(cur, 'NWP_OUT'),
+			'packed'    : []
+			}
+	if skip_unchanged:
+		writers['hashes'] = []
+	return writers
+
+
+# Define a procedure that sends the rows waiting
+# in the writers and commits them (with a spool:
+# appends them to the spool and syncs it; with a pool:
+# waits until every table writer has committed).
+# The block hashes are written after the rows (in the
+# same transaction without a pool):
+def flush_writers(db, cur, writers):
+	result = True
+	hashes = writers.get('hashes', [])
+	try:
+		writers['NWP_IN_1D'].flush()
+		writers['NWP_IN_3D'].flush()
+		writers['NWP_OUT'].flush()
+		if 'pool' in writers:
+			writers['pool'].append('NWP_IN_3D_PACKED', writers['packed'])
+			errors = writers['pool'].barrier().wait()
+			if not len(errors) and len(hashes):
+				writers['pool'].append('INGEST_HASH', hashes)
+				errors = writers['pool'].barrier().wait()
+			for table in sorted(errors):
+				sys.stderr.write('Error occured in the writer of {table}: {error}\n'.format(table = table, error = errors[table]))
+			result = not len(errors)
+		elif 'spool' in writers:
+			writers['spool'].append('NWP_IN_3D_PACKED', writers['packed'])
+			writers['spool'].append('INGEST_HASH', hashes)
+			writers['spool'].sync()
+		else:
+			profiles.write_packed_profiles(cur, writers['packed'])
+			if len(hashes):
+				columns_hash, keys_hash = dbwriter.tables['INGEST_HASH']
+				dbwriter.upsert_many(cur, 'INGEST_HASH', columns_hash, keys_hash, hashes)
+			db.commit()
+	except Exception as e:
+		db.rollback()
+		sys.stderr.write('Error occured in flush_writers: {error}\n'.format(error = repr(e)))
+		result = False
+	finally:
+		for table in ('NWP_IN_1D', 'NWP_IN_3D', 'NWP_OUT'):
+			writers[table].rows = []
+		writers['packed'] = []
+		if 'hashes' in writers:
+			writers['hashes'] = []
+	return result
+
+
+# Define a procedure that processes the model files in flist
+# (or their cache entries with from_cache, or dictionaries
+# domain -> file of nested domains, see domains.group_files)
+# for the stations and writes the output (db or tro). The DB connection,
+# the stations and the grid indices (grids, a dictionary kept
+# by the caller) are reused, so that a long-running process
+# (ingestd.py) pays for them only once. The db rows go through
+# batched writers (new_writers, or the writers of the caller)
+# that are sent and committed after every file. The files that are
+# written completely (no failed station) are appended to done (if given).
+# Returns the number of processed files:
+def ingest_files(db, cur, flist, stations, source_id, country='All', output='db', levels='rows', cachedir='', cache_size=colcache.default_size, from_cache=False, grids=None, writers=None, done=None):
+	stations_by_id = dict((station['id'], station) for station in stations)
+	if from_cache:
+		flist = colcache.replay_entries(flist, stations, country)
+	if writers is None and output == 'db':
+		writers = new_writers(cur)
+	processed = 0
+	for file in flist:
+		field2D = []
+		print 'Processing: ', file
+
+		# Take the station columns from the cache entry
+		# or read them from the file (and add them to the cache).
+		# A dictionary domain -> file is a group of nested
+		# domains with the same valid time:
+		entry = None
+		if isinstance(file, dict):
+			entry = domains.extract_domains(file, stations, grids)
+		elif from_cache:
+			entry = colcache.load(file)
+		elif cachedir:
+			entry = colcache.lookup(cachedir, file, stations, country)
+		if entry is None and not from_cache and not isinstance(file, dict):
+			ncfile = ncreader.open_dataset(file)
+			entry = colcache.extract(ncfile, file, stations, grids)
+			ncfile.close()
+			if cachedir:
+				colcache.store(cachedir, file, stations, country, entry, cache_size)
+		if entry is None:
+			print 'Error: Can not read the cache entry ', file
+			continue
+
+		strDateTime = entry['time'].replace('_', ' ')
+		local_tz = get_localzone()
+		date = parser.parse(strDateTime)
+		strDateTimeLocal = local_tz.localize(date)
+		# Print the timestamp
+		print('Dataset timestamp: {}'.format(strDateTimeLocal))
+
+		# Record the domain of every station:
+		if 'domain' in entry and output == 'db':
+			sensors = dict((station['id'], station['senid']) for station in stations)
+			if 'spool' in writers:
+				writers['spool'].append('NWP_IN_DOMAIN', domains.domain_rows(entry, sensors, date))
+			elif 'pool' in writers:
+				writers['pool'].append('NWP_IN_DOMAIN', domains.domain_rows(entry, sensors, date))
+			else:
+				domains.write_domains(cur, entry, sensors, date)
+				db.commit()
+
+		# Columns of the fields [station] or [station, level]:
+		col = dict((name, entry[name]) for name in columns.fields_1d + columns.fields_3d if name in entry)
+
+		# Level values and IWV of all stations in one pass
+		# (see kernels.profile_physics), and the partial column
+		# IWV products from the cumulative IWV (see columns.iwv_products):
+		if output == 'db' and len(entry['id']):
+			prof = kernels.profile_physics(col['T'], col['P'], col['PB'], col['PH'], col['PHB'], col['QVAPOR'])
+			for name in ('tk', 'Pair', 'hgth', 'QV'):
+				col[name] = prof[name]
+			products = columns.iwv_products(prof)
+			for name in ('IWV', 'IWV_500_Swiss', 'IWV_500_Profile', 'IWV_Max_Height'):
+				col[name] = products[name]
+
+		# The block hashes of the last run (see blockhash.py):
+		stored_hashes = None
+		skipped = 0
+		if output == 'db' and 'hashes' in writers:
+			try:
+				stored_hashes = blockhash.load(cur, source_id, date)
+			except Exception as e:
+				# Without the stored hashes all blocks are sent
+				# (e.g. with --spool while the database is down):
+				sys.stderr.write('Error occured in blockhash.load: {error}\n'.format(error = repr(e)))
+				stored_hashes = {}
+
+		# Empty list to contain data:
+		station_data = []
+		# Stations whose rows may be incomplete:
+		failed = 0
+		for n, stationId in enumerate(entry['id']):
+			if not stationId in stations_by_id:
+				continue
+			station = stations_by_id[stationId]
+			stationName = station['name']
+			stationId = station['id']
+			sensorId = station['senid']
+			print 'Station: ', station['name'], ' ID: ', station['id'], ' sensorId: ', sensorId, 'Country Code: ', station['country']
+			station['i0'] = entry['i0'][n]
+			station['j0'] = entry['j0'][n]
+			station['source_id'] = source_id
+			if 'domain' in entry:
+				print 'Domain: ', entry['domain'][n]
+			station_col = dict((name, values[n]) for name, values in col.items())
+
+			if output == 'db' and stored_hashes is not None:
+				# Only the blocks that differ from the last run:
+				block = blockhash.new_block()
+				block_ok = process_station(station, station_col, date, block, levels)
+				if not block_ok:
+					failed += 1
+				block_hash = blockhash.digest(block)
+				if block_ok and stored_hashes.get(sensorId) == block_hash:
+					skipped += 1
+					continue
+				blockhash.forward(block, writers)
+				if block_ok:
+					writers['hashes'].append((source_id, sensorId, date, block_hash))
+			elif output == 'db':
+				if not process_station(station, station_col, date, writers, levels):
+					failed += 1
+			elif output == 'tro':
+				# save result in
+				# tropo_station_data
+				tropo_station_data = process_station_tro(station, station_col, date)
+				# if tropo_station_data is
+				# not None,
+				# append to data list
+				if tropo_station_data:
+					station_data.append(tropo_station_data.copy())
+		if skipped:
+			print('{} stations unchanged since the last run'.format(skipped))
+		written = True
+		if output == 'db':
+			written = flush_writers(db, cur, writers)
+		if output == 'tro' and len(station_data)>0:
+			written = tropo_out(station_data)
+		if failed:
+			# The file is not complete in the database:
+			print('Error: {} stations of {} failed'.format(failed, file))
+			written = False
+		if written and done is not None:
+			done.append(file)
+		processed += 1
+	return processed
+
+
+# Define a procedure that processes several sources in one run.
+# sources is a list of (source_name, basedir, prefix). The source ids
+# and the stations of all sources are selected with one query each,
+# the grid indices are shared by the sources (sources on the same
+# domain locate their stations only once) and all rows go through
+# one set of batched writers. Returns the number of processed files:
+def ingest_sources(db, cur, sources, country='All', output='db', levels='rows', cachedir='', cache_size=colcache.default_size, domain_list=[], instrument_name='GNSS', spool=None, pool=None, skip_unchanged=False):
+	names = [source[0] for source in sources]
+	source_ids = suadadb.get_source_ids(cur, names)
+	stations = getstations_sources(cur, names, country, instrument_name)
+	grids = {}
+	writers = None
+	if output == 'db':
+		writers = new_writers(cur, spool, pool, skip_unchanged)
+	processed = 0
+	for source_name, basedir, prefix in sources:
+		if not source_name in source_ids:
+			print 'Error: Can not find source_id for source_name: {}'.format(source_name)
+			continue
+		source_stations = [station for station in stations[source_name] if (country == 'All') or (country == station['country'])]
+		if len(domain_list):
+			flist = domains.group_files(basedir, prefix, domain_list)
+		else:
+			flist = listfiles(basedir, prefix)
+		print('Source: {} (id {}), {} stations, {} files'.format(source_name, source_ids[source_name], len(source_stations), len(flist)))
+		processed += ingest_files(db, cur, flist, source_stations, source_ids[source_name], country, output, levels, cachedir, cache_size, False, grids, writers)
+	return processed
+
+
 # Define the main procedure that checks whether the command
 # that the user typed in the terminal is correct; then it has to
 # create a db connection; to fetch source_id by calling
@@ -682,6 +927,29 @@ def main(argv):
 	# WRF model is going to be stored.
 	# -o <output> - either insert data into database or
 	# export it to txt fomrat.
+	# -l <levels> - where to store the 3D profiles with -o db:
+	# 'rows' (NWP_IN_3D), 'packed' (NWP_IN_3D_PACKED) or 'both'.
+	# -k <cachedir> - keep the station columns of every file
+	# in a cache (see colcache.py), --cache-size <MB> bounds it.
+	# --from-cache - compute the outputs from the cache
+	# entries of the files with [prefix] instead of the files.
+	# -a <source_name>:<basedir>:<prefix> - several sources
+	# in one run (repeat -a for every source; an empty basedir
+	# or prefix means -b <basedir> / -p <prefix>), instead of -s.
+	# -m <domains> - nested domains processed together
+	# (e.g. d01,d02,d03): every station is taken from the finest
+	# domain that contains it (see domains.py).
+	# --spool <spooldir> - append the rows to a local spool
+	# instead of the database; spool.py sends them (see spool.py).
+	# --table-writers - write every table from its own thread and
+	# connection (see dbwriter.WriterPool).
+	# --skip-unchanged - do not send the rows of the stations and
+	# epochs whose hash equals the last run (see blockhash.py).
+	# --shard <i>/<n> - ingest only the i-th of n parts of the
+	# files (--shard sge: the task of an SGE job array), and
+	# --manifest <dir> - record the files of the part (see shards.py).
+	# --backfill-stations - ingest only the stations that have
+	# no model rows in the period of the files (new stations).
 	basedir='./'
 	prefix='wrfout_d02'
 	source_name = ''
@@ -691,16 +959,29 @@ def main(argv):
 	output = 'db' # By default: 'db'.
 	# Possible options: 'db' (write to SUADA db),
 	# 'tro' (write to troposinex txt format).
+	levels = 'rows' # By default: 'rows'.
+	# Possible options: 'rows', 'packed', 'both'.
+	cachedir = '' # By default: no cache.
+	cache_size = colcache.default_size
+	from_cache = False
+	domain_list = [] # By default: only the files with [prefix].
+	source_args = [] # By default: only -s <source_name>.
+	spooldir = '' # By default: write to the database.
+	table_writers = False # By default: one connection for all tables.
+	skip_unchanged = False # By default: send all rows.
+	shard = None # By default: all files.
+	manifestdir = ''
+	backfill = False
 	instrument_name = 'GNSS'
 
 	try:
-		opts, args = getopt.getopt(argv,"h:b:p:s:c:d:o:",["basedir=","prefix=","source_name=","country=","env=","output="])
+		opts, args = getopt.getopt(argv,"h:b:p:s:c:d:o:l:k:m:a:",["basedir=","prefix=","source_name=","country=","env=","output=","levels=","cache=","cache-size=","from-cache","domains=","source=","spool=","shard=","manifest=","backfill-stations","table-writers","skip-unchanged"])
 	except getopt.GetoptError:
-		print 'ncdf2db.py -b <basedir> ['+basedir+'] -p <prefix> ['+prefix+'] -s <source_name> ['+str(source_name)+'] -c <country> ['+str(country)+'] -d <env> ['+str(env)+'] -o <output> ['+str(output)+']'
+		print 'ncdf2db.py -b <basedir> ['+basedir+'] -p <prefix> ['+prefix+'] -s <source_name> ['+str(source_name)+'] -c <country> ['+str(country)+'] -d <env> ['+str(env)+'] -o <output> ['+str(output)+'] -l <levels> ['+str(levels)+'] -k <cachedir> --cache-size <MB> ['+str(cache_size)+'] --from-cache -m <domains> -a <source_name>:<basedir>:<prefix> --spool <spooldir> --shard <i>/<n> --manifest <dir> --backfill-stations --table-writers --skip-unchanged'
 		sys.exit(2)
 	for opt, arg in opts:
 		if opt == '-h':
-			print 'ncdf2db.py -b <basedir> ['+basedir+'] -p <prefix> ['+prefix+'] -s <source_name> ['+str(source_name)+'] -c <country> ['+str(country)+'] -d <env> ['+str(env)+'] -o <output> ['+str(output)+']'
+			print 'ncdf2db.py -b <basedir> ['+basedir+'] -p <prefix> ['+prefix+'] -s <source_name> ['+str(source_name)+'] -c <country> ['+str(country)+'] -d <env> ['+str(env)+'] -o <output> ['+str(output)+'] -l <levels> ['+str(levels)+'] -k <cachedir> --cache-size <MB> ['+str(cache_size)+'] --from-cache -m <domains> -a <source_name>:<basedir>:<prefix> --spool <spooldir> --shard <i>/<n> --manifest <dir> --backfill-stations --table-writers --skip-unchanged'
 			sys.exit()
 		elif opt in ("-b", "--basedir"):
 			basedir = arg
@@ -717,13 +998,60 @@ def main(argv):
 			env = str(arg)
 		elif opt in ("-o", "--output"):
 			output = str(arg)
+		elif opt in ("-l", "--levels"):
+			levels = str(arg)
+		elif opt in ("-k", "--cache"):
+			cachedir = str(arg)
+		elif opt == "--cache-size":
+			cache_size = float(arg)
+		elif opt == "--from-cache":
+			from_cache = True
+		elif opt in ("-m", "--domains"):
+			domain_list = [domain for domain in str(arg).split(',') if domain]
+		elif opt in ("-a", "--source"):
+			source_args.append(str(arg))
+		elif opt == "--spool":
+			spooldir = str(arg)
+		elif opt == "--table-writers":
+			table_writers = True
+		elif opt == "--skip-unchanged":
+			skip_unchanged = True
+		elif opt == "--shard":
+			try:
+				shard = shards.parse_shard(str(arg))
+			except ValueError as e:
+				print 'Error: {}'.format(e)
+				sys.exit(2)
+		elif opt == "--manifest":
+			manifestdir = str(arg)
+		elif opt == "--backfill-stations":
+			backfill = True
+
+	# Sources given with -a <source_name>:<basedir>:<prefix>:
+	sources = []
+	for source_arg in source_args:
+		values = (source_arg.split(':', 2) + ['', ''])[:3]
+		sources.append((values[0], values[1] or basedir, values[2] or prefix))
 
 	# Check whether the user has specified source name.
 	# If not -> Error.
-	if source_name == '':
+	if source_name == '' and not len(sources):
 		print 'Error: You must specify the source name! (-s <source_name>)'
 		sys.exit()
 
+	if source_name != '' and len(sources):
+		print 'Error: Use either -s <source_name> or -a <source_name>:<basedir>:<prefix>'
+		sys.exit()
+
+	# The TROPOSINEX file names do not depend on the source:
+	if len(sources) > 1 and output == 'tro':
+		print 'Error: -o tro takes one source at a time'
+		sys.exit()
+
+	if len(sources) and from_cache:
+		print 'Error: --from-cache can not be combined with -a <source_name>:<basedir>:<prefix>'
+		sys.exit()
+
 	# Check whether the user has specified the database.
 	# If not -> Error.
 	if env == '':
@@ -734,9 +1062,56 @@ def main(argv):
 		print ('Error: Not a possible output {}'.format(output))
 		sys.exit()
 
+	if not levels in profiles.level_layouts:
+		print ('Error: Not a possible levels layout {}'.format(levels))
+		sys.exit()
+
+	if from_cache and len(domain_list):
+		print 'Error: --from-cache can not be combined with -m <domains>'
+		sys.exit()
+
+	if len(sources) and (shard is not None or manifestdir):
+		print 'Error: --shard and --manifest take one source at a time'
+		sys.exit()
+
+	if backfill and (len(sources) or output != 'db'):
+		print 'Error: --backfill-stations takes one source (-s <source_name>) and -o db'
+		sys.exit()
+
+	if spooldir and output != 'db':
+		print 'Error: --spool <spooldir> is only used with -o db'
+		sys.exit()
+
+	if table_writers and (output != 'db' or spooldir):
+		print 'Error: --table-writers is only used with -o db and without --spool'
+		sys.exit()
+
+	if skip_unchanged and output != 'db':
+		print 'Error: --skip-unchanged is only used with -o db'
+		sys.exit()
+
+	if from_cache and cachedir == '':
+		print 'Error: You must specify the cache with --from-cache! (-k <cachedir>)'
+		sys.exit()
+
 	# Retrieve the list of all data files
 	# starting with [prefix] inside [basedir] folder
-	flist = listfiles(basedir, prefix)
+	# (or the list of their cache entries):
+	if from_cache:
+		flist = colcache.entries(cachedir, prefix)
+	elif len(domain_list):
+		flist = domains.group_files(basedir, prefix, domain_list)
+	else:
+		flist = listfiles(basedir, prefix)
+	catalog = flist
+
+	# Only the files of this shard:
+	if shard is None:
+		shard = (1, 1)
+	else:
+		flist = shards.plan(catalog, shard[0], shard[1])
+		print('Shard {}/{}: {} of {} files'.format(shard[0], shard[1], len(flist), len(catalog)))
+	started = time.time()
 
 	# Create the DB connection:
 	db = None
@@ -763,6 +1138,29 @@ def main(argv):
 		cur.close()
 		sys.exit(1)
 
+	# The rows go to the spool instead of the database:
+	spool = None
+	if spooldir:
+		spool = Spool(spooldir)
+		print('Spool -> {}'.format(spool.path))
+
+	# A writer thread and connection per table:
+	pool = None
+	if table_writers:
+		pool = dbwriter.WriterPool(lambda: suadadb.connect(env))
+
+	# Several sources in one run:
+	if len(sources):
+		processed = ingest_sources(db, cur, sources, country, output, levels, cachedir, cache_size, domain_list, instrument_name, spool, pool, skip_unchanged)
+		if spool is not None:
+			spool.close()
+		if pool is not None:
+			pool.close()
+		if not processed:
+			print 'No candidates for import files found ...'
+			sys.exit(1)
+		return
+
 	# Fetching source_id...
 	print('Trying to fetch the source_id ...')
 	source_id = get_source_id(cur, source_name)
@@ -777,67 +1175,36 @@ def main(argv):
 	print('Get stations')
 	stations = getstations(cur, source_name, country, instrument_name)
 
+	# Keep the stations of the selected country:
+	stations = [station for station in stations if (country == 'All') or (country == station['country'])]
+
+	# Keep the stations without model rows in the period of the files:
+	if backfill:
+		date_from, date_to = file_period(flist)
+		if date_from is None:
+			print 'Error: No valid times in the file names for --backfill-stations'
+			sys.exit(1)
+		stations = stations_without_rows(cur, stations, source_id, date_from, date_to)
+		print('Backfill {} - {}: {} stations without model rows {}'.format(date_from, date_to, len(stations), ' '.join(station['name'] for station in stations)))
+		if not len(stations):
+			print 'Nothing to backfill'
+			return
+
 	# Now iterating over list of all data files:
 	print('Iterate files')
-
-	for file in flist:
-		field2D = []
-		print 'Processing: ', file
-		ncfile = netcdf(file)
-		strDateTime = ncfile.variables['Times'][0].tostring().replace('_', ' ')
-		local_tz = get_localzone()
-		date = parser.parse(strDateTime)
-		strDateTimeLocal = local_tz.localize(date)
-		# Print the timestamp
-		print('Dataset timestamp: {}'.format(strDateTimeLocal))
-		xlong = ncfile.variables['XLONG'][0]
-		xlat = ncfile.variables['XLAT'][0]
-		alt = ncfile.variables['HGT'][0]
-		truelat1 = ncfile.TRUELAT1
-		truelat2 = ncfile.TRUELAT2
-		ref_lat  = ncfile.CEN_LAT
-		ref_lon  = ncfile.CEN_LON
-		stand_lon= ncfile.STAND_LON
-		dx = ncfile.DX
-		dy = ncfile.DY
-		west_east = ncfile.dimensions['west_east'].size
-		south_north = ncfile.dimensions['south_north'].size
-
-
-		# Empty list to contain data:
-		station_data = []
-		for station in stations:
-			stationName = station['name']
-			stationId = station['id']
-			sensorId = station['senid']
-			print 'Station: ', station['name'], ' ID: ', station['id'], ' sensorId: ', sensorId, 'Country Code: ', station['country']
-			x0 = station['long']
-			y0 = station['latt']
-			z0 = station['alt']
-			indx = wrf.ll_to_ij(1, truelat1, truelat2, stand_lon, dx, dy, ref_lat, ref_lon, y0, x0)
-			j0 = west_east / 2 + indx[0] - 1
-			i0 = south_north / 2 + indx[1] - 1
-			station['i0'] = i0
-			station['j0'] = j0
-                        station['source_id'] = source_id
-
-
-			if (i0 >= 0 and i0 < south_north) and ( j0 >= 0 and j0 < west_east) and ( (country == 'All') or (country == station['country'])):
-				if output == 'db':
-					process_station(db, cur, station, ncfile, date)
-				elif output == 'tro':
-					# save result in
-					# tropo_station_data
-					tropo_station_data = process_station_tro(station, ncfile, date)
-					# if tropo_station_data is
-					# not None,
-					# append to data list
-					if tropo_station_data:
-						station_data.append(tropo_station_data.copy())
-		if output == 'tro' and len(station_data)>0:
-			tropo_out(station_data)
-
-	if not(len(flist)):
+	writers = None
+	if spool is not None or pool is not None or skip_unchanged:
+		writers = new_writers(cur, spool, pool, skip_unchanged)
+	done = []
+	ingest_files(db, cur, flist, stations, source_id, country, output, levels, cachedir, cache_size, from_cache, None, writers, done)
+	if spool is not None:
+		spool.close()
+	if pool is not None:
+		pool.close()
+	if manifestdir:
+		print('Manifest -> {}'.format(shards.write_manifest(manifestdir, shard[0], shard[1], flist, done, started)))
+
+	if not(len(catalog)):
 		print 'No candidates for import files found ...'
 		sys.exit(1)
 
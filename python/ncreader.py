@@ -0,0 +1,226 @@
+# ncreader.py
+# Zero-copy reader for netCDF-3 classic and 64-bit offset files.
+#
+# For the classic formats the header is parsed once and the file is
+# mapped into memory with mmap. Every variable is exposed as a numpy
+# array view on the mapped file (big-endian dtype, strided through the
+# records for record variables): no data is copied and no masked
+# arrays are built, so taking the station columns of a field touches
+# only the pages that hold them.
+#
+# Other files (netCDF-4/HDF5) are opened with netCDF4.Dataset.
+#
+# The returned objects can be used in place of netCDF4.Dataset for
+# what ncdf2db.py needs: ncfile.variables[name][t], ncfile.dimensions[name].size,
+# global attributes (ncfile.TRUELAT1, ...) and ncfile.close().
+
+import mmap
+import struct
+import numpy as np
+
+
+# netCDF-3 header tags and types:
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+STREAMING = 0xFFFFFFFF
+
+nc_types = {
+	1  : 'i1',
+	2  : 'S1',
+	3  : '>i2',
+	4  : '>i4',
+	5  : '>f4',
+	6  : '>f8',
+	7  : 'u1',
+	8  : '>u2',
+	9  : '>u4',
+	10 : '>i8',
+	11 : '>u8'
+	}
+
+
+# A dimension of a classic file (same .size as netCDF4.Dimension):
+class Dimension(object):
+
+	def __init__(self, name, size, unlimited):
+		self.name = name
+		self.size = size
+		self.unlimited = unlimited
+
+	def __len__(self):
+		return self.size
+
+	def isunlimited(self):
+		return self.unlimited
+
+
+# Header parser of the classic (version 1), 64-bit offset (2)
+# and 64-bit data (5) formats:
+class _Header(object):
+
+	def __init__(self, data, version):
+		self.data = data
+		self.pos = 4
+		self.version = version
+
+	def int32(self):
+		value = struct.unpack('>i', self.data[self.pos:self.pos + 4])[0]
+		self.pos += 4
+		return value
+
+	def uint32(self):
+		value = struct.unpack('>I', self.data[self.pos:self.pos + 4])[0]
+		self.pos += 4
+		return value
+
+	def int64(self):
+		value = struct.unpack('>q', self.data[self.pos:self.pos + 8])[0]
+		self.pos += 8
+		return value
+
+	# Counts are 64-bit in the version 5 format:
+	def count(self):
+		if self.version == 5:
+			return self.int64()
+		return self.uint32()
+
+	# Offsets are 64-bit in the version 2 and 5 formats:
+	def offset(self):
+		if self.version in (2, 5):
+			return self.int64()
+		return self.uint32()
+
+	def padded(self, size):
+		value = self.data[self.pos:self.pos + size]
+		self.pos += (size + 3) // 4 * 4
+		return value
+
+	def name(self):
+		return self.padded(self.count()).decode('utf-8')
+
+	# ABSENT lists are two zero words:
+	def list_header(self, tag):
+		found = self.int32()
+		nelems = self.count()
+		if found == 0 and nelems == 0:
+			return 0
+		if found != tag:
+			raise ValueError('Unexpected tag {} in netCDF header (expected {})'.format(found, tag))
+		return nelems
+
+	def attributes(self):
+		attrs = {}
+		for n in range(self.list_header(NC_ATTRIBUTE)):
+			name = self.name()
+			dtype = np.dtype(nc_types[self.int32()])
+			nelems = self.count()
+			raw = self.padded(nelems * dtype.itemsize)
+			if dtype.char == 'S':
+				attrs[name] = raw.decode('utf-8', 'replace').rstrip('\x00')
+			else:
+				values = np.frombuffer(raw, dtype=dtype).astype(dtype.newbyteorder('='))
+				attrs[name] = values[0] if nelems == 1 else values
+		return attrs
+
+
+# A netCDF-3 file mapped into memory:
+class ClassicDataset(object):
+
+	def __init__(self, filename):
+		self.filepath = filename
+		self._file = open(filename, 'rb')
+		self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		version = bytearray(self._map[3:4])[0]
+		header = _Header(self._map, version)
+		numrecs = header.count()
+
+		dims = []
+		for n in range(header.list_header(NC_DIMENSION)):
+			name = header.name()
+			dims.append((name, header.count()))
+		self._attrs = header.attributes()
+
+		vars = []
+		for n in range(header.list_header(NC_VARIABLE)):
+			name = header.name()
+			dimids = [header.count() for d in range(header.count())]
+			vattrs = header.attributes()
+			dtype = np.dtype(nc_types[header.int32()])
+			header.count() # vsize, recomputed below
+			begin = header.offset()
+			vars.append((name, dimids, vattrs, dtype, begin))
+
+		# Record variables have the unlimited (length 0) dimension first:
+		record = [v for v in vars if len(v[1]) and dims[v[1][0]][1] == 0]
+		sizes = [int(np.prod([dims[d][1] for d in v[1][1:]])) * v[3].itemsize for v in record]
+		if len(record) == 1:
+			recsize = sizes[0]
+		else:
+			recsize = sum((size + 3) // 4 * 4 for size in sizes)
+		if numrecs in (STREAMING, -1):
+			numrecs = (len(self._map) - min(v[4] for v in record)) // recsize if recsize else 0
+		self.recsize = recsize
+
+		self.dimensions = {}
+		for name, size in dims:
+			self.dimensions[name] = Dimension(name, size if size else numrecs, size == 0)
+		self.variables = {}
+		self.variable_attrs = {}
+		for name, dimids, vattrs, dtype, begin in vars:
+			shape = [dims[d][1] for d in dimids]
+			inner = shape
+			is_record = len(dimids) and dims[dimids[0]][1] == 0
+			if is_record:
+				inner = shape[1:]
+				shape = [numrecs] + inner
+			strides = []
+			step = dtype.itemsize
+			for size in reversed(inner):
+				strides.insert(0, step)
+				step *= size
+			if is_record:
+				strides.insert(0, recsize)
+			self.variables[name] = np.ndarray(shape=tuple(shape), dtype=dtype, buffer=self._map, offset=begin, strides=tuple(strides))
+			self.variable_attrs[name] = vattrs
+
+	# Global attributes (ncfile.TRUELAT1, ncfile.DX, ...):
+	def __getattr__(self, name):
+		attrs = self.__dict__.get('_attrs', {})
+		if name in attrs:
+			return attrs[name]
+		raise AttributeError(name)
+
+	def ncattrs(self):
+		return list(self._attrs)
+
+	def getncattr(self, name):
+		return self._attrs[name]
+
+	def close(self):
+		# The views keep a reference to the map, drop them first:
+		self.variables = {}
+		try:
+			self._map.close()
+		except Exception:
+			pass
+		self._file.close()
+
+
+# Define a procedure that returns the netCDF format version
+# of a classic file (1, 2 or 5), or 0 for other files:
+def classic_version(filename):
+	with open(filename, 'rb') as f:
+		magic = bytearray(f.read(4))
+	if len(magic) == 4 and bytes(magic[:3]) == b'CDF' and magic[3] in (1, 2, 5):
+		return magic[3]
+	return 0
+
+
+# Define a procedure that opens a model file: netCDF-3 files
+# with the memory-mapped reader, other files with netCDF4:
+def open_dataset(filename):
+	if classic_version(filename):
+		return ClassicDataset(filename)
+	from netCDF4 import Dataset as netcdf
+	return netcdf(filename)
@@ -0,0 +1,198 @@
+# profiles.py
+# Packed per-profile storage for model vertical levels.
+#
+# NWP_IN_3D keeps one row per (SensorID, Datetime, Level).
+# NWP_IN_3D_PACKED keeps one row per (SensorID, Datetime) and stores
+# the level values of Temperature, Pressure, Height and WV_Mixing_ratio
+# as little-endian float32 arrays in BLOB columns (see db/suada_updates.sql).
+# The values and units are the same as in NWP_IN_3D.
+
+import numpy as np
+
+
+# Names of the packed columns, in the order used by all helpers below:
+profile_fields = ('Temperature', 'Pressure', 'Height', 'WV_Mixing_ratio')
+
+# Storage type of the level arrays:
+blob_dtype = np.dtype('<f4')
+
+# Possible options for the 3D output layout (-l <levels>):
+# 'rows'   - one NWP_IN_3D row per level (default),
+# 'packed' - one NWP_IN_3D_PACKED row per profile,
+# 'both'   - write to both tables.
+level_layouts = ('rows', 'packed', 'both')
+
+
+# Define a procedure that packs the level values
+# of a profile into a BLOB string:
+def pack_levels(values):
+	return np.asarray(values, dtype=blob_dtype).tobytes()
+
+
+# Define a procedure that decodes a BLOB back
+# into a float array with one value per level:
+def unpack_levels(blob):
+	if blob is None:
+		return None
+	return np.frombuffer(blob, dtype=blob_dtype)
+
+
+# Define a procedure that builds the parameters
+# of one NWP_IN_3D_PACKED row:
+def packed_row(sensorId, date, latitude, longitude, temperature, pressure, height, mixing_ratio):
+	return (sensorId,
+		date,
+		len(temperature),
+		latitude,
+		longitude,
+		pack_levels(temperature),
+		pack_levels(pressure),
+		pack_levels(height),
+		pack_levels(mixing_ratio))
+
+
+insert_packed_sql = "insert into NWP_IN_3D_PACKED (SensorID, \
+	Datetime, \
+	Levels, \
+	Latitude, \
+	Longitude, \
+	Temperature, \
+	Pressure, \
+	Height, \
+	WV_Mixing_ratio)\
+	values (%s, %s, %s, %s, %s, %s, %s, %s, %s) on duplicate key update\
+	Levels = values(Levels),\
+	Latitude = values(Latitude),\
+	Longitude = values(Longitude),\
+	Temperature = values(Temperature),\
+	Pressure = values(Pressure),\
+	Height = values(Height),\
+	WV_Mixing_ratio = values(WV_Mixing_ratio)"
+
+
+# Define a procedure that inserts (or updates)
+# one packed profile. The level arrays are in the
+# same units as the NWP_IN_3D columns:
+def write_packed_profile(cur, sensorId, date, latitude, longitude, temperature, pressure, height, mixing_ratio):
+	cur.execute(insert_packed_sql, packed_row(sensorId, date, latitude, longitude, temperature, pressure, height, mixing_ratio))
+
+
+# Define a procedure that inserts (or updates)
+# many packed profiles with a single statement.
+# rows is a list of packed_row() results:
+def write_packed_profiles(cur, rows):
+	if len(rows):
+		cur.executemany(insert_packed_sql, rows)
+
+
+# Define a procedure that reads the packed profiles
+# of the given sensors between date_from and date_to
+# (inclusive) and decodes them straight to NumPy.
+# The result is a dictionary with:
+# 'SensorID', 'Latitude', 'Longitude', 'Levels' - 1D arrays (one value per profile),
+# 'Datetime' - list of datetimes,
+# and for each name in profile_fields a 2D float32 array
+# [profile, level]. Profiles with fewer levels are padded with NaN.
+def read_packed_profiles(cur, sensor_ids, date_from, date_to):
+	sensor_ids = [int(sid) for sid in sensor_ids]
+	result = {
+		'SensorID'  : np.zeros(0, dtype=int),
+		'Datetime'  : [],
+		'Latitude'  : np.zeros(0),
+		'Longitude' : np.zeros(0),
+		'Levels'    : np.zeros(0, dtype=int)
+		}
+	for field in profile_fields:
+		result[field] = np.zeros((0, 0), dtype=blob_dtype)
+	if not len(sensor_ids):
+		return result
+
+	cur.execute("select SensorID, \
+		Datetime, \
+		Latitude, \
+		Longitude, \
+		Levels, \
+		Temperature, \
+		Pressure, \
+		Height, \
+		WV_Mixing_ratio \
+		from NWP_IN_3D_PACKED \
+		where SensorID in (" + ', '.join(['%s'] * len(sensor_ids)) + ") \
+		and Datetime >= %s and Datetime <= %s \
+		order by SensorID, Datetime", sensor_ids + [date_from, date_to])
+	rows = cur.fetchall()
+	if not len(rows):
+		return result
+
+	nprof = len(rows)
+	nlev = max(row[4] for row in rows)
+	result['SensorID'] = np.array([row[0] for row in rows], dtype=int)
+	result['Datetime'] = [row[1] for row in rows]
+	result['Latitude'] = np.array([row[2] for row in rows], dtype=float)
+	result['Longitude'] = np.array([row[3] for row in rows], dtype=float)
+	result['Levels'] = np.array([row[4] for row in rows], dtype=int)
+	for f, field in enumerate(profile_fields):
+		values = np.empty((nprof, nlev), dtype=blob_dtype)
+		values.fill(np.nan)
+		for n, row in enumerate(rows):
+			levels = unpack_levels(row[5 + f])
+			if levels is not None:
+				values[n, :len(levels)] = levels
+		result[field] = values
+	return result
+
+
+# Define a procedure that splits rows ordered by
+# (SensorID, Datetime, level) into profiles. Returns the first row
+# of every profile and, for every row, its profile and level number:
+def group_levels(rows):
+	start = [0] + [n for n in range(1, len(rows)) if rows[n][0] != rows[n-1][0] or rows[n][1] != rows[n-1][1]]
+	profile = np.zeros(len(rows), dtype=int)
+	profile[start[1:]] = 1
+	profile = np.cumsum(profile)
+	level = np.arange(len(rows)) - np.array(start)[profile]
+	return start, profile, level
+
+
+# Define a procedure that reads the NWP_IN_3D rows of the sensors
+# between date_from and date_to and returns them in the same form
+# as read_packed_profiles (one profile per SensorID and Datetime,
+# levels in the order of the Level column):
+def read_level_profiles(cur, sensor_ids, date_from, date_to):
+	sensor_ids = [int(sid) for sid in sensor_ids]
+	if not len(sensor_ids):
+		return read_packed_profiles(cur, sensor_ids, date_from, date_to)
+
+	cur.execute("select SensorID, \
+		Datetime, \
+		Latitude, \
+		Longitude, \
+		Temperature, \
+		Pressure, \
+		Height, \
+		WV_Mixing_ratio \
+		from NWP_IN_3D \
+		where SensorID in (" + ', '.join(['%s'] * len(sensor_ids)) + ") \
+		and Datetime >= %s and Datetime <= %s \
+		order by SensorID, Datetime, Level", sensor_ids + [date_from, date_to])
+	rows = cur.fetchall()
+	if not len(rows):
+		return read_packed_profiles(cur, [], date_from, date_to)
+
+	start, profile, level = group_levels(rows)
+	nprof = len(start)
+	nlev = level.max() + 1
+
+	result = {
+		'SensorID'  : np.array([rows[n][0] for n in start], dtype=int),
+		'Datetime'  : [rows[n][1] for n in start],
+		'Latitude'  : np.array([rows[n][2] for n in start], dtype=float),
+		'Longitude' : np.array([rows[n][3] for n in start], dtype=float),
+		'Levels'    : np.bincount(profile, minlength=nprof)
+		}
+	for f, field in enumerate(profile_fields):
+		values = np.empty((nprof, nlev), dtype=blob_dtype)
+		values.fill(np.nan)
+		values[profile, level] = np.array([row[4 + f] for row in rows], dtype=float)
+		result[field] = values
+	return result
@@ -0,0 +1,188 @@
+# recompute.py
+# Recomputation of NWP_OUT from the stored model profiles.
+#
+# modelf.m recomputed IWV from profile dumps (model.dat) in MATLAB.
+# recompute.py reads the profiles of a source that ncdf2db.py has
+# stored (NWP_IN_3D, -l rows, or NWP_IN_3D_PACKED, -l packed) in
+# blocks of -b days, computes IWV, IWV_500_Swiss, IWV_500_Profile
+# and IWV_Max_Height for all profiles of a block at once
+# (columns.stored_profile_physics, columns.iwv_products) and upserts
+# them into NWP_OUT with one commit per block. A change of the
+# physics or of the constants in columns.py is so applied to the
+# whole archive without the wrfout files. Profiles are grouped by
+# their number of levels; other NWP_OUT columns (PE) are kept.
+#
+# The stored profiles are float32, the recomputed values can differ
+# from the values computed from the model files in the last digits.
+#
+# Usage:
+# recompute.py -d <env> -s <source_name> -f <from> -t <to>
+#	[-l <levels>] [rows] [-c <country>] [All] [-b <days>] [7] [--dry-run]
+
+import sys, getopt
+import datetime
+import numpy as np
+import columns
+import dbwriter
+import ncdf2db
+import profiles
+import suadadb
+
+
+instrument_name = 'GNSS'
+
+# Where the profiles are read from for -l <levels>:
+readers = {
+	'rows'   : profiles.read_level_profiles,
+	'packed' : profiles.read_packed_profiles
+	}
+
+
+# Define a procedure that computes the NWP_OUT products of
+# the profiles returned by profiles.read_*_profiles.
+# Returns a dictionary of arrays, one value per profile:
+def profile_products(prof):
+	nprof = len(prof['SensorID'])
+	names = ('IWV', 'IWV_500_Swiss', 'IWV_500_Profile', 'IWV_Max_Height')
+	products = dict((name, np.empty(nprof)) for name in names)
+	for name in names:
+		products[name].fill(np.nan)
+	# Profiles with the same number of levels are computed together
+	# (the shorter ones are padded with NaN):
+	for nlev in np.unique(prof['Levels']):
+		rows = np.nonzero(prof['Levels'] == nlev)[0]
+		if nlev < 2:
+			continue
+		phys = columns.stored_profile_physics(prof['Temperature'][rows, :nlev],
+			prof['Pressure'][rows, :nlev],
+			prof['Height'][rows, :nlev],
+			prof['WV_Mixing_ratio'][rows, :nlev])
+		for name, values in columns.iwv_products(phys).items():
+			if name in products:
+				products[name][rows] = values
+	return products
+
+
+# Define a procedure that builds the NWP_OUT rows of the profiles.
+# stations is a dictionary SensorID -> station (ncdf2db.getstations).
+# Profiles without a finite IWV are left out:
+def nwp_out_rows(prof, products, stations, source_id):
+	rows = []
+	for n, sensorId in enumerate(prof['SensorID']):
+		if not np.isfinite(products['IWV'][n]):
+			continue
+		values = {
+			'StationID'   : stations[int(sensorId)]['id'],
+			'SourceModID' : source_id,
+			'Datetime'    : prof['Datetime'][n]
+			}
+		for name in ('IWV', 'IWV_500_Swiss', 'IWV_500_Profile', 'IWV_Max_Height'):
+			value = products[name][n]
+			values[name] = float(value) if np.isfinite(value) else None
+		rows.append(values)
+	return rows
+
+
+# Define a procedure that recomputes the period [date_from, date_to)
+# in blocks of days. Returns the number of written rows:
+def recompute(db, cur, stations, source_id, date_from, date_to, levels='rows', days=7, dry_run=False):
+	writer = dbwriter.BatchWriter(cur, 'NWP_OUT')
+	sensor_ids = sorted(stations)
+	total = 0
+	start = date_from
+	while start < date_to:
+		end = min(start + datetime.timedelta(days=days), date_to)
+		# The readers select Datetime <= date_to:
+		prof = readers[levels](cur, sensor_ids, start, end - datetime.timedelta(seconds=1))
+		rows = nwp_out_rows(prof, profile_products(prof), stations, source_id)
+		if len(rows):
+			iwv = np.array([row['IWV'] for row in rows])
+			print('{} - {}: {} profiles, IWV {:.2f} .. {:.2f} kg/m^2'.format(start.date(), end.date(), len(rows), iwv.min(), iwv.max()))
+		if not dry_run:
+			for row in rows:
+				writer.add_dict(row)
+			writer.flush()
+			db.commit()
+		total += len(rows)
+		start = end
+	return total
+
+
+def usage():
+	print('recompute.py -d <env> -s <source_name> -f <from> -t <to> -l <levels> [rows] -c <country> [All] -b <days> [7] --dry-run')
+
+
+def main(argv):
+	# -d <env> - database ('dev' or 'prod'),
+	# -s <source_name> - model source,
+	# -f <from>, -t <to> - period (YYYY-MM-DD),
+	# -l <levels> - profiles from NWP_IN_3D ('rows') or NWP_IN_3D_PACKED ('packed'),
+	# -c <country> - the stations of one country only,
+	# -b <days> - days read and committed at a time,
+	# --dry-run - compute only, do not write NWP_OUT.
+	env = ''
+	source_name = ''
+	date_from = None
+	date_to = None
+	levels = 'rows'
+	country = 'All'
+	days = 7
+	dry_run = False
+	try:
+		opts, args = getopt.getopt(argv, "hd:s:f:t:l:c:b:", ["env=", "source_name=", "from=", "to=", "levels=", "country=", "days=", "dry-run"])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-d", "--env"):
+			env = arg
+		elif opt in ("-s", "--source_name"):
+			source_name = arg
+		elif opt in ("-f", "--from"):
+			date_from = datetime.datetime.strptime(arg, '%Y-%m-%d')
+		elif opt in ("-t", "--to"):
+			date_to = datetime.datetime.strptime(arg, '%Y-%m-%d') + datetime.timedelta(days=1)
+		elif opt in ("-l", "--levels"):
+			levels = arg
+		elif opt in ("-c", "--country"):
+			country = arg
+		elif opt in ("-b", "--days"):
+			days = int(arg)
+		elif opt == "--dry-run":
+			dry_run = True
+
+	if env == '' or source_name == '' or date_from is None or date_to is None:
+		print('Error: You must specify the database, the source and the period! (-d <env> -s <source_name> -f <from> -t <to>)')
+		sys.exit(2)
+	if not levels in readers:
+		print('Error: Not a possible levels layout {} (rows or packed)'.format(levels))
+		sys.exit(2)
+	if days < 1:
+		print('Error: -b <days> must be at least 1')
+		sys.exit(2)
+
+	try:
+		db = suadadb.connect(env)
+		cur = db.cursor()
+	except Exception as e:
+		print('Failed to establish connection: {0}'.format(e))
+		sys.exit(1)
+
+	source_id = ncdf2db.get_source_id(cur, source_name)
+	if source_id < 0:
+		print('Error: Can not find source_id for source_name: {}'.format(source_name))
+		sys.exit(1)
+	stations = ncdf2db.getstations(cur, source_name, country, instrument_name)
+	stations = dict((station['senid'], station) for station in stations if (country == 'All') or (country == station['country']))
+	print('{} stations of source {}'.format(len(stations), source_name))
+
+	total = recompute(db, cur, stations, source_id, date_from, date_to, levels, days, dry_run)
+	print('{} NWP_OUT rows {}'.format(total, 'computed (dry run)' if dry_run else 'written'))
+	cur.close()
+	db.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
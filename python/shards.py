@@ -0,0 +1,194 @@
+# shards.py
+# Sharded ingest of the model files over the nodes of a cluster.
+#
+# The file catalog (the files with [prefix] in [basedir], the
+# groups of nested domains or the cache entries) is sorted by valid
+# time and domain and split into n contiguous blocks (plan). Task i of
+# ncdf2db.py --shard i/n (or --shard sge in an SGE job array:
+# SGE_TASK_ID, SGE_TASK_FIRST, SGE_TASK_LAST, SGE_TASK_STEPSIZE)
+# ingests block i only and, with --manifest <dir>, writes the files
+# it planned and the files it finished to shard-<i>-of-<n>.json.
+# The split depends only on the file names, so a task can be rerun
+# (the upserts are idempotent) and gets the same files.
+#
+# The check (python shards.py) reads the manifests and reports the
+# missing shards, the failed files and the catalog files that no
+# shard has planned.
+#
+# Usage (check):
+# shards.py -q <manifestdir> -n <shards> -b <basedir> [./] -p <prefix> [wrfout_d02]
+#	[-m <domains>]
+
+import sys, os, getopt, json, re, socket, time
+import domains
+
+
+time_pattern = re.compile(r'(\d{4}-\d{2}-\d{2}_\d{2}[:_]\d{2}[:_]\d{2})')
+domain_pattern = re.compile(r'_(d\d\d)_')
+
+
+# Define a procedure that returns the name of a catalog item
+# (a file, a cache entry or a dictionary domain -> file):
+def item_name(item):
+	if isinstance(item, dict):
+		return ','.join(os.path.basename(item[domain]) for domain in sorted(item))
+	return os.path.basename(item)
+
+
+# Define a procedure that returns the sort key of an item:
+# valid time and domain from the WRF file name, then the name:
+def item_key(item):
+	name = item_name(item)
+	valid = time_pattern.search(name)
+	domain = domain_pattern.search(name)
+	return (valid.group(1).replace(':', '_') if valid else '', domain.group(1) if domain else '', name)
+
+
+# Define a procedure that returns the items of shard
+# index (1..count) of the catalog flist:
+def plan(flist, index, count):
+	items = sorted(flist, key=item_key)
+	return items[len(items) * (index - 1) // count:len(items) * index // count]
+
+
+# Define a procedure that parses --shard i/n. Returns (i, n):
+def parse_shard(arg):
+	if arg == 'sge':
+		shard = shard_from_env()
+		if shard is None:
+			raise ValueError('--shard sge needs SGE_TASK_ID and SGE_TASK_LAST')
+		return shard
+	try:
+		index, count = [int(value) for value in arg.split('/')]
+	except ValueError:
+		raise ValueError('Not a possible shard {} (use i/n)'.format(arg))
+	if count < 1 or index < 1 or index > count:
+		raise ValueError('Not a possible shard {} (use i/n with 1 <= i <= n)'.format(arg))
+	return index, count
+
+
+# Define a procedure that returns (i, n) of the task of an
+# SGE job array, or None outside of a job array:
+def shard_from_env(environ=os.environ):
+	task = environ.get('SGE_TASK_ID', 'undefined')
+	if task == 'undefined' or environ.get('SGE_TASK_LAST', 'undefined') == 'undefined':
+		return None
+	first = int(environ.get('SGE_TASK_FIRST', '1'))
+	step = environ.get('SGE_TASK_STEPSIZE', '1')
+	step = int(step) if step != 'undefined' else 1
+	last = int(environ['SGE_TASK_LAST'])
+	return (int(task) - first) // step + 1, (last - first) // step + 1
+
+
+# Define a procedure that returns the manifest file of a shard:
+def manifest_path(manifestdir, index, count):
+	return os.path.join(manifestdir, 'shard-{:04d}-of-{:04d}.json'.format(index, count))
+
+
+# Define a procedure that writes the manifest of a shard
+# (written to a temporary file and renamed):
+def write_manifest(manifestdir, index, count, planned, done, started):
+	if not os.path.isdir(manifestdir):
+		os.makedirs(manifestdir)
+	names = [item_name(item) for item in planned]
+	finished = set(item_name(item) for item in done)
+	manifest = {
+		'shard'    : index,
+		'count'    : count,
+		'host'     : socket.gethostname(),
+		'started'  : started,
+		'finished' : time.time(),
+		'planned'  : names,
+		'done'     : [name for name in names if name in finished]
+		}
+	path = manifest_path(manifestdir, index, count)
+	with open(path + '.tmp', 'w') as f:
+		json.dump(manifest, f, indent=1)
+	os.rename(path + '.tmp', path)
+	return path
+
+
+# Define a procedure that checks the manifests of count shards
+# against the catalog flist. Returns a dictionary with the lists
+# 'missing' (shards without a manifest), 'failed' (shard -> files
+# planned but not done) and 'uncovered' (catalog files of no plan,
+# when all shards have a manifest):
+def check(manifestdir, flist, count):
+	report = {'missing' : [], 'failed' : {}, 'uncovered' : []}
+	planned = set()
+	for index in range(1, count + 1):
+		path = manifest_path(manifestdir, index, count)
+		if not os.path.exists(path):
+			report['missing'].append(index)
+			continue
+		with open(path) as f:
+			manifest = json.load(f)
+		planned.update(manifest['planned'])
+		done = set(manifest['done'])
+		failed = [name for name in manifest['planned'] if not name in done]
+		if len(failed):
+			report['failed'][index] = failed
+	# The files of the missing shards are known only when they
+	# have run, so the coverage is checked when all manifests are there:
+	if not len(report['missing']):
+		report['uncovered'] = [item_name(item) for item in sorted(flist, key=item_key) if not item_name(item) in planned]
+	return report
+
+
+def usage():
+	print('shards.py -q <manifestdir> -n <shards> -b <basedir> [./] -p <prefix> [wrfout_d02] -m <domains>')
+
+
+def main(argv):
+	from ncdf2db import listfiles
+	manifestdir = ''
+	count = 0
+	basedir = './'
+	prefix = 'wrfout_d02'
+	domain_list = []
+	try:
+		opts, args = getopt.getopt(argv, "hq:n:b:p:m:", ["manifest=", "shards=", "basedir=", "prefix=", "domains="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-q", "--manifest"):
+			manifestdir = arg
+		elif opt in ("-n", "--shards"):
+			count = int(arg)
+		elif opt in ("-b", "--basedir"):
+			basedir = arg
+		elif opt in ("-p", "--prefix"):
+			prefix = arg
+		elif opt in ("-m", "--domains"):
+			domain_list = [domain for domain in arg.split(',') if domain]
+
+	if manifestdir == '' or count < 1:
+		print('Error: You must specify the manifests and the number of shards! (-q <manifestdir> -n <shards>)')
+		sys.exit(2)
+
+	if len(domain_list):
+		flist = domains.group_files(basedir, prefix, domain_list)
+	else:
+		flist = listfiles(basedir, prefix)
+	report = check(manifestdir, flist, count)
+
+	print('{} files in {} shards'.format(len(flist), count))
+	if len(report['missing']):
+		print('Shards without a manifest: {}'.format(','.join(str(index) for index in report['missing'])))
+	for index in sorted(report['failed']):
+		print('Shard {}: {} files not done: {}'.format(index, len(report['failed'][index]), ' '.join(report['failed'][index])))
+	if len(report['uncovered']):
+		print('{} files in no shard (the catalog has changed): {}'.format(len(report['uncovered']), ' '.join(report['uncovered'])))
+	rerun = sorted(set(report['missing']) | set(report['failed']))
+	if len(rerun) or len(report['uncovered']):
+		if len(rerun):
+			print('Rerun the shards: {}'.format(','.join(str(index) for index in rerun)))
+		sys.exit(1)
+	print('All shards complete')
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
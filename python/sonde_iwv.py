@@ -0,0 +1,257 @@
+# sonde_iwv.py
+# IWV of the radiosonde soundings (RADIOSONDE_IN -> RADIOSONDE_IN_IWV).
+#
+# The levels of RADIOSONDE_IN are streamed with an unbuffered
+# server-side cursor (SSCursor) ordered by sensor, epoch and
+# decreasing pressure and cut into batches of complete soundings.
+# The levels of a batch stay one flat array with the sounding number
+# of every level (ragged profiles, see profiles.group_levels), and the
+# IWV of all soundings of the batch is integrated at once:
+#
+# IWV = 1/g * sum over the layers of (q_k + q_k+1)/2 * (p_k - p_k+1)
+#
+# with the specific humidity q from MixR [g/kg] or, where MixR is
+# missing, from Dew_Point [C] (Magnus formula) and Pressure [hPa].
+# Levels without pressure or humidity are skipped, a layer joins
+# two levels of the same sounding only (segments of the flat array).
+#
+# Quality control, a sounding gets no IWV when:
+# 'levels'  - fewer than 2 levels with humidity,
+# 'surface' - the lowest level with humidity is more than
+#             qc_surface_gap above the lowest level of the sounding,
+# 'top'     - the humidity ends below qc_min_top,
+# 'gap'     - two levels with humidity below qc_gap_top are more
+#             than qc_max_gap apart.
+#
+# Only the soundings after the last epoch of every station in
+# RADIOSONDE_IN_IWV are read (-f <from> or --full to recompute).
+# Every batch is upserted and committed.
+#
+# Usage:
+# sonde_iwv.py -d <env> -r <sonde_source> [-c <country>] [All]
+#	[-f <from>] [--full] [-b <soundings>] [2000]
+
+import sys, getopt
+import datetime
+import numpy as np
+import MySQLdb.cursors
+import dbwriter
+import profiles
+import sondeinterp
+import suadadb
+
+
+# Define global variables:
+g = 9.80665
+
+# Quality control [hPa]:
+qc_surface_gap = 50.
+qc_min_top = 500.
+qc_gap_top = 500.
+qc_max_gap = 100.
+
+# Rows read from the server-side cursor at a time:
+fetch_size = 20000
+first_epoch = datetime.datetime(1900, 1, 1)
+
+
+# Define a procedure that computes the specific humidity [kg/kg]
+# of the levels from MixR [g/kg], or from Dew_Point [C] and
+# Pressure [hPa] where MixR is missing (NaN if both are missing):
+def specific_humidity(pressure, dew_point, mixr):
+	with np.errstate(invalid='ignore'):
+		e = 6.112 * np.exp(17.67 * dew_point / (dew_point + 243.5))
+		w_dew = 0.622 * e / (pressure - e)
+		w = np.where(np.isfinite(mixr), mixr / 1000., w_dew)
+		w = np.where(w >= 0, w, np.nan)
+	return w / (1. + w)
+
+
+# Define a procedure that integrates the IWV [kg/m^2] of nsound
+# soundings given as flat arrays of all their levels: sounding
+# number, pressure [hPa] (decreasing within a sounding) and specific
+# humidity [kg/kg]. Returns the IWV (NaN if rejected) and the
+# quality control result ('ok' or the reason) of every sounding:
+def integrate_iwv(sounding, pressure, q, nsound):
+	sounding = np.asarray(sounding, dtype=int)
+	pressure = np.asarray(pressure, dtype=float)
+	q = np.asarray(q, dtype=float)
+
+	surface = np.empty(nsound)
+	surface.fill(np.nan)
+	np.fmax.at(surface, sounding, pressure)
+
+	ok = np.isfinite(pressure) & (pressure > 0) & np.isfinite(q)
+	s = sounding[ok]
+	p = pressure[ok]
+	q = q[ok]
+
+	# Layers between neighbouring levels of the same sounding:
+	same = s[1:] == s[:-1]
+	dp = p[:-1] - p[1:]
+	layer = ((q[:-1] + q[1:]) / 2.) * dp * 100. / g
+	iwv = np.bincount(s[:-1][same], weights=layer[same], minlength=nsound)
+
+	nlev = np.bincount(s, minlength=nsound)
+	bottom = np.empty(nsound)
+	bottom.fill(np.nan)
+	np.fmax.at(bottom, s, p)
+	top = np.empty(nsound)
+	top.fill(np.nan)
+	np.fmin.at(top, s, p)
+	gaps = np.bincount(s[:-1][same & (dp > qc_max_gap) & (p[:-1] > qc_gap_top)], minlength=nsound)
+
+	status = np.array(['ok'] * nsound, dtype=object)
+	with np.errstate(invalid='ignore'):
+		status[gaps > 0] = 'gap'
+		status[~(top <= qc_min_top)] = 'top'
+		status[~(bottom >= surface - qc_surface_gap)] = 'surface'
+	status[nlev < 2] = 'levels'
+	iwv[status != 'ok'] = np.nan
+	return iwv, status
+
+
+# Define a procedure that returns the last epoch of every
+# station in RADIOSONDE_IN_IWV (StationID -> datetime):
+def last_epochs(cur, source_id):
+	cur.execute("select StationID, max(Datetime) from RADIOSONDE_IN_IWV \
+		where SourceID = %s group by StationID", [source_id])
+	return dict((row[0], row[1]) for row in cur.fetchall())
+
+
+# Define a procedure that streams the levels of the sensors after
+# date_from (None - all) through the server-side cursor sscur and
+# yields lists of rows (SensorID, Datetime, Pressure, Dew_Point,
+# MixR) of batch_size complete soundings:
+def stream_soundings(sscur, sensor_ids, date_from=None, batch_size=2000):
+	cond, params = suadadb.in_condition('SensorID', sensor_ids)
+	if date_from is None:
+		date_from = first_epoch
+	sscur.execute("select SensorID, Datetime, Pressure, Dew_Point, MixR from RADIOSONDE_IN \
+		where Datetime > %s" + cond + " \
+		order by SensorID, Datetime, Pressure desc", [date_from] + params)
+
+	pending = []
+	soundings = 0
+	key = None
+	while True:
+		rows = sscur.fetchmany(fetch_size)
+		if not rows:
+			break
+		for row in rows:
+			if (row[0], row[1]) != key:
+				if soundings >= batch_size:
+					yield pending
+					pending = []
+					soundings = 0
+				key = (row[0], row[1])
+				soundings += 1
+			pending.append(row)
+	if len(pending):
+		yield pending
+
+
+# Define a procedure that computes the IWV of the soundings in rows.
+# Returns (SensorID, Datetime) of every sounding, the IWV and the
+# quality control results:
+def batch_iwv(rows):
+	start, sounding, level = profiles.group_levels(rows)
+	pressure = np.array([row[2] for row in rows], dtype=float)
+	dew_point = np.array([row[3] for row in rows], dtype=float)
+	mixr = np.array([row[4] for row in rows], dtype=float)
+	iwv, status = integrate_iwv(sounding, pressure, specific_humidity(pressure, dew_point, mixr), len(start))
+	return [(rows[n][0], rows[n][1]) for n in start], iwv, status
+
+
+def usage():
+	print('sonde_iwv.py -d <env> -r <sonde_source> -c <country> [All] -f <from> --full -b <soundings> [2000]')
+
+
+def main(argv):
+	# -d <env> - database ('dev' or 'prod'),
+	# -r <sonde_source> - radiosonde source (RADIOSONDE_IN),
+	# -c <country> - the stations of one country only,
+	# -f <from> - recompute the soundings from this date on (YYYY-MM-DD),
+	# --full - recompute all soundings,
+	# -b <soundings> - soundings computed and committed at a time.
+	env = ''
+	sonde_source = ''
+	country = 'All'
+	date_from = None
+	full = False
+	batch_size = 2000
+	try:
+		opts, args = getopt.getopt(argv, "hd:r:c:f:b:", ["env=", "sonde_source=", "country=", "from=", "full", "soundings="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-d", "--env"):
+			env = arg
+		elif opt in ("-r", "--sonde_source"):
+			sonde_source = arg
+		elif opt in ("-c", "--country"):
+			country = arg
+		elif opt in ("-f", "--from"):
+			# The soundings from 00 UTC of the day on:
+			date_from = datetime.datetime.strptime(arg, '%Y-%m-%d') - datetime.timedelta(seconds=1)
+		elif opt == "--full":
+			full = True
+		elif opt in ("-b", "--soundings"):
+			batch_size = int(arg)
+
+	if env == '' or sonde_source == '':
+		print('Error: You must specify the database and the radiosonde source! (-d <env> -r <sonde_source>)')
+		sys.exit(2)
+
+	try:
+		db = suadadb.connect(env)
+		cur = db.cursor()
+		# A second connection for the unbuffered stream:
+		sdb = suadadb.connect(env, cursorclass=MySQLdb.cursors.SSCursor)
+		sscur = sdb.cursor()
+	except Exception as e:
+		print('Failed to establish connection: {0}'.format(e))
+		sys.exit(1)
+
+	source_id = suadadb.get_source_ids(cur, [sonde_source]).get(sonde_source, -1)
+	if source_id < 0:
+		print('Error: Can not find source_id for source_name: {}'.format(sonde_source))
+		sys.exit(1)
+	station_ids = None if country == 'All' else suadadb.get_station_ids(cur, country)
+	sensors = sondeinterp.get_sensor_stations(cur, source_id, station_ids)
+
+	# The soundings after the last epoch of every station:
+	last = {}
+	if date_from is None and not full:
+		last = last_epochs(cur, source_id)
+		if all(sensors[sensor] in last for sensor in sensors) and len(sensors):
+			date_from = min(last[sensors[sensor]] for sensor in sensors)
+	print('{} sensors of source {}, soundings after {}'.format(len(sensors), sonde_source, date_from if date_from is not None else 'the first'))
+
+	writer = dbwriter.BatchWriter(cur, 'RADIOSONDE_IN_IWV')
+	counts = {}
+	for rows in stream_soundings(sscur, sorted(sensors), date_from, batch_size):
+		keys, iwv, status = batch_iwv(rows)
+		for n, (sensorId, date) in enumerate(keys):
+			stationId = sensors[sensorId]
+			if stationId in last and date <= last[stationId]:
+				continue
+			counts[status[n]] = counts.get(status[n], 0) + 1
+			if status[n] == 'ok':
+				writer.add((stationId, source_id, date, float(iwv[n])))
+		writer.flush()
+		db.commit()
+		print('{} soundings: {}'.format(sum(counts.values()), ', '.join('{} {}'.format(counts[name], name) for name in sorted(counts))))
+
+	print('{} IWV values written to RADIOSONDE_IN_IWV'.format(writer.written))
+	sscur.close()
+	sdb.close()
+	cur.close()
+	db.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
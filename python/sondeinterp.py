@@ -0,0 +1,277 @@
+# sondeinterp.py
+# Comparison of the model profiles with the radiosondes.
+#
+# RADIOSONDE_IN keeps the soundings by pressure, NWP_IN_3D (and
+# NWP_IN_3D_PACKED) the model profiles by model level. The model
+# temperature, height and mixing ratio are interpolated linearly in
+# log-pressure to the standard levels (-v standard, the soundings are
+# interpolated the same way) or to the levels of every sounding
+# (-v sonde). All profiles are handled at once as [profile, level]
+# arrays (interp_logp); the model columns of ncdf2db.py
+# (columns.profile_physics) can be passed in the same way.
+#
+# The model and sonde values of every matched station, epoch and
+# level go to PROFILE_COMPARISON (see db/suada_updates.sql).
+#
+# Usage:
+# sondeinterp.py -d <env> -s <source_name> -r <sonde_source> -f <from> -t <to>
+#	[-v <levels>] [standard] [-k <model_layout>] [rows] [-c <country>] [All]
+
+import sys, getopt
+import datetime
+import numpy as np
+import dbwriter
+import profiles
+import suadadb
+
+
+# Standard pressure levels of the soundings [hPa]:
+standard_levels = np.array([1000., 925., 850., 700., 500., 400., 300., 250., 200., 150., 100.])
+
+# Possible options for -v <levels>:
+level_sets = ('standard', 'sonde')
+
+# Compared fields: model field (profiles.profile_fields) -> RADIOSONDE_IN column.
+# Units: temperature [C], height [m], mixing ratio [g/kg].
+sonde_fields = (
+	('Temperature', 'Temperature'),
+	('Height', 'Height'),
+	('WV_Mixing_ratio', 'MixR')
+	)
+
+
+# Define a procedure that interpolates profiles linearly in
+# log-pressure. pressure [profile, level] are the pressures of the
+# profiles (any order, NaN for missing levels), values a dictionary
+# name -> [profile, level] of the same shape, target the pressures to
+# interpolate to: [level] for all profiles or [profile, level].
+# Returns a dictionary name -> [profile, target level];
+# targets outside a profile (no extrapolation) are NaN:
+def interp_logp(pressure, values, target):
+	pressure = np.atleast_2d(np.asarray(pressure, dtype=float))
+	n = pressure.shape[0]
+	target = np.asarray(target, dtype=float)
+	if target.ndim == 1:
+		target = np.tile(target, (n, 1))
+	rows = np.arange(n)[:, None]
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		# Levels sorted by increasing log-pressure,
+		# missing levels at the end:
+		lp = np.log(np.where(pressure > 0, pressure, np.nan))
+		lp = np.where(np.isnan(lp), np.inf, lp)
+		order = np.argsort(lp, axis=1)
+		lp = lp[rows, order]
+		valid_levels = np.isfinite(lp).sum(axis=1)
+		lt = np.log(np.where(target > 0, target, np.nan))
+
+		# Layer of every target: lp[lo] <= lt <= lp[hi]
+		hi = (lp[:, None, :] < lt[:, :, None]).sum(axis=-1)
+		hi = np.clip(hi, 1, np.maximum(valid_levels - 1, 1)[:, None])
+		lo = hi - 1
+		x0 = lp[rows, lo]
+		x1 = lp[rows, hi]
+		weight = np.where(x1 > x0, (lt - x0) / (x1 - x0), 0.)
+		top = lp[rows, np.maximum(valid_levels - 1, 0)[:, None]]
+		inside = (valid_levels[:, None] >= 2) & (lt >= lp[:, :1]) & (lt <= top)
+
+		result = {}
+		for name in values:
+			v = np.atleast_2d(np.asarray(values[name], dtype=float))[rows, order]
+			y = v[rows, lo] + weight * (v[rows, hi] - v[rows, lo])
+			y[~inside] = np.nan
+			result[name] = y
+	return result
+
+
+# Define a procedure that interpolates the model columns of
+# columns.profile_physics (Pair, tk, hgth, QV) to the target pressures:
+def interp_columns(prof, target):
+	values = {
+		'Temperature'     : prof['tk'],
+		'Height'          : prof['hgth'],
+		'WV_Mixing_ratio' : prof['QV']
+		}
+	return interp_logp(prof['Pair'], values, target)
+
+
+# Define a procedure that reads the soundings of the sensors
+# between date_from and date_to from RADIOSONDE_IN. Returns the
+# same form as profiles.read_level_profiles: SensorID and Datetime
+# of every sounding and [sounding, level] arrays of Pressure and of
+# the columns in sonde_fields (NaN padded):
+def read_soundings(cur, sensor_ids, date_from, date_to):
+	sensor_ids = [int(sid) for sid in sensor_ids]
+	columns = ['Pressure'] + [column for field, column in sonde_fields]
+	result = {'SensorID' : np.zeros(0, dtype=int), 'Datetime' : []}
+	for column in columns:
+		result[column] = np.zeros((0, 0))
+	if not len(sensor_ids):
+		return result
+
+	cur.execute("select SensorID, Datetime, " + ', '.join(columns) + " \
+		from RADIOSONDE_IN \
+		where SensorID in (" + ', '.join(['%s'] * len(sensor_ids)) + ") \
+		and Datetime >= %s and Datetime <= %s \
+		order by SensorID, Datetime, Pressure desc", sensor_ids + [date_from, date_to])
+	rows = cur.fetchall()
+	if not len(rows):
+		return result
+
+	start, sounding, level = profiles.group_levels(rows)
+	result['SensorID'] = np.array([rows[n][0] for n in start], dtype=int)
+	result['Datetime'] = [rows[n][1] for n in start]
+	for c, column in enumerate(columns):
+		values = np.empty((len(start), level.max() + 1))
+		values.fill(np.nan)
+		values[sounding, level] = np.array([row[2 + c] for row in rows], dtype=float)
+		result[column] = values
+	return result
+
+
+# Define a procedure that returns the sensors of a source
+# as a dictionary SensorID -> StationID (for the given stations):
+def get_sensor_stations(cur, source_id, station_ids):
+	cond, params = suadadb.in_condition('StationID', station_ids)
+	cur.execute("select ID, StationID from SENSOR where SourceID = %s" + cond, [source_id] + params)
+	return dict((row[0], row[1]) for row in cur.fetchall())
+
+
+# Define a procedure that matches the model profiles with the
+# soundings of the same station and epoch and interpolates both to
+# the compared levels. Returns the PROFILE_COMPARISON rows:
+def compare_profiles(model, model_stations, sondes, sonde_stations, source_id, sonde_id, level_set):
+	index = {}
+	for n, sensor in enumerate(model['SensorID']):
+		index[(model_stations[sensor], model['Datetime'][n])] = n
+	pairs = []
+	for n, sensor in enumerate(sondes['SensorID']):
+		key = (sonde_stations[sensor], sondes['Datetime'][n])
+		if key in index:
+			pairs.append((index[key], n, key))
+	if not len(pairs):
+		return []
+	m = np.array([pair[0] for pair in pairs])
+	s = np.array([pair[1] for pair in pairs])
+
+	model_values = dict((field, model[field][m]) for field, column in sonde_fields)
+	sonde_values = dict((field, sondes[column][s]) for field, column in sonde_fields)
+	if level_set == 'standard':
+		target = np.tile(standard_levels, (len(pairs), 1))
+		sonde_values = interp_logp(sondes['Pressure'][s], sonde_values, target)
+	else:
+		target = sondes['Pressure'][s]
+	model_values = interp_logp(model['Pressure'][m], model_values, target)
+
+	rows = []
+	for p, (mi, si, (stationId, date)) in enumerate(pairs):
+		for k in range(target.shape[1]):
+			if np.isnan(target[p, k]):
+				continue
+			x = [model_values[field][p, k] for field, column in sonde_fields]
+			y = [sonde_values[field][p, k] for field, column in sonde_fields]
+			if np.all(np.isnan(x)) or np.all(np.isnan(y)):
+				continue
+			rows.append([stationId, source_id, sonde_id, date, level_set, float(target[p, k])]
+				+ [None if np.isnan(value) else float(value) for value in x + y])
+	return rows
+
+
+def usage():
+	print('sondeinterp.py -d <env> -s <source_name> -r <sonde_source> -f <from> -t <to> [-v <levels>] [standard] [-k <model_layout>] [rows] [-c <country>] [All]')
+
+
+def main(argv):
+	# -d <env> - database ('dev' or 'prod'),
+	# -s <source_name> - model source (NWP_IN_3D / NWP_IN_3D_PACKED),
+	# -r <sonde_source> - radiosonde source (RADIOSONDE_IN),
+	# -f <from>, -t <to> - compared period (YYYY-MM-DD),
+	# -v <levels> - 'standard' (standard_levels) or 'sonde' (levels of every sounding),
+	# -k <model_layout> - read the model profiles from 'rows' (NWP_IN_3D) or 'packed' (NWP_IN_3D_PACKED),
+	# -c <country> - compare the stations of one country only.
+	env = ''
+	source_name = ''
+	sonde_source = ''
+	date_from = None
+	date_to = None
+	level_set = 'standard'
+	layout = 'rows'
+	country = 'All'
+
+	try:
+		opts, args = getopt.getopt(argv, "hd:s:r:f:t:v:k:c:", ["env=", "source_name=", "sonde_source=", "from=", "to=", "levels=", "model_layout=", "country="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-d", "--env"):
+			env = arg
+		elif opt in ("-s", "--source_name"):
+			source_name = arg
+		elif opt in ("-r", "--sonde_source"):
+			sonde_source = arg
+		elif opt in ("-f", "--from"):
+			date_from = datetime.datetime.strptime(arg, '%Y-%m-%d')
+		elif opt in ("-t", "--to"):
+			# The last second of the day (the readers select Datetime <= date_to):
+			date_to = datetime.datetime.strptime(arg, '%Y-%m-%d') + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
+		elif opt in ("-v", "--levels"):
+			level_set = arg
+		elif opt in ("-k", "--model_layout"):
+			layout = arg
+		elif opt in ("-c", "--country"):
+			country = arg
+
+	if env == '' or source_name == '' or sonde_source == '' or date_from is None or date_to is None:
+		print('Error: You must specify the database, the sources and the period! (-d <env> -s <source_name> -r <sonde_source> -f <from> -t <to>)')
+		sys.exit(2)
+	if not level_set in level_sets:
+		print('Error: Not a possible levels option {}'.format(level_set))
+		sys.exit(2)
+	if not layout in ('rows', 'packed'):
+		print('Error: Not a possible model layout {}'.format(layout))
+		sys.exit(2)
+
+	try:
+		db = suadadb.connect(env)
+		cur = db.cursor()
+	except Exception as e:
+		print('Failed to establish connection: {0}'.format(e))
+		sys.exit(1)
+
+	source_ids = suadadb.get_source_ids(cur, [source_name, sonde_source])
+	for name in (source_name, sonde_source):
+		if not name in source_ids:
+			print('Error: Can not find source_id for source_name: {}'.format(name))
+			sys.exit(1)
+	station_ids = suadadb.get_station_ids(cur, country)
+	model_stations = get_sensor_stations(cur, source_ids[source_name], station_ids)
+	sonde_stations = get_sensor_stations(cur, source_ids[sonde_source], station_ids)
+
+	# Only the stations with both model profiles and soundings:
+	common = set(model_stations.values()) & set(sonde_stations.values())
+	model_sensors = [sensor for sensor in model_stations if model_stations[sensor] in common]
+	sonde_sensors = [sensor for sensor in sonde_stations if sonde_stations[sensor] in common]
+	print('{} stations with model profiles and soundings'.format(len(common)))
+
+	if layout == 'packed':
+		model = profiles.read_packed_profiles(cur, model_sensors, date_from, date_to)
+	else:
+		model = profiles.read_level_profiles(cur, model_sensors, date_from, date_to)
+	sondes = read_soundings(cur, sonde_sensors, date_from, date_to)
+	print('{} model profiles, {} soundings'.format(len(model['SensorID']), len(sondes['SensorID'])))
+
+	rows = compare_profiles(model, model_stations, sondes, sonde_stations, source_ids[source_name], source_ids[sonde_source], level_set)
+	columns, keys = dbwriter.tables['PROFILE_COMPARISON']
+	dbwriter.upsert_many(cur, 'PROFILE_COMPARISON', columns, keys, rows)
+	db.commit()
+	print('{} compared levels written to PROFILE_COMPARISON'.format(len(rows)))
+
+	cur.close()
+	db.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
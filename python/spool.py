@@ -0,0 +1,354 @@
+# spool.py
+# Local spool between the ingest scripts and the database.
+#
+# With --spool <dir> ncdf2db.py does not write to MySQL: every batch
+# of rows (table, rows) is appended to a segment file of the spool
+# and synced to disk, so the model processing does not wait on the
+# writes and a stalled or unreachable server loses nothing. The
+# source and the stations are still read from the database once at
+# the start of ncdf2db.py, and with --skip-unchanged the stored block
+# hashes once per file (all blocks are sent if that fails). The
+# drainer (python spool.py) sends the batches to the database in the
+# order they were written, one batch per commit, and remembers its
+# position in drain.pos. Failed connections are retried with an
+# increasing delay (backoff); batches that the server rejects
+# (e.g. a foreign key error) are kept in rejected.spool.
+#
+# ncdf2db.py --skip-unchanged spools the block hashes of a file
+# (INGEST_HASH, see blockhash.py) after its rows. When a batch of
+# rows is rejected, the next INGEST_HASH batch is dropped, so that a
+# rerun sends the rows again instead of skipping them.
+#
+# Segment files: segment-<number>.spool, a new segment is started
+# by every writer and after segment_size bytes. A frame is
+# magic (4 bytes), payload length and CRC32 of the payload (big-endian
+# unsigned ints) and the payload (pickled (table, rows)).
+# Segments with a damaged frame are moved to bad/.
+#
+# Usage (drainer):
+# spool.py -d <env> -q <spooldir> [-t <poll seconds>] [5]
+#	[--max-backoff <seconds>] [300] [--once]
+
+import sys, os, getopt, glob, time
+import fcntl
+import pickle
+import struct
+import zlib
+import MySQLdb
+import dbwriter
+import suadadb
+
+
+magic = b'SPL1'
+frame_header = struct.Struct('>4sII')
+segment_size = 64 * 1024 * 1024
+pos_name = 'drain.pos'
+lock_name = 'writer.lock'
+rejected_name = 'rejected.spool'
+# MySQL client errors of a lost or unreachable server (retried):
+# CR_CONNECTION_ERROR, CR_CONN_HOST_ERROR, CR_SERVER_GONE_ERROR,
+# CR_SERVER_LOST, CR_SERVER_LOST_EXTENDED
+connection_errnos = (2002, 2003, 2006, 2013, 2055)
+
+
+class SpoolError(Exception):
+	pass
+
+
+# Define a procedure that returns the segment files
+# of the spool, oldest first:
+def segments(spooldir):
+	return sorted(glob.glob(os.path.join(spooldir, 'segment-*.spool')))
+
+
+# Define a procedure that returns the number of a segment file:
+def segment_number(path):
+	return int(os.path.basename(path)[len('segment-'):-len('.spool')])
+
+
+# Define a procedure that builds the frame of one batch:
+def encode_frame(table, rows):
+	payload = pickle.dumps((table, [tuple(row) for row in rows]), 2)
+	return frame_header.pack(magic, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+# Define a procedure that reads the frames of a segment
+# from offset on. Yields (offset after the frame, table, rows).
+# Stops at an incomplete frame (still being written or cut off
+# by a crash), raises SpoolError for a damaged frame:
+def read_frames(path, offset=0):
+	with open(path, 'rb') as f:
+		f.seek(offset)
+		while True:
+			header = f.read(frame_header.size)
+			if len(header) < frame_header.size:
+				return
+			tag, length, crc = frame_header.unpack(header)
+			if tag != magic:
+				raise SpoolError('Bad frame at {}:{}'.format(path, offset))
+			payload = f.read(length)
+			if len(payload) < length:
+				return
+			if zlib.crc32(payload) & 0xffffffff != crc:
+				raise SpoolError('Checksum error at {}:{}'.format(path, offset))
+			offset += frame_header.size + length
+			table, rows = pickle.loads(payload)
+			yield offset, table, rows
+
+
+# A Spool appends batches to the segment files. Only one
+# writer at a time uses a spool directory (writer.lock):
+class Spool(object):
+
+	def __init__(self, spooldir, max_segment=segment_size):
+		self.spooldir = spooldir
+		self.max_segment = max_segment
+		if not os.path.isdir(spooldir):
+			os.makedirs(spooldir)
+		self.lock = open(os.path.join(spooldir, lock_name), 'w')
+		try:
+			fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			raise SpoolError('The spool {} is used by another writer'.format(spooldir))
+		self.segment = None
+		self.batches = 0
+		self.rotate()
+
+	# Start a new segment after the existing ones:
+	def rotate(self):
+		if self.segment is not None:
+			self.segment.close()
+		numbers = [segment_number(path) for path in segments(self.spooldir)]
+		number = max(numbers) + 1 if len(numbers) else 1
+		self.path = os.path.join(self.spooldir, 'segment-{:012d}.spool'.format(number))
+		self.segment = open(self.path, 'ab')
+
+	# Append one batch of rows of a table (see dbwriter.tables):
+	def append(self, table, rows):
+		if not len(rows):
+			return 0
+		if not table in dbwriter.tables:
+			raise SpoolError('Unknown table {}'.format(table))
+		if self.segment.tell() >= self.max_segment:
+			self.rotate()
+		self.segment.write(encode_frame(table, rows))
+		self.batches += 1
+		return len(rows)
+
+	# Write the appended batches to disk:
+	def sync(self):
+		self.segment.flush()
+		os.fsync(self.segment.fileno())
+
+	def close(self):
+		if self.segment is not None:
+			self.sync()
+			self.segment.close()
+			self.segment = None
+		self.lock.close()
+
+
+# A SpoolWriter has the interface of dbwriter.BatchWriter
+# but appends the rows to the spool instead of the database:
+class SpoolWriter(dbwriter.BatchWriter):
+
+	def __init__(self, spool, table, batch_size=5000):
+		dbwriter.BatchWriter.__init__(self, None, table, batch_size=batch_size)
+		self.spool = spool
+
+	def flush(self):
+		if len(self.rows):
+			self.spool.append(self.table, self.rows)
+			self.written += len(self.rows)
+			self.rows = []
+		return self.written
+
+
+# Define a procedure that reads the drain position
+# (segment file name, offset) of the spool and whether a
+# batch has been rejected since the last INGEST_HASH batch:
+def read_pos(spooldir):
+	try:
+		with open(os.path.join(spooldir, pos_name)) as f:
+			values = f.read().split()
+			return values[0], int(values[1]), len(values) > 2 and values[2] == 'rejected'
+	except (IOError, OSError, ValueError, IndexError):
+		return None, 0, False
+
+
+# Define a procedure that saves the drain position
+# (written to a temporary file and renamed):
+def write_pos(spooldir, name, offset, rejected=False):
+	path = os.path.join(spooldir, pos_name)
+	with open(path + '.tmp', 'w') as f:
+		f.write('{} {}{}\n'.format(name, offset, ' rejected' if rejected else ''))
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(path + '.tmp', path)
+
+
+# A Drainer sends the spooled batches to the database.
+# connect is a function that returns a new DB connection:
+class Drainer(object):
+
+	def __init__(self, spooldir, connect, max_backoff=300., sleep=time.sleep):
+		self.spooldir = spooldir
+		self.connect = connect
+		self.max_backoff = max_backoff
+		self.sleep = sleep
+		self.db = None
+		self.sent = 0
+		self.rejected = 0
+		self.dropped = 0
+
+	# Errors of the connection (retried) as opposed to
+	# errors of the data (the batch is rejected). MySQLdb raises
+	# many statement errors as OperationalError, only the
+	# connection_errnos are errors of the connection:
+	def connection_error(self, e):
+		if isinstance(e, MySQLdb.InterfaceError):
+			return True
+		return isinstance(e, MySQLdb.OperationalError) and len(e.args) > 0 and e.args[0] in connection_errnos
+
+	# Send one batch and commit it. Failed connects and connection
+	# errors are retried with backoff until the batch is committed:
+	def send(self, table, rows):
+		columns, keys = dbwriter.tables[table]
+		delay = 1.
+		while True:
+			connected = self.db is not None
+			try:
+				if self.db is None:
+					self.db = self.connect()
+					connected = True
+				cur = self.db.cursor()
+				try:
+					dbwriter.upsert_many(cur, table, columns, keys, rows)
+					self.db.commit()
+				finally:
+					cur.close()
+				self.sent += len(rows)
+				return True
+			except Exception as e:
+				try:
+					self.db.rollback()
+				except Exception:
+					pass
+				if connected and not self.connection_error(e):
+					sys.stderr.write('Rejected batch of {} rows for {}: {}\n'.format(len(rows), table, repr(e)))
+					with open(os.path.join(self.spooldir, rejected_name), 'ab') as f:
+						f.write(encode_frame(table, rows))
+					self.rejected += len(rows)
+					return False
+				sys.stderr.write('Database not available ({}), retry in {:.0f} s\n'.format(repr(e), delay))
+				try:
+					self.db.close()
+				except Exception:
+					pass
+				self.db = None
+				self.sleep(delay)
+				delay = min(delay * 2., self.max_backoff)
+
+	# Move a damaged segment out of the way:
+	def set_aside(self, path, error):
+		sys.stderr.write('{}, segment moved to bad/\n'.format(error))
+		bad = os.path.join(self.spooldir, 'bad')
+		if not os.path.isdir(bad):
+			os.makedirs(bad)
+		os.rename(path, os.path.join(bad, os.path.basename(path)))
+
+	# Send everything waiting in the spool. Drained segments
+	# are removed except the newest one (a writer may still
+	# append to it). A segment that was the newest when its reading
+	# started may have got more frames since; the pass stops there
+	# and reads on from the position the next time. Returns the
+	# number of sent batches:
+	def drain(self):
+		batches = 0
+		name, offset, rejected = read_pos(self.spooldir)
+		for path in segments(self.spooldir):
+			if name is not None and os.path.basename(path) < name:
+				os.remove(path) # drained before
+				continue
+			if os.path.basename(path) != name:
+				name, offset = os.path.basename(path), 0
+			# A writer has finished the segments before the newest:
+			finished = path != segments(self.spooldir)[-1]
+			try:
+				for offset, table, rows in read_frames(path, offset):
+					if table == 'INGEST_HASH' and rejected:
+						# The rows of these blocks are not all in the database:
+						sys.stderr.write('Dropped {} block hashes after a rejected batch\n'.format(len(rows)))
+						self.dropped += len(rows)
+						rejected = False
+					elif not self.send(table, rows):
+						rejected = table != 'INGEST_HASH'
+					elif table == 'INGEST_HASH':
+						rejected = False
+					write_pos(self.spooldir, name, offset, rejected)
+					batches += 1
+			except SpoolError as e:
+				self.set_aside(path, e)
+				continue
+			if not finished:
+				break
+			if offset < os.path.getsize(path):
+				sys.stderr.write('Incomplete frame at the end of {} dropped\n'.format(path))
+			os.remove(path)
+		return batches
+
+
+def usage():
+	print('spool.py -d <env> -q <spooldir> -t <poll seconds> [5] --max-backoff <seconds> [300] --once')
+
+
+def main(argv):
+	env = ''
+	spooldir = ''
+	poll = 5.
+	max_backoff = 300.
+	once = False
+	try:
+		opts, args = getopt.getopt(argv, "hd:q:t:", ["env=", "spool=", "poll=", "max-backoff=", "once"])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-d", "--env"):
+			env = arg
+		elif opt in ("-q", "--spool"):
+			spooldir = arg
+		elif opt in ("-t", "--poll"):
+			poll = float(arg)
+		elif opt == "--max-backoff":
+			max_backoff = float(arg)
+		elif opt == "--once":
+			once = True
+
+	if env == '' or spooldir == '':
+		print('Error: You must specify the database and the spool directory! (-d <env> -q <spooldir>)')
+		sys.exit(2)
+	if not os.path.isdir(spooldir):
+		print('Error: No such spool directory {}'.format(spooldir))
+		sys.exit(2)
+
+	drainer = Drainer(spooldir, lambda: suadadb.connect(env), max_backoff)
+	try:
+		while True:
+			batches = drainer.drain()
+			if batches:
+				print('{} batches sent ({} rows, {} rejected, {} hashes dropped)'.format(batches, drainer.sent, drainer.rejected, drainer.dropped))
+			if once:
+				break
+			time.sleep(poll)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if drainer.db is not None:
+			drainer.db.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
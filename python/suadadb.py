@@ -0,0 +1,65 @@
+# suadadb.py
+# Common procedures for connecting to the SUADA database
+# and looking up entries in the SUADA information tables.
+
+import MySQLdb
+import databaseconfig as cfg
+
+
+# Possible options for -d <env>:
+environments = ('dev', 'prod')
+
+
+# Define a procedure that creates the DB connection
+# for the given environment ('dev' or 'prod').
+# Extra keyword arguments are passed to MySQLdb.connect
+# (for example cursorclass):
+def connect(env, **kwargs):
+	if env == 'dev':
+		config = cfg.dev
+	elif env == 'prod':
+		config = cfg.prod
+	else:
+		raise ValueError('No such database: {} (possible options are "dev" and "prod")'.format(env))
+	print('DB -> {}'.format(config['db']))
+	return MySQLdb.connect(host=config['host'],
+		user=config['user'],
+		passwd=config['passwd'],
+		db=config['db'],
+		**kwargs)
+
+
+# Define a procedure that takes a list of source names
+# and returns a dictionary source_name -> source_id
+# with a single query. Unknown names are left out:
+def get_source_ids(cur, source_names):
+	source_ids = {}
+	source_names = list(source_names)
+	if not len(source_names):
+		return source_ids
+	cur.execute("SELECT Name, ID FROM SOURCE WHERE Name in (" + ', '.join(['%s'] * len(source_names)) + ")", source_names)
+	for row in cur.fetchall():
+		source_ids[row[0]] = row[1]
+	return source_ids
+
+
+# Define a procedure that returns the IDs of the stations
+# in the given country (all stations for 'All'):
+def get_station_ids(cur, country):
+	if country == 'All':
+		cur.execute("SELECT ID FROM STATION")
+	else:
+		cur.execute("SELECT ID FROM STATION WHERE Country = %(country)s", {'country' : country})
+	return [row[0] for row in cur.fetchall()]
+
+
+# Define a procedure that builds an "and <column> in (...)"
+# condition for a list of IDs. None means no condition,
+# an empty list matches nothing:
+def in_condition(column, ids):
+	if ids is None:
+		return '', []
+	ids = [int(i) for i in ids]
+	if not len(ids):
+		return ' and 1 = 0', []
+	return ' and ' + column + ' in (' + ', '.join(['%s'] * len(ids)) + ')', ids
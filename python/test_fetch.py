@@ -0,0 +1,164 @@
+# test_fetch.py
+# Tests of the downloads of fetch.py against a local HTTP server
+# (resume of a .part file, the disk budget, failed downloads).
+#
+# Usage:
+# python -m unittest test_fetch
+
+import os, re, shutil, tempfile
+import threading
+import unittest
+try:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+import fetch
+
+
+# A request handler that serves the files of the server (name ->
+# bytes), with Range requests if the server has ranges set.
+# 'drop' files send only a part of the announced length, for
+# 'close' files the connection is closed without a response:
+class Handler(BaseHTTPRequestHandler):
+
+	def do_HEAD(self):
+		self.reply(False)
+
+	def do_GET(self):
+		self.reply(True)
+
+	def reply(self, body):
+		name = self.path.lstrip('/')
+		self.server.requests.append((self.command, name, self.headers.get('Range')))
+		if body and name in self.server.close:
+			self.close_connection = True
+			return
+		data = self.server.files.get(name)
+		if data is None:
+			self.send_error(404)
+			return
+		start = 0
+		match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+		if match and self.server.ranges:
+			start = int(match.group(1))
+			if start >= len(data):
+				self.send_error(416)
+				return
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+		else:
+			self.send_response(200)
+		self.send_header('Content-Length', str(len(data) - start))
+		self.end_headers()
+		if body:
+			if name in self.server.drop:
+				self.wfile.write(data[start:start + 10])
+				self.wfile.flush()
+				self.close_connection = True
+				return
+			self.wfile.write(data[start:])
+
+	def log_message(self, *args):
+		pass
+
+
+class FetchTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = HTTPServer(('127.0.0.1', 0), Handler)
+		self.server.files = {}
+		self.server.requests = []
+		self.server.ranges = True
+		self.server.drop = set()
+		self.server.close = set()
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+		self.datadir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.datadir)
+
+	def add_file(self, name, size):
+		data = bytes(bytearray((n * 7) % 251 for n in range(size)))
+		self.server.files[name] = data
+		return data
+
+	def read(self, name):
+		with open(os.path.join(self.datadir, name), 'rb') as f:
+			return f.read()
+
+	def write_part(self, name, data):
+		with open(os.path.join(self.datadir, name + '.part'), 'wb') as f:
+			f.write(data)
+
+	def test_resume(self):
+		data = self.add_file('wrfout_d02_a', 5000)
+		self.write_part('wrfout_d02_a', data[:1200])
+		path = os.path.join(self.datadir, 'wrfout_d02_a')
+		self.assertEqual(fetch.download(self.url + 'wrfout_d02_a', path, len(data)), len(data))
+		self.assertEqual(self.read('wrfout_d02_a'), data)
+		self.assertFalse(os.path.exists(path + '.part'))
+		self.assertEqual(self.server.requests, [('GET', 'wrfout_d02_a', 'bytes=1200-')])
+
+	def test_range_ignored(self):
+		data = self.add_file('wrfout_d02_a', 5000)
+		self.server.ranges = False
+		self.write_part('wrfout_d02_a', b'x' * 1200)
+		path = os.path.join(self.datadir, 'wrfout_d02_a')
+		self.assertEqual(fetch.download(self.url + 'wrfout_d02_a', path, len(data)), len(data))
+		self.assertEqual(self.read('wrfout_d02_a'), data)
+
+	def test_complete_part(self):
+		data = self.add_file('wrfout_d02_a', 5000)
+		self.write_part('wrfout_d02_a', data)
+		path = os.path.join(self.datadir, 'wrfout_d02_a')
+		self.assertEqual(fetch.download(self.url + 'wrfout_d02_a', path, len(data)), len(data))
+		self.assertEqual(self.read('wrfout_d02_a'), data)
+		self.assertEqual(self.server.requests, [])
+
+	def test_disk_budget(self):
+		names = ['wrfout_d02_{}'.format(n) for n in range(6)]
+		for name in names:
+			self.add_file(name, 1000)
+		budget = fetch.DiskBudget(2500)
+		fetcher = fetch.Fetcher(self.url, self.datadir, budget, workers=4)
+		fetcher.start(names)
+		fetched = []
+		peak = 0
+		for n in range(len(names)):
+			name, path, size, error = fetcher.done.get(timeout=30)
+			self.assertEqual(error, None)
+			self.assertEqual(self.read(name), self.server.files[name])
+			on_disk = sum(os.path.getsize(os.path.join(self.datadir, entry)) for entry in os.listdir(self.datadir))
+			peak = max(peak, on_disk)
+			fetched.append(name)
+			# Ingested: removed, or kept until the space is needed:
+			budget.ingested(path, size, n % 2 == 0)
+		self.assertEqual(sorted(fetched), names)
+		self.assertTrue(peak <= 2500)
+		self.assertTrue(budget.used <= 2500)
+
+	def test_failed(self):
+		retries = fetch.retries
+		fetch.retries = 1
+		try:
+			self.add_file('wrfout_d02_a', 5000)
+			self.server.drop.add('wrfout_d02_a')
+			self.add_file('wrfout_d02_b', 5000)
+			self.server.close.add('wrfout_d02_b')
+			names = ['wrfout_d02_a', 'wrfout_d02_b', 'wrfout_d02_missing']
+			fetcher = fetch.Fetcher(self.url, self.datadir, fetch.DiskBudget(0), workers=2)
+			fetcher.start(names)
+			results = [fetcher.done.get(timeout=30) for name in names]
+		finally:
+			fetch.retries = retries
+		self.assertEqual(sorted(name for name, path, size, error in results), names)
+		self.assertTrue(all(error is not None for name, path, size, error in results))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,116 @@
+# test_kernels.py
+# Numerical equality of the column physics: kernels.profile_physics
+# (compiled with numba if installed, the pure Python kernel, the NumPy
+# fallback) against columns.profile_physics and the former level loop
+# of ncdf2db.process_station (reference_iwv), and the rows that
+# process_station writes from these values.
+#
+# Usage:
+# python -m unittest test_kernels
+
+import datetime
+import unittest
+import numpy as np
+import columns
+import kernels
+import blockhash
+
+
+fields = ('tk', 'Pair', 'hgth', 'QV', 'rho', 'IWV_cum', 'IWV')
+
+
+# Define a procedure that returns random model columns
+# [column, level] (PH and PHB with one more level):
+def random_columns(n=50, nz=44, seed=1):
+	r = np.random.RandomState(seed)
+	return {
+		'T'      : r.uniform(0., 30., (n, nz)),
+		'P'      : r.uniform(-100., 100., (n, nz)),
+		'PB'     : np.tile(np.linspace(95000., 5000., nz), (n, 1)),
+		'PH'     : r.uniform(0., 10., (n, nz + 1)),
+		'PHB'    : np.tile(np.linspace(0., 200000., nz + 1), (n, 1)),
+		'QVAPOR' : r.uniform(0., 0.015, (n, nz))
+		}
+
+
+def physics_args(col):
+	return [col[name] for name in ('T', 'P', 'PB', 'PH', 'PHB', 'QVAPOR')]
+
+
+# Define a procedure that computes IWV of one column with the
+# level loop that ncdf2db.process_station had (the reference):
+def reference_iwv(T, P, PB, PH, PHB, QVAPOR):
+	Rv = columns.Rv
+	IWV = 0.
+	for k in range(0, len(T)):
+		if k <= columns.iwv_top_layer and k + 1 < len(T):
+			q1 = (QVAPOR[k] * 1000.) / ((QVAPOR[k] * 1000.) + 1.)
+			q2 = (QVAPOR[k+1] * 1000.) / ((QVAPOR[k+1] * 1000.) + 1.)
+			e_k = (((P[k]+PB[k]) / 100.) * q1) / (0.622 + (0.378 * q1))
+			e_kp1 = (((P[k+1]+PB[k+1]) / 100.) * q2) / (0.622 + (0.378 * q2))
+			ro_k = e_k / (Rv * ((T[k] + 300.) * (((P[k]+PB[k])/100000.)**(2./7.))))
+			ro_kp1 = e_kp1 / (Rv * ((T[k+1] + 300.) * (((P[k+1]+PB[k+1])/100000.)**(2./7.))))
+			h_k = (PH[k]+PHB[k])/9.81
+			h_kp1 = (PH[k+1]+PHB[k+1])/9.81
+			IWV = IWV + (((ro_k+ro_kp1) / 2.) * abs(h_kp1 - h_k))
+	return IWV
+
+
+class KernelTest(unittest.TestCase):
+
+	def setUp(self):
+		self.col = random_columns()
+		self.expected = columns.profile_physics(*physics_args(self.col))
+
+	def assertSame(self, result, expected, names=fields):
+		for name in names:
+			np.testing.assert_allclose(result[name], expected[name], rtol=1e-12, atol=1e-12, err_msg=name)
+
+	def test_numpy_fallback(self):
+		self.assertSame(kernels.profile_physics(*physics_args(self.col), use_jit=False), self.expected)
+
+	def test_python_kernel(self):
+		self.assertSame(kernels.run_kernel(*physics_args(self.col), jit=False), self.expected)
+
+	@unittest.skipUnless(kernels.have_jit, 'numba is not installed')
+	def test_jit_kernel(self):
+		self.assertSame(kernels.run_kernel(*physics_args(self.col)), self.expected)
+		self.assertSame(kernels.profile_physics(*physics_args(self.col)), self.expected)
+
+	def test_reference_iwv(self):
+		reference = np.array([reference_iwv(*[values[s] for values in physics_args(self.col)]) for s in range(len(self.col['T']))])
+		for result in (kernels.profile_physics(*physics_args(self.col)), kernels.run_kernel(*physics_args(self.col), jit=False)):
+			np.testing.assert_allclose(result['IWV'], reference, rtol=1e-12, atol=1e-12)
+
+	# The rows that process_station writes for every column.
+	# ncdf2db.py needs its modules (MySQLdb, wrf, ...); without
+	# them this test errors instead of being skipped:
+	def test_process_station(self):
+		import ncdf2db
+		n = 5
+		date = datetime.datetime(2017, 8, 29, 18)
+		prof = kernels.profile_physics(*physics_args(self.col))
+		products = columns.iwv_products(prof)
+		for s in range(n):
+			station = {'name' : 'S{}'.format(s), 'id' : s, 'senid' : 100 + s, 'source_id' : 1,
+				'long' : 25., 'latt' : 42.5, 'alt' : 500., 'i0' : 0, 'j0' : 0}
+			# As ingest_files builds the column of a station:
+			col = dict((name, prof[name][s]) for name in ('tk', 'Pair', 'hgth', 'QV'))
+			col.update((name, values[s]) for name, values in products.items())
+			col.update({'T2' : 290., 'PSFC' : 95000., 'PBLH' : 800., 'HGT' : 500.,
+				'RAINNC' : 0., 'SNOWNC' : 0., 'GRAUPELNC' : 0., 'HAILNC' : 0.})
+			block = blockhash.new_block()
+			self.assertTrue(ncdf2db.process_station(station, col, date, block))
+			rows = block['NWP_IN_3D'].rows
+			levels = np.array([row[2] for row in rows])
+			np.testing.assert_array_equal(levels, np.arange(self.col['T'].shape[1]))
+			for name, index in (('tk', 3), ('Pair', 4), ('hgth', 7), ('QV', 8)):
+				np.testing.assert_array_equal([row[index] for row in rows], prof[name][s], err_msg=name)
+			out = block['NWP_OUT']
+			for name in ('IWV', 'IWV_500_Swiss', 'IWV_500_Profile', 'IWV_Max_Height'):
+				self.assertEqual(out.rows[0][out.columns.index(name)], products[name][s])
+			self.assertAlmostEqual(out.rows[0][out.columns.index('IWV')], reference_iwv(*[values[s] for values in physics_args(self.col)]), places=9)
+
+
+if __name__ == "__main__":
+	unittest.main()
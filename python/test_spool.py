@@ -0,0 +1,183 @@
+# test_spool.py
+# Tests of the spool and its drainer (spool.py) with a stand-in
+# database (no MySQL server needed).
+#
+# Usage:
+# python -m unittest test_spool
+
+import os, shutil, tempfile
+import datetime
+import unittest
+import MySQLdb
+import spool
+
+
+# A stand-in DB connection: the rows of a batch are stored on
+# commit, fail(table, rows) returns the error raised by executemany
+# (or None). connect_errors connects fail before the first success:
+class StandinDB(object):
+
+	def __init__(self, fail=None):
+		self.fail = fail
+		self.store = []
+		self.pending = []
+		self.connects = 0
+		self.connect_errors = 0
+
+	def connect(self):
+		self.connects += 1
+		if self.connect_errors:
+			self.connect_errors -= 1
+			raise MySQLdb.OperationalError(2003, "Can't connect to MySQL server")
+		return self
+
+	def cursor(self):
+		return self
+
+	def executemany(self, sql, rows):
+		error = self.fail(sql, rows) if self.fail is not None else None
+		if error is not None:
+			raise error
+		self.pending.append((sql.split()[2], list(rows)))
+
+	def commit(self):
+		self.store.extend(self.pending)
+		self.pending = []
+
+	def rollback(self):
+		self.pending = []
+
+	def close(self):
+		pass
+
+
+def row_1d(n):
+	return (1, datetime.datetime(2017, 1, 1, n), 1., 2., 3., 4., 5., 6., 7., 8.)
+
+
+def row_out(n):
+	return (1, 2, datetime.datetime(2017, 1, 1, n), 10. + n, None, None, None)
+
+
+class DrainerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.spooldir = tempfile.mkdtemp()
+		self.sleeps = []
+
+	def tearDown(self):
+		shutil.rmtree(self.spooldir)
+
+	def drain(self, db):
+		drainer = spool.Drainer(self.spooldir, db.connect, max_backoff=4., sleep=self.sleeps.append)
+		return drainer, drainer.drain()
+
+	def test_order_per_table(self):
+		writer = spool.Spool(self.spooldir, max_segment=300)
+		for n in range(6):
+			writer.append('NWP_IN_1D', [row_1d(n)])
+			writer.append('NWP_OUT', [row_out(n)])
+		writer.close()
+		self.assertTrue(len(spool.segments(self.spooldir)) > 1)
+		db = StandinDB()
+		drainer, batches = self.drain(db)
+		self.assertEqual(batches, 12)
+		for table, row in (('NWP_IN_1D', row_1d), ('NWP_OUT', row_out)):
+			rows = [rows[0] for name, rows in db.store if name == table]
+			self.assertEqual(rows, [row(n) for n in range(6)])
+		# Nothing is sent twice:
+		drainer, batches = self.drain(db)
+		self.assertEqual(batches, 0)
+
+	def test_retry(self):
+		writer = spool.Spool(self.spooldir)
+		writer.append('NWP_OUT', [row_out(0)])
+		writer.append('NWP_OUT', [row_out(1)])
+		writer.close()
+		lost = [True]
+		def fail(sql, rows):
+			if lost[0]:
+				lost[0] = False
+				return MySQLdb.OperationalError(2006, 'MySQL server has gone away')
+		db = StandinDB(fail)
+		db.connect_errors = 2
+		drainer, batches = self.drain(db)
+		self.assertEqual(batches, 2)
+		self.assertEqual(self.sleeps, [1., 2., 4.])
+		self.assertEqual([rows[0] for name, rows in db.store], [row_out(0), row_out(1)])
+		self.assertEqual(drainer.rejected, 0)
+
+	def test_rejected(self):
+		writer = spool.Spool(self.spooldir)
+		writer.append('NWP_OUT', [row_out(0)])
+		writer.append('NWP_OUT', [row_out(1)])
+		writer.append('NWP_OUT', [row_out(2)])
+		writer.close()
+		def fail(sql, rows):
+			if rows[0] == row_out(1):
+				# A statement error that MySQLdb raises as OperationalError:
+				return MySQLdb.OperationalError(1054, "Unknown column 'IWV_Station' in 'field list'")
+		db = StandinDB(fail)
+		drainer, batches = self.drain(db)
+		self.assertEqual(batches, 3)
+		self.assertEqual(self.sleeps, [])
+		self.assertEqual([rows[0] for name, rows in db.store], [row_out(0), row_out(2)])
+		self.assertEqual(drainer.rejected, 1)
+		rejected = list(spool.read_frames(os.path.join(self.spooldir, spool.rejected_name)))
+		self.assertEqual([(table, rows) for offset, table, rows in rejected], [('NWP_OUT', [row_out(1)])])
+
+	def test_rotate_while_draining(self):
+		writer = spool.Spool(self.spooldir)
+		writer.append('NWP_OUT', [row_out(0)])
+		writer.sync()
+		# The writer finishes a frame and starts a new segment
+		# while the drainer reads the first one:
+		read_frames = spool.read_frames
+		def racing_read_frames(path, offset=0):
+			frames = list(read_frames(path, offset))
+			if not writer.batches > 1:
+				writer.append('NWP_OUT', [row_out(1)])
+				writer.rotate()
+				writer.append('NWP_OUT', [row_out(2)])
+				writer.sync()
+			return iter(frames)
+		spool.read_frames = racing_read_frames
+		try:
+			db = StandinDB()
+			drainer, batches = self.drain(db)
+		finally:
+			spool.read_frames = read_frames
+		self.assertEqual(batches, 1)
+		drainer, batches = self.drain(db)
+		writer.close()
+		self.assertEqual(batches, 2)
+		self.assertEqual([rows[0] for name, rows in db.store], [row_out(0), row_out(1), row_out(2)])
+		self.assertEqual(len(spool.segments(self.spooldir)), 1)
+
+	def test_hashes_after_rejected(self):
+		# Two files of ncdf2db.py --skip-unchanged: rows, then hashes.
+		# A row batch of the first file is rejected:
+		writer = spool.Spool(self.spooldir)
+		writer.append('NWP_OUT', [row_out(0)])
+		writer.append('NWP_OUT', [row_out(1)])
+		writer.sync()
+		def fail(sql, rows):
+			if rows[0] == row_out(1):
+				return MySQLdb.IntegrityError(1452, 'Cannot add or update a child row')
+		db = StandinDB(fail)
+		# The drainer stops (and restarts) before the hashes:
+		drainer, batches = self.drain(db)
+		self.assertEqual(batches, 2)
+		hashes = (2, 1, datetime.datetime(2017, 1, 1), b'0123456789abcdef')
+		writer.append('INGEST_HASH', [hashes])
+		writer.append('NWP_OUT', [row_out(2)])
+		writer.append('INGEST_HASH', [hashes])
+		writer.close()
+		drainer, batches = self.drain(db)
+		self.assertEqual(batches, 3)
+		self.assertEqual(drainer.dropped, 1)
+		self.assertEqual([name for name, rows in db.store], ['NWP_OUT', 'NWP_OUT', 'INGEST_HASH'])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,283 @@
+# tro2db.py
+# Ingest of SINEX_TRO files into GNSS_IN.
+#
+# The TRO files of the analysis centres (and the files of
+# ncdf2db.py -o tro / tro_export.py) are read line by line
+# (TroReader). The parameter columns of +TROP/SOLUTION are taken from
+# +TROP/DESCRIPTION (SOLUTION_FIELDS_1/2 of SINEX_TRO 0.01, TROPO
+# PARAMETER NAMES and UNITS of SINEX_TRO 2.00) or from the header line
+# of the solution block. The values are returned in SI units: the
+# delays and gradients [m] (TROTOT, TGNTOT, TGETOT and their STDDEV
+# are in mm unless TROPO PARAMETER UNITS says otherwise).
+#
+# The site codes are mapped to the sensors of the GNSS source with one
+# lookup loaded at the start (sensor_lookup). The files are read and
+# written to GNSS_IN (ZTD, Sigma_ZTD, Gradient_N, Gradient_E,
+# Sigma_Grad_N, Sigma_Grad_E [m]) by -n parallel processes, each with
+# its own connection and one commit per file.
+#
+# Usage:
+# tro2db.py -d <env> -s <gnss_source> [-n <processes>] [1] file.TRO [...]
+
+import sys, getopt
+import datetime
+import multiprocessing
+import dbwriter
+import suadadb
+
+
+# Parameters of the solution lines -> GNSS_IN columns
+# (the STDDEV column after a parameter is its sigma):
+gnss_columns = {
+	'TROTOT' : ('ZTD', 'Sigma_ZTD'),
+	'TGNTOT' : ('Gradient_N', 'Sigma_Grad_N'),
+	'TGETOT' : ('Gradient_E', 'Sigma_Grad_E')
+	}
+sigma_names = ('STDDEV', 'STDEV')
+
+# Units of the parameters when the file gives none
+# (value in the file = value in SI units * factor):
+default_units = {'TROTOT' : 1e3, 'TGNTOT' : 1e3, 'TGETOT' : 1e3, 'TRODRY' : 1e3, 'TROWET' : 1e3}
+
+# Values at or below this are missing (e.g. -999):
+missing_below = -998.
+
+
+# Define a procedure that converts a SINEX epoch
+# YY:DDD:SSSSS or YYYY:DDD:SSSSS to a datetime:
+def parse_epoch(epoch):
+	year, doy, seconds = epoch.split(':')
+	year = int(year)
+	if len(epoch.split(':')[0]) == 2:
+		year = year + (2000 if year < 50 else 1900)
+	return datetime.datetime(year, 1, 1) + datetime.timedelta(days=int(doy) - 1, seconds=int(seconds))
+
+
+# Define a procedure that gives the STDDEV columns
+# the name of the parameter before them (TROTOT_STDDEV):
+def column_names(names):
+	result = []
+	for name in names:
+		if name in sigma_names and len(result):
+			result.append(result[-1] + '_STDDEV')
+		else:
+			result.append(name)
+	return result
+
+
+# A TroReader reads one SINEX_TRO file. Iterating gives
+# (site, epoch, values) for every solution line, values is
+# a dictionary parameter -> value [SI units] (None if missing).
+# The SITE/ID lines are collected in sites (code -> fields):
+class TroReader(object):
+
+	def __init__(self, f):
+		self.f = f
+		self.names = None
+		self.units = None
+		self.sites = {}
+
+	def __iter__(self):
+		block = None
+		fields = {}
+		for line in self.f:
+			line = line.rstrip()
+			if line.startswith('+'):
+				block = line[1:].split()[0] if len(line) > 1 else None
+				continue
+			if line.startswith('-'):
+				block = None
+				continue
+			if line.startswith('%') or not line.strip():
+				continue
+
+			if block == 'TROP/DESCRIPTION' and not line.startswith('*'):
+				words = line.split()
+				if line.strip().startswith('SOLUTION_FIELDS_'):
+					fields[words[0]] = words[1:]
+				elif line.strip().startswith('TROPO PARAMETER NAMES'):
+					fields['NAMES'] = words[3:]
+				elif line.strip().startswith('TROPO PARAMETER UNITS'):
+					self.units = [float(unit) for unit in words[3:]]
+			elif block == 'SITE/ID' and not line.startswith('*'):
+				words = line.split()
+				self.sites[words[0]] = words[1:]
+			elif block == 'TROP/SOLUTION':
+				if line.startswith('*'):
+					# Header line: *SITE ____EPOCH___ names...
+					if self.names is None and not len(fields):
+						self.names = column_names(line.split()[2:])
+					continue
+				if self.names is None:
+					if 'NAMES' in fields:
+						self.names = column_names(fields['NAMES'])
+					else:
+						self.names = column_names(sum([fields[key] for key in sorted(fields) if key != 'NAMES'], []))
+				words = line.split()
+				yield words[0], parse_epoch(words[1]), self.values(words[2:])
+
+	# Convert the values of a solution line to SI units:
+	def values(self, words):
+		values = {}
+		for n, name in enumerate(self.names):
+			if n >= len(words):
+				break
+			try:
+				value = float(words[n])
+			except ValueError:
+				value = None
+			if value is None or value != value or value <= missing_below:
+				values[name] = None
+				continue
+			if self.units is not None and n < len(self.units):
+				factor = self.units[n]
+			else:
+				factor = default_units.get(name.split('_')[0], 1.)
+			values[name] = value / factor
+		return values
+
+
+# Define a procedure that returns the lookup site code -> SensorID
+# of the sensors of the GNSS source (by station name, by its first
+# four characters, the site code of the analysis centres, and by its
+# first nine characters, the site name of ncdf2db.py -o tro and
+# tro_export.py). Shortened names are used only if they are unique:
+def sensor_lookup(cur, source_id):
+	cur.execute("select sen.ID, st.Name from SENSOR as sen \
+		join STATION as st on st.ID = sen.StationID \
+		where sen.SourceID = %s", [source_id])
+	lookup = {}
+	codes = {}
+	for sensorId, name in cur.fetchall():
+		lookup[name.upper()] = sensorId
+		for length in (4, 9):
+			codes.setdefault(name[:length].upper(), set()).add(sensorId)
+	for code, sensors in codes.items():
+		if len(sensors) == 1 and not code in lookup:
+			lookup[code] = list(sensors)[0]
+	return lookup
+
+
+# Define a procedure that reads a TRO file and builds the GNSS_IN
+# rows of the sites in lookup. Returns (rows, unknown site codes):
+def read_gnss_rows(filename, lookup):
+	rows = []
+	unknown = set()
+	with open(filename) as f:
+		for site, epoch, values in TroReader(f):
+			sensorId = lookup.get(site.upper())
+			if sensorId is None:
+				unknown.add(site)
+				continue
+			if values.get('TROTOT') is None:
+				continue
+			row = {'SensorID' : sensorId, 'Datetime' : epoch}
+			for name, (column, sigma) in gnss_columns.items():
+				row[column] = values.get(name)
+				row[sigma] = values.get(name + '_STDDEV')
+			rows.append(row)
+	return rows, unknown
+
+
+# Worker processes: a connection each and the sensor lookup.
+_worker = {}
+
+def init_worker(env, lookup):
+	_worker['db'] = suadadb.connect(env)
+	_worker['lookup'] = lookup
+
+
+# Define a procedure that ingests one file (in a worker).
+# Returns (filename, rows written, unknown sites, error):
+def ingest_file(filename):
+	db = _worker['db']
+	try:
+		rows, unknown = read_gnss_rows(filename, _worker['lookup'])
+		columns, keys = dbwriter.tables['GNSS_IN']
+		cur = db.cursor()
+		try:
+			dbwriter.upsert_many(cur, 'GNSS_IN', columns, keys, [[row[column] for column in columns] for row in rows])
+			db.commit()
+		finally:
+			cur.close()
+		return filename, len(rows), sorted(unknown), None
+	except Exception as e:
+		try:
+			db.rollback()
+		except Exception:
+			pass
+		return filename, 0, [], repr(e)
+
+
+def usage():
+	print('tro2db.py -d <env> -s <gnss_source> -n <processes> [1] file.TRO [...]')
+
+
+def main(argv):
+	env = ''
+	source_name = ''
+	nproc = 1
+	try:
+		opts, args = getopt.getopt(argv, "hd:s:n:", ["env=", "source_name=", "processes="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-d", "--env"):
+			env = arg
+		elif opt in ("-s", "--source_name"):
+			source_name = arg
+		elif opt in ("-n", "--processes"):
+			nproc = int(arg)
+
+	if env == '' or source_name == '' or not len(args):
+		print('Error: You must specify the database, the GNSS source and the files! (-d <env> -s <gnss_source> file.TRO ...)')
+		sys.exit(2)
+
+	try:
+		db = suadadb.connect(env)
+		cur = db.cursor()
+	except Exception as e:
+		print('Failed to establish connection: {0}'.format(e))
+		sys.exit(1)
+	source_id = suadadb.get_source_ids(cur, [source_name]).get(source_name, -1)
+	if source_id < 0:
+		print('Error: Can not find source_id for source_name: {}'.format(source_name))
+		sys.exit(1)
+	lookup = sensor_lookup(cur, source_id)
+	cur.close()
+	db.close()
+	print('{} sensors of source {}'.format(len(lookup), source_name))
+
+	files = sorted(args)
+	if nproc > 1:
+		pool = multiprocessing.Pool(nproc, init_worker, (env, lookup))
+		results = pool.imap_unordered(ingest_file, files)
+	else:
+		init_worker(env, lookup)
+		results = (ingest_file(filename) for filename in files)
+
+	total = 0
+	failed = 0
+	unknown = set()
+	for filename, rows, sites, error in results:
+		if error is not None:
+			sys.stderr.write('Error occured in {file}: {error}\n'.format(file = filename, error = error))
+			failed += 1
+			continue
+		total += rows
+		unknown.update(sites)
+	if nproc > 1:
+		pool.close()
+		pool.join()
+	if len(unknown):
+		print('Sites without a sensor of {}: {}'.format(source_name, ' '.join(sorted(unknown))))
+	print('{} rows from {} files written to GNSS_IN ({} failed)'.format(total, len(files) - failed, failed))
+	if failed:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,234 @@
+# tro_export.py
+# TROPOSINEX export of the model values stored in the database.
+#
+# ncdf2db.py -o tro needs the model files. The values of the
+# TROPOSINEX files are already in NWP_OUT (IWV) and NWP_IN_1D
+# (pressure, temperature, ZHD), so past periods are exported from the
+# database instead: the joined rows of the source and period are read
+# in time order with an unbuffered server-side cursor (SSCursor) and
+# written with the tro_write_* procedures of ncdf2db.py, one file per
+# day (-g day) or per epoch (-g epoch). Only the rows of one fetch
+# and the station names of the current file are kept in memory; the
+# solution lines are collected in a temporary file until the SITE/ID
+# block of the file is known.
+#
+# NWP_IN_1D has no specific humidity, HUMSPC is written as tro_missing.
+#
+# Usage:
+# tro_export.py -d <env> -s <source_name> -f <from> -t <to>
+#	[-g <period>] [day] [-c <country>] [All] [-w <outdir>] [./]
+
+import sys, os, getopt
+import datetime
+import shutil
+import tempfile
+import MySQLdb.cursors
+import columns
+import ncdf2db
+import suadadb
+
+
+# Possible options for -g <period> and the
+# period field of the file names:
+periods = {'day' : '01D', 'epoch' : '00U'}
+
+# Written for the values not stored in the database:
+tro_missing = -999.
+
+# Rows read from the server-side cursor at a time:
+fetch_size = 2000
+instrument_name = 'GNSS'
+
+
+# Define a procedure that returns the date strings
+# of an epoch (as in ncdf2db.process_station_tro):
+def epoch_strings(date):
+	tt = date.timetuple()
+	return {
+		'YYYY_st'  : str(tt.tm_year),
+		'DOY_st'   : '{:03d}'.format(tt.tm_yday),
+		'SSSSS_st' : '{:05d}'.format(tt.tm_hour * 60 * 60),
+		'HH_st'    : '{:02d}'.format(tt.tm_hour),
+		'MM_st'    : '{:02d}'.format(tt.tm_min)
+		}
+
+
+# Define a procedure that builds the dictionary of
+# ncdf2db.process_station_tro from the stored values:
+# IWV [kg/m^2], press [hPa], temp [C], zhd [m]:
+def tro_record(station, date, IWV, press, temp, zhd):
+	Tm = columns.mean_temperature(temp + columns.t_kelvin)
+	ZWD = columns.zwd(IWV, Tm)
+	record = {
+		'station_name' : station['name'],
+		'long'         : station['long'],
+		'latt'         : station['latt'],
+		'alt'          : station['alt'],
+		'IWV'          : IWV,
+		'press'        : press,
+		'Q2_humi'      : tro_missing,
+		'temp'         : temp,
+		'Tm'           : Tm,
+		'zhd_mm'       : zhd*1000.,
+		'ZTD_mm'       : (zhd + ZWD)*1000.,
+		'ZWD_mm'       : ZWD*1000.
+		}
+	record.update(epoch_strings(date))
+	return record
+
+
+# A TroFile writes one TROPOSINEX file from records
+# added in time order. The solution lines wait in a
+# temporary file until close writes the SITE/ID block:
+class TroFile(object):
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.solutions = tempfile.TemporaryFile(mode='w+')
+		self.sites = []
+		self.names = set()
+		self.records = 0
+
+	def add(self, record):
+		if not record['station_name'] in self.names:
+			self.names.add(record['station_name'])
+			self.sites.append(dict((key, record[key]) for key in ('station_name', 'long', 'latt', 'alt')))
+		ncdf2db.tro_write_solution(self.solutions, record)
+		self.records += 1
+
+	def close(self):
+		self.solutions.seek(0)
+		with open(self.filename + '.tmp', 'w') as troposinex:
+			ncdf2db.tro_write_header(troposinex)
+			for site in self.sites:
+				ncdf2db.tro_write_site(troposinex, site)
+			ncdf2db.tro_write_solution_header(troposinex)
+			shutil.copyfileobj(self.solutions, troposinex)
+			ncdf2db.tro_write_footer(troposinex)
+		self.solutions.close()
+		os.rename(self.filename + '.tmp', self.filename)
+
+
+# Define a procedure that streams the IWV (NWP_OUT) and the
+# surface values (NWP_IN_1D) of the source between date_from and
+# date_to through the server-side cursor sscur and writes one
+# TROPOSINEX file per period. stations is a dictionary
+# StationID -> station (ncdf2db.getstations). Returns the file names:
+def export(sscur, stations, source_id, date_from, date_to, period='day', outdir='./'):
+	cond, params = suadadb.in_condition('o.StationID', list(stations.keys()))
+	sscur.execute("select o.StationID, o.Datetime, o.IWV, i.Pressure, i.Temperature, i.ZHD \
+		from NWP_OUT as o \
+		join SENSOR as sen on sen.StationID = o.StationID and sen.SourceID = o.SourceModID \
+		join NWP_IN_1D as i on i.SensorID = sen.ID and i.Datetime = o.Datetime \
+		where o.SourceModID = %s and o.Datetime >= %s and o.Datetime < %s" + cond + " \
+		order by o.Datetime, o.StationID", [source_id, date_from, date_to] + params)
+
+	files = []
+	group = None
+	out = None
+	while True:
+		rows = sscur.fetchmany(fetch_size)
+		if not rows:
+			break
+		for stationId, date, IWV, press, temp, zhd in rows:
+			if None in (IWV, press, temp, zhd):
+				continue
+			record = tro_record(stations[stationId], date, IWV, press, temp, zhd)
+			key = date.date() if period == 'day' else date
+			if key != group:
+				if out is not None:
+					out.close()
+					print('Written: {} ({} epochs)'.format(out.filename, out.records))
+				filename = ncdf2db.tro_filename(record['YYYY_st'], record['DOY_st'],
+					'00' if period == 'day' else record['HH_st'],
+					'00' if period == 'day' else record['MM_st'], periods[period])
+				out = TroFile(os.path.join(outdir, filename))
+				files.append(out.filename)
+				group = key
+			out.add(record)
+	if out is not None:
+		out.close()
+		print('Written: {} ({} epochs)'.format(out.filename, out.records))
+	return files
+
+
+def usage():
+	print('tro_export.py -d <env> -s <source_name> -f <from> -t <to> -g <period> [day] -c <country> [All] -w <outdir> [./]')
+
+
+def main(argv):
+	# -d <env> - database ('dev' or 'prod'),
+	# -s <source_name> - model source,
+	# -f <from>, -t <to> - exported period (YYYY-MM-DD),
+	# -g <period> - one file per 'day' or per 'epoch',
+	# -c <country> - export the stations of one country only,
+	# -w <outdir> - directory of the TROPOSINEX files.
+	env = ''
+	source_name = ''
+	date_from = None
+	date_to = None
+	period = 'day'
+	country = 'All'
+	outdir = './'
+
+	try:
+		opts, args = getopt.getopt(argv, "hd:s:f:t:g:c:w:", ["env=", "source_name=", "from=", "to=", "period=", "country=", "outdir="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-d", "--env"):
+			env = arg
+		elif opt in ("-s", "--source_name"):
+			source_name = arg
+		elif opt in ("-f", "--from"):
+			date_from = datetime.datetime.strptime(arg, '%Y-%m-%d')
+		elif opt in ("-t", "--to"):
+			date_to = datetime.datetime.strptime(arg, '%Y-%m-%d') + datetime.timedelta(days=1)
+		elif opt in ("-g", "--period"):
+			period = arg
+		elif opt in ("-c", "--country"):
+			country = arg
+		elif opt in ("-w", "--outdir"):
+			outdir = arg
+
+	if env == '' or source_name == '' or date_from is None or date_to is None:
+		print('Error: You must specify the database, the source and the period! (-d <env> -s <source_name> -f <from> -t <to>)')
+		sys.exit(2)
+	if not period in periods:
+		print('Error: Not a possible period {}'.format(period))
+		sys.exit(2)
+	if not os.path.isdir(outdir):
+		os.makedirs(outdir)
+
+	try:
+		db = suadadb.connect(env)
+		cur = db.cursor()
+		# A second connection for the unbuffered stream:
+		sdb = suadadb.connect(env, cursorclass=MySQLdb.cursors.SSCursor)
+		sscur = sdb.cursor()
+	except Exception as e:
+		print('Failed to establish connection: {0}'.format(e))
+		sys.exit(1)
+
+	source_id = ncdf2db.get_source_id(cur, source_name)
+	if source_id < 0:
+		print('Error: Can not find source_id for source_name: {}'.format(source_name))
+		sys.exit(1)
+	stations = ncdf2db.getstations(cur, source_name, country, instrument_name)
+	stations = dict((station['id'], station) for station in stations if (country == 'All') or (country == station['country']))
+	print('{} stations of source {}'.format(len(stations), source_name))
+
+	files = export(sscur, stations, source_id, date_from, date_to, period, outdir)
+	print('{} TROPOSINEX files written'.format(len(files)))
+
+	sscur.close()
+	sdb.close()
+	cur.close()
+	db.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
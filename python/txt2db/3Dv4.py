@@ -1,114 +1,183 @@
 #!/usr/bin/python
 
-import sys, datetime, getopt, MySQLdb, math
+import sys, os, datetime, getopt, MySQLdb
+import numpy as np
 #from datetime import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import profiles
 
 
-def values2db(vLine,tStart):
-  datalist = []
-  vData = vLine.split()
-  for i, val in enumerate(vData):
-    vTime = tStart + datetime.timedelta(hours=0,seconds=i*1800)
-    datalist.append((vTime, val))
-  return datalist
-    #print vTime, val
+# Field headers of a station block -> field name.
+# Every header is followed by one line per model level,
+# each with one value every 30 minutes from the start time.
+sections = {
+  "Temperature (K)"                    : 'tk',
+  "Model pressure [hPa]"               : 'pressure',
+  "Model height [km]"                  : 'height',
+  "Water vapor mixing ratio [kg kg-1]" : 'qvapor'
+}
 
+# Source of the model sensors in SENSOR:
+sourceId = 71
+
+# Number of NWP_IN_3D rows sent with one executemany:
+batchSize = 10000
+
+insert_3d = "insert into NWP_IN_3D (Datetime, Temperature, Pressure, SensorID, Latitude, Longitude, Height, WV_Mixing_ratio, Level)\
+  values (%s, %s, %s, %s, %s, %s, %s, %s, %s) on duplicate key update\
+  Temperature = values(Temperature),\
+  Pressure = values(Pressure),\
+  Latitude = values(Latitude),\
+  Longitude = values(Longitude),\
+  Height = values(Height),\
+  WV_Mixing_ratio = values(WV_Mixing_ratio),\
+  Level = values(Level)"
+
+
+# Load the station -> SensorID mapping with one query
+def station_sensors(cur):
+  mapping = {}
+  cur.execute("select ss.StationID, ss.ID from SENSOR ss where ss.SourceID = %s", [sourceId])
+  for row in cur.fetchall():
+    mapping[str(row[0])] = row[1]
+  return mapping
+
+
+# Read the GrADS profile dump once.
+# Returns the list of station blocks (name, stationId, latt, long)
+# and for each field a (station, level, time) array.
+def parse_profiles(f):
+  stations = []
+  blocks = []
+  station = None
+  block = {}
+  rows = None
+  for line in f:
+    header = line.strip()
+    if header.startswith("Station:"):
+      values = header.split()
+      station = (values[1], values[4], values[2], values[3])
+      block = {}
+      rows = None
+    elif header == "End":
+      if station is not None:
+        stations.append(station)
+        blocks.append(block)
+      station = None
+      rows = None
+    elif header in sections:
+      rows = []
+      block[sections[header]] = rows
+    elif header and rows is not None:
+      rows.append(header.split())
+
+  # Keep the complete blocks with the most common shape
+  fields = sorted(sections.values())
+  shapes = {}
+  for n, block in enumerate(blocks):
+    try:
+      arrays = [np.array(block[name], dtype=float) for name in fields]
+    except (KeyError, ValueError):
+      print 'Error occured. Incomplete block for station ', stations[n][0]
+      continue
+    if len(set(a.shape for a in arrays)) != 1 or arrays[0].ndim != 2:
+      print 'Error occured. Inconsistent levels for station ', stations[n][0]
+      continue
+    shapes.setdefault(arrays[0].shape, []).append((stations[n], arrays))
+  if not len(shapes):
+    return [], {}
+  shape = max(shapes, key=lambda s: len(shapes[s]))
+  for other in shapes:
+    if other != shape:
+      for st, arrays in shapes[other]:
+        print 'Error occured. Levels/steps ', other, ' differ from ', shape, ' for station ', st[0]
+  good = shapes[shape]
+  data = {}
+  for i, name in enumerate(fields):
+    data[name] = np.array([arrays[i] for st, arrays in good])
+  return [st for st, arrays in good], data
 
 
 def main(argv):
   inputfile = 'zLevels4stat.txt'
+  # levels: 'rows' (NWP_IN_3D), 'packed' (NWP_IN_3D_PACKED) or 'both'
+  levels = 'rows'
   try:
-    opts, args = getopt.getopt(argv,"hi:",["ifile="])
+    opts, args = getopt.getopt(argv,"hi:l:",["ifile=","levels="])
   except getopt.GetoptError:
-    print 'Usage: test.py -i <inputfile>'
+    print 'Usage: test.py -i <inputfile> -l <levels>'
     sys.exit(2)
   for opt, arg in opts:
     if opt == '-h':
-      print 'test.py -i <inputfile>'
+      print 'test.py -i <inputfile> -l <levels> [rows|packed|both]'
       sys.exit()
     elif opt in ("-i", "--ifile"):
       inputfile = arg
+    elif opt in ("-l", "--levels"):
+      levels = arg
     else:
-      print 'Wrong parameters, usage: test.py -i <inputfile>'
+      print 'Wrong parameters, usage: test.py -i <inputfile> -l <levels>'
       sys.exit(2)
+  if not levels in profiles.level_layouts:
+    print 'Wrong levels layout ', levels, ', possible options are rows, packed and both'
+    sys.exit(2)
 
   try:
     f = open(inputfile)
-    content = f.readlines()
-    if len(content) > 0:
-      firstLine = content[0]
-      words = firstLine.split()
-      startTime = words[4]
-      print 'startTime: ',startTime
-      timeStart = datetime.datetime.strptime(startTime, '%Y%m%d%H%M')
-      startTime = words[7]
-      recordCnt = words[11]
-
-	#create DB connection
-      db = MySQLdb.connect(host="10.1.1.220", user="meteo", passwd="xxxxxx", db="suada_4")
-      cur = db.cursor()
-
-      stationSourceId = -1
-      count1 = 0
-      while (count1 < 44):
-        count1 = count1 + 1
-        for index, line in enumerate(content):
-          if line.find("Station:") > -1:
-            values = line.split()
-            stationName = values[1]
-            stationLatt = values[2]
-            stationLong = values[3]
-            stationId   = values[4]
-	    cur.execute("select ss.ID from SENSOR ss left join SOURCE src " +\
-                "on src.ID = ss.SourceID left join STATION stn " +\
-                "on stn.ID = ss.StationID where stn.ID = %s and src.ID = %s", [stationId,71])
-	    rows =  cur.fetchall()
-	    if len(rows):
-              for row in rows:
-		stationSourceId = row[0]
-              print 'Station: ', stationName, ' ID: ', stationId, ' stationSourceId: ', stationSourceId
-	    else:
-	      stationSourceId = -1
-              print 'Error occured. I can\'t find stationSourceId for station ', stationName, ' ID: ', stationId
-	  if (line.find("Temperature (K)") > -1) & (stationSourceId > -1) :
-                 data = content[index+count1]
-                 tempmlst = values2db(data,timeStart)
-	  if (line.find("Water vapor mixing ratio [kg kg-1]") > -1) & (stationSourceId > -1) :
-		 data = content[index+count1]
-		 wvmrlst  = values2db(data,timeStart)
-                # count1 = count1 + 1
-	  if (line.find("Model height [km]") > -1) & (stationSourceId > -1) :
-                 data = content[index+count1]
-                 hgtlst = values2db(data,timeStart)
-	  if (line.find("Model pressure [hPa]") > -1) & (stationSourceId > -1) :
-                 data = content[index+count1]
-                 pressure2lst = values2db(data,timeStart)
- 	  if (line.find("End") > -1) & (stationSourceId > -1) :
-		for i, tup in enumerate(pressure2lst):
-		  tk = float(tempmlst[i][1])
-		  Press3D  = float(pressure2lst[i][1])
-		  height = float(hgtlst[i][1])
-		  QVAPOR = float(wvmrlst[i][1])
-		  DateTime = pressure2lst[i][0].strftime('%Y-%m-%d %H:%M:%S')
-		  Level = float(count1)
-		  cur.execute ( "insert into NWP_IN_3D (Datetime, Temperature, Pressure, SensorID, Latitude, Longitude, Height, WV_Mixing_ratio, Level)\
-	                   	values (%s, %s, %s, %s, %s, %s, %s, %s, %s) on duplicate key update\
-				Temperature = %s,\
-				Pressure = %s,\
-			   	Latitude = %s,\
-			   	Longitude = %s,\
-				Height = %s,\
-				WV_Mixing_ratio = %s,\
-				Level = %s", [DateTime, tk, Press3D, stationSourceId, stationLatt, stationLong, height, QVAPOR, Level, tk, Press3D, stationLatt, stationLong, height, QVAPOR, Level]) #insert or update
-		  db.commit()		  
-    else:
-        print 'Input file seems empty'
-        sys.exit(2)
+    firstLine = f.readline()
+    if not firstLine:
+      print 'Input file seems empty'
+      sys.exit(2)
+    words = firstLine.split()
+    startTime = words[4]
+    print 'startTime: ',startTime
+    timeStart = datetime.datetime.strptime(startTime, '%Y%m%d%H%M')
+
+    stations, data = parse_profiles(f)
+    f.close()
+    if not len(stations):
+      print 'No station profiles found in ', inputfile
+      sys.exit(2)
+    nstations, nlevels, nsteps = data['tk'].shape
+    print 'Stations: ', nstations, ' levels: ', nlevels, ' steps: ', nsteps
 
+    #create DB connection
+    db = MySQLdb.connect(host="10.1.1.220", user="meteo", passwd="xxxxxx", db="suada_4")
+    cur = db.cursor()
+    sensors = station_sensors(cur)
 
+    DateTimes = [(timeStart + datetime.timedelta(hours=0,seconds=i*1800)).strftime('%Y-%m-%d %H:%M:%S') for i in range(nsteps)]
+    rows = []
+    packed = []
+    for s, (stationName, stationId, stationLatt, stationLong) in enumerate(stations):
+      stationSourceId = sensors.get(stationId, -1)
+      if stationSourceId < 0:
+        print 'Error occured. I can\'t find stationSourceId for station ', stationName, ' ID: ', stationId
+        continue
+      print 'Station: ', stationName, ' ID: ', stationId, ' stationSourceId: ', stationSourceId
+      tk = data['tk'][s]
+      Press3D = data['pressure'][s]
+      height = data['height'][s]
+      QVAPOR = data['qvapor'][s]
+      if levels in ('rows', 'both'):
+        for k in range(nlevels):
+          for i in range(nsteps):
+            rows.append((DateTimes[i], float(tk[k, i]), float(Press3D[k, i]), stationSourceId, stationLatt, stationLong, float(height[k, i]), float(QVAPOR[k, i]), float(k + 1)))
+          if len(rows) >= batchSize:
+            cur.executemany(insert_3d, rows)
+            db.commit()
+            rows = []
+      if levels in ('packed', 'both'):
+        for i in range(nsteps):
+          packed.append(profiles.packed_row(stationSourceId, DateTimes[i], stationLatt, stationLong,
+                tk[:, i], Press3D[:, i], height[:, i], QVAPOR[:, i]))
+    if len(rows):
+      cur.executemany(insert_3d, rows)
+    profiles.write_packed_profiles(cur, packed)
+    db.commit()
 
   except IOError:
-    print 'File ',inputname,' not found !!!'
+    print 'File ',inputfile,' not found !!!'
 
 
 if __name__ == "__main__":
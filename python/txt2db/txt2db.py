@@ -1,18 +1,79 @@
 #!/usr/bin/python
 
-import sys, datetime, getopt, MySQLdb, math
+import sys, datetime, getopt, MySQLdb
+import numpy as np
 #from datetime import datetime
 
 
-def values2db(vLine,tStart):
-  datalist = []
-  vData = vLine.split()
-  for i, val in enumerate(vData):
-    vTime = tStart + datetime.timedelta(hours=2,seconds=i*1800)
-    datalist.append((vTime, val))
-  return datalist
-    #print vTime, val
-
+# Section headers of a station block -> field name.
+# The line after a header holds the values of the field
+# (one value every 30 minutes from the start time).
+sections = {
+  "Surface Temperature [K]"     : 'temp',
+  "Pressure [Pa]"               : 'pressure',
+  "Rain total [mm]"             : 'rain',
+  "Vapor at 2 m [kg kg-1]"      : 'vapor',
+  "Cloud fraction [-]"          : 'cloud',
+  "Wind X [m / s]"              : 'windU',
+  "Wind Y [m / s]"              : 'windV',
+  "Relative Humidity at 2m (%)" : 'humid',
+  "Total cloud fraction [-]"    : 'tcld'
+}
+
+# Fields needed to write a station block:
+required = ('temp', 'pressure', 'rain', 'windU', 'windV', 'humid', 'tcld')
+
+# Source of the SYNOP stations in STATION_SOURCE:
+sourceId = 7
+
+insert_synop = "insert into SYNOP (Datetime, Pressure, Temperature, Humidity, Station_SourceID, Cloud, Wind_Dir, Wind_Speed, Precipitation_1h,Precipitation_3h)\
+  values (%s, %s, %s, %s, %s,  %s,  %s,  %s,  %s, %s) on duplicate key update\
+  Pressure    = values(Pressure),\
+  Temperature = values(Temperature),\
+  Humidity    = values(Humidity),\
+  Cloud       = values(Cloud),\
+  Wind_Dir    = values(Wind_Dir),\
+  Wind_Speed  = values(Wind_Speed),\
+  Precipitation_1h = values(Precipitation_1h),\
+  Precipitation_3h = values(Precipitation_3h)"
+
+
+# Load the station -> Station_SourceID mapping with one query
+def station_sources(cur):
+  mapping = {}
+  cur.execute("select ss.StationID, ss.ID from STATION_SOURCE ss where ss.SourceID = %s", [sourceId])
+  for row in cur.fetchall():
+    mapping[str(row[0])] = row[1]
+  return mapping
+
+
+# Compute the SYNOP rows of one station block.
+# fields holds the value arrays of the block (see sections).
+def synop_rows(fields, stationSourceId, timeStart):
+  count = min(len(fields[name]) for name in required)
+  T2    = fields['temp'][:count]
+  PSCF  = fields['pressure'][:count]
+  rain  = fields['rain'][:count]
+  windU = fields['windU'][:count]
+  windV = fields['windV'][:count]
+
+  Temp  = T2 - 273.15
+  Press = PSCF / 100
+  # Rain over the last 1h (2 steps) and 3h (6 steps)
+  Rain1h = np.zeros(count)
+  Rain1h[2:] = rain[2:] - rain[:-2]
+  Rain3h = np.zeros(count)
+  Rain3h[6:] = rain[6:] - rain[:-6]
+  Humid = fields['humid'][:count] / 100
+  Cloud = fields['tcld'][:count]
+  WindS = np.sqrt(windU**2 + windV**2)**1.89
+  WindD = 57.2957795*np.arctan2(windU, windV)+180
+
+  rows = []
+  for i in range(count):
+    DateTime = (timeStart + datetime.timedelta(hours=2,seconds=i*1800)).strftime('%Y-%m-%d %H:%M:%S')
+    rows.append((DateTime, float(Press[i]), float(Temp[i]), float(Humid[i]), stationSourceId, float(Cloud[i]), float(WindD[i]), float(WindS[i]), float(Rain1h[i]), float(Rain3h[i])))
+  return rows
 
 
 def main(argv):
@@ -33,128 +94,60 @@ def main(argv):
       sys.exit(2)
 
   try:
-      f = open(inputfile)
-      content = f.readlines()
-      if len(content) > 0:
-        firstLine = content[0]
-        words = firstLine.split()
-        startTime = words[4]
-        print 'startTime: ',startTime
-        timeStart = datetime.datetime.strptime(startTime, '%Y%m%d%H%M')
-        startTime = words[7]
-        recordCnt = words[11]
-
-	#create DB connection
-	db = MySQLdb.connect(host="cn001", user="meteo", passwd="xxxxxx", db="meteodb")
-	cur = db.cursor()
-
-	stationSourceId = -1
-        for index, line in enumerate(content):
-#        for line in content:
-#	  stationSourceId = -1
-          if line.find("Station:") > -1:
-            values = line.split()
-            stationName = values[1]
-            stationLong = values[2]
-            stationLatt = values[3]
-            stationId   = values[4]
-	    cur.execute("select ss.ID from STATION_SOURCE ss left join SOURCE src " +\
-                "on src.ID = ss.SourceID left join STATION stn " +\
-                "on stn.ID = ss.StationID where stn.ID = %s and src.ID = %s", [stationId,7])
-	    rows =  cur.fetchall()
-	    if len(rows):
-              for row in rows:
-		stationSourceId = row[0]
-              print 'Station: ', stationName, ' ID: ', stationId, ' stationSourceId: ', stationSourceId
-	    else:
-	      stationSourceId = -1
-              print 'Error occured. I can\'t find stationSourceId for station ', stationName, ' ID: ', stationId
-          if (line.find("Surface Temperature [K]") > -1) & (stationSourceId > -1) :
-                data = content[index+1]
-                templst = values2db(data,timeStart)
-	  if (line.find("Pressure [Pa]") > -1) & (stationSourceId > -1) :
-                data = content[index+1]
-                pressurelst = values2db(data,timeStart)
-	  if (line.find("Rain total [mm]") > -1) & (stationSourceId > -1) :
-                data = content[index+1]
-                rainlst = values2db(data,timeStart)
-	  if (line.find("Vapor at 2 m [kg kg-1]") > -1) & (stationSourceId > -1) :
-                data = content[index+1]
-                vaporlst = values2db(data,timeStart)
-	  if (line.find("Cloud fraction [-]") > -1) & (stationSourceId > -1) :
-                data = content[index+1]
-                cloudlst = values2db(data,timeStart)
-	  if (line.find("Wind X [m / s]") > -1) & (stationSourceId > -1) :
-                data = content[index+1]
-                windUlst = values2db(data,timeStart)
-	  if (line.find("Wind Y [m / s]") > -1) & (stationSourceId > -1) :
-                data = content[index+1]
-                windVlst = values2db(data,timeStart)
-	  if (line.find("Relative Humidity at 2m (%)") > -1) & (stationSourceId > -1) :
-		data = content[index+1]
-		humidlst = values2db(data,timeStart)
-	  if (line.find("Total cloud fraction [-]") > -1) & (stationSourceId > -1) :
-		data = content[index+1]
-		tcldlst  = values2db(data,timeStart)
-	  if (line.find("End") > -1) & (stationSourceId > -1) :
-		for i, tup in enumerate(templst):
-		  T2 = float(templst[i][1])
-		  Temp  = T2 - 273.15
-		  PSCF  = float(pressurelst[i][1])
-		  Press = PSCF / 100
-		  if ( i > 1) :
-		    Rain1h = float(rainlst[i][1]) - float(rainlst[i-2][1])
-	          else :
-                    Rain1h = 0.0
-		  if ( i > 5) :
-                    Rain3h = float(rainlst[i][1]) - float(rainlst[i-6][1])
-                  else :
-                    Rain3h = 0.0
-		  Q2    = float(vaporlst[i][1])
-		  PQ0   = 379.90516
-		  A2    = 17.2693882
-		  A3    = 273.16
-		  A4    = 35.86
-#		  Humid = Q2 / ( (PQ0 / PSCF) * math.exp(A2 * (T2 - A3) / (T2 - A4))  )
-		  Humid = float(humidlst[i][1])/100
-		  Vapor = Q2
-		  Cloud = float(tcldlst[i][1])
-		  WindS = math.sqrt(float(windUlst[i][1])**2+float(windVlst[i][1])**2)**1.89
-		  WindD = 57.2957795*math.atan2(float(windUlst[i][1]),float(windVlst[i][1]))+180
-	  	  DateTime = templst[i][0].strftime('%Y-%m-%d %H:%M:%S')
-#		  print DateTime, Temp, Press, Rain1h, Rain3h, Vapor, Humid, Cloud, WindS, WindD 
-		  #Prepare SQL statement
-		  cur.execute ( "insert into SYNOP (Datetime, Pressure, Temperature, Humidity, Station_SourceID, Cloud, Wind_Dir, Wind_Speed, Precipitation_1h,Precipitation_3h)\
-	                   	values (%s, %s, %s, %s, %s,  %s,  %s,  %s,  %s, %s) on duplicate key update\
-			   	Pressure    = %s,\
-			   	Temperature = %s,\
-			   	Humidity    = %s,\
-			   	Cloud       = %s,\
-			   	Wind_Dir    = %s,\
-			   	Wind_Speed =  %s,\
-			   	Precipitation_1h = %s,\
-				Precipitation_3h = %s", [DateTime, Press, Temp, Humid, stationSourceId, Cloud, WindD, WindS, Rain1h, Rain3h, Press, Temp, Humid, Cloud, WindD, WindS, Rain1h, Rain3h])
-		  db.commit()	  
-      else:
-        print 'Input file seems empty'
-        sys.exit(2)
-
-     
+    f = open(inputfile)
+    firstLine = f.readline()
+    if not firstLine:
+      print 'Input file seems empty'
+      sys.exit(2)
+    words = firstLine.split()
+    startTime = words[4]
+    print 'startTime: ',startTime
+    timeStart = datetime.datetime.strptime(startTime, '%Y%m%d%H%M')
+
+    #create DB connection
+    db = MySQLdb.connect(host="cn001", user="meteo", passwd="xxxxxx", db="meteodb")
+    cur = db.cursor()
+    stationSources = station_sources(cur)
+
+    # Stream through the file: a header line selects the
+    # field, the next line holds its values. The block of
+    # a station is written at once when "End" is reached.
+    stationSourceId = -1
+    fields = {}
+    field = None
+    for line in f:
+      if field is not None:
+        fields[field] = np.array(line.split(), dtype=float)
+        field = None
+        continue
+      header = line.strip()
+      if header.startswith("Station:"):
+        values = header.split()
+        stationName = values[1]
+        stationId   = values[4]
+        fields = {}
+        stationSourceId = stationSources.get(stationId, -1)
+        if stationSourceId > -1:
+          print 'Station: ', stationName, ' ID: ', stationId, ' stationSourceId: ', stationSourceId
+        else:
+          print 'Error occured. I can\'t find stationSourceId for station ', stationName, ' ID: ', stationId
+      elif header == "End":
+        if stationSourceId > -1:
+          missing = [name for name in required if not name in fields]
+          if len(missing):
+            print 'Error occured. Missing ', ', '.join(missing), ' for station ', stationName
+          else:
+            cur.executemany(insert_synop, synop_rows(fields, stationSourceId, timeStart))
+            db.commit()
+        stationSourceId = -1
+        fields = {}
+      elif stationSourceId > -1:
+        field = sections.get(header)
+    f.close()
 
   except IOError:
-    print 'File ',inputname,' not found !!!'
+    print 'File ',inputfile,' not found !!!'
 
 
 if __name__ == "__main__":
    main(sys.argv[1:])
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,282 @@
+# webcache.py
+# Static time-series files for the SUADA website.
+#
+# The station plots of the website query NWP_OUT and GNSS_OUT for
+# every page view. webcache.py writes the series instead as static
+# files, one chunk per source, station and month, that the web server
+# returns without a database query:
+#
+# <outdir>/index.json                          - the exported sources
+# <outdir>/<kind>/<source>/index.json          - stations and months
+# <outdir>/<kind>/<source>/<station>/summary.json - monthly statistics
+# <outdir>/<kind>/<source>/<station>/<YYYY-MM>.json
+# <outdir>/<kind>/<source>/<station>/<YYYY-MM>.bin
+#
+# kind 'nwp' is NWP_OUT (-s <source>), kind 'gnss' is GNSS_OUT
+# (-g <gnss_source>, one value per epoch, the lowest SourceMetID).
+# A chunk has the epochs t [s since 1970 UTC] and a list per column
+# (null if missing). The .bin file has the same values: magic 'SWC1',
+# number of epochs and of columns (little-endian uint32), then t as
+# uint32 and every column as float32 (NaN if missing).
+#
+# A run reads max(Timestamp) and count(*) of every chunk with one
+# grouped query per source and rewrites only the chunks that differ
+# from the last run (webcache.state); chunks without rows are removed.
+#
+# Usage:
+# webcache.py -d <env> -w <outdir> [-s <source_name>[,...]] [-g <gnss_source>[,...]]
+#	[-c <country>] [All] [-f <from>] [YYYY-MM] [--full]
+
+import sys, os, getopt, json
+import calendar
+import datetime
+import struct
+import numpy as np
+import suadadb
+
+
+# Table, source column, exported columns and
+# order of the rows of every kind of series:
+series = {
+	'nwp'  : ('NWP_OUT', 'SourceModID', ('IWV', 'IWV_500_Swiss', 'IWV_500_Profile', 'IWV_Max_Height', 'PE'), 'Datetime'),
+	'gnss' : ('GNSS_OUT', 'SourceGpsID', ('IWV', 'Sigma_IWV', 'ZTD', 'ZHD', 'ZWD', 'PE'), 'Datetime, SourceMetID')
+	}
+
+chunk_magic = b'SWC1'
+chunk_header = struct.Struct('<4sII')
+state_name = 'webcache.state'
+digits = 4
+
+
+# Define a procedure that returns the first day
+# of the month after month ('YYYY-MM'):
+def next_month(month):
+	start = datetime.datetime.strptime(month, '%Y-%m')
+	return (start + datetime.timedelta(days=32)).replace(day=1)
+
+
+# Define a procedure that returns the version of every chunk
+# of a source: (StationID, 'YYYY-MM') -> [max(Timestamp), rows]:
+def chunk_versions(cur, kind, source_id, station_ids, date_from):
+	table, source_column, names, order = series[kind]
+	cond, params = suadadb.in_condition('StationID', station_ids)
+	cur.execute("select StationID, date_format(Datetime, '%%Y-%%m'), max(Timestamp), count(*) from " + table + " \
+		where " + source_column + " = %s and Datetime >= %s" + cond + " \
+		group by StationID, date_format(Datetime, '%%Y-%%m')", [source_id, date_from] + params)
+	return dict(((stationId, month), [str(timestamp), int(rows)]) for stationId, month, timestamp, rows in cur.fetchall())
+
+
+# Define a procedure that reads one chunk. Returns the
+# epochs [s since 1970] and the values of every column:
+def read_chunk(cur, kind, source_id, station_id, month):
+	table, source_column, names, order = series[kind]
+	start = datetime.datetime.strptime(month, '%Y-%m')
+	cur.execute("select Datetime, " + ', '.join(names) + " from " + table + " \
+		where " + source_column + " = %s and StationID = %s and Datetime >= %s and Datetime < %s \
+		order by " + order, [source_id, station_id, start, next_month(month)])
+	times = []
+	values = dict((name, []) for name in names)
+	for row in cur.fetchall():
+		t = calendar.timegm(row[0].timetuple())
+		if len(times) and times[-1] == t:
+			continue # another SourceMetID of the same epoch
+		times.append(t)
+		for n, name in enumerate(names):
+			values[name].append(None if row[n + 1] is None else round(float(row[n + 1]), digits))
+	return times, values
+
+
+# Define a procedure that computes the summary of a chunk
+# (from the first column, IWV):
+def chunk_stats(times, values, name='IWV'):
+	valid = np.array([value for value in values[name] if value is not None], dtype=float)
+	stats = {'epochs' : len(times), 'first' : times[0] if len(times) else None, 'last' : times[-1] if len(times) else None, 'n' : len(valid)}
+	if len(valid):
+		stats['mean'] = round(float(valid.mean()), digits)
+		stats['min'] = round(float(valid.min()), digits)
+		stats['max'] = round(float(valid.max()), digits)
+	return stats
+
+
+# Define a procedure that writes a file through a
+# temporary file, so the web server never sees half of it:
+def write_file(path, data, mode='w'):
+	with open(path + '.tmp', mode) as f:
+		f.write(data)
+	os.rename(path + '.tmp', path)
+
+
+def write_json(path, obj):
+	write_file(path, json.dumps(obj, separators=(',', ':'), sort_keys=True))
+
+
+# Define a procedure that writes the .json and the .bin file of a chunk:
+def write_chunk(basepath, kind, source_name, station_id, month, times, values):
+	names = series[kind][2]
+	chunk = {'source' : source_name, 'station' : station_id, 'month' : month, 'columns' : list(names), 't' : times}
+	chunk.update(values)
+	write_json(basepath + '.json', chunk)
+	data = [chunk_header.pack(chunk_magic, len(times), len(names)), np.array(times, dtype='<u4').tobytes()]
+	for name in names:
+		data.append(np.array([np.nan if value is None else value for value in values[name]], dtype='<f4').tobytes())
+	write_file(basepath + '.bin', b''.join(data), 'wb')
+
+
+# Define a procedure that reads the state of the last run
+# (chunk key -> {'version', 'stats'}):
+def read_state(outdir):
+	try:
+		with open(os.path.join(outdir, state_name)) as f:
+			return json.load(f)
+	except (IOError, OSError, ValueError):
+		return {}
+
+
+def write_state(outdir, state):
+	write_file(os.path.join(outdir, state_name), json.dumps(state, sort_keys=True))
+
+
+# Define a procedure that returns the state key of a chunk:
+def chunk_key(kind, source_name, station_id, month):
+	return '/'.join((kind, source_name, str(station_id), month))
+
+
+# Define a procedure that brings the chunks of one source up to
+# date. Returns the numbers of written and removed chunks and
+# the stations whose summary has changed:
+def refresh_source(cur, outdir, state, kind, source_name, source_id, station_ids, date_from):
+	versions = chunk_versions(cur, kind, source_id, station_ids, date_from)
+	prefix = '/'.join((kind, source_name)) + '/'
+	current = set(chunk_key(kind, source_name, stationId, month) for stationId, month in versions)
+	first_month = date_from.strftime('%Y-%m')
+	removed = [key for key in state if key.startswith(prefix) and not key in current
+		and key.split('/')[-1] >= first_month
+		and (station_ids is None or int(key.split('/')[-2]) in station_ids)]
+	stations = set()
+	written = 0
+	for (stationId, month), version in sorted(versions.items()):
+		key = chunk_key(kind, source_name, stationId, month)
+		if key in state and state[key]['version'] == version:
+			continue
+		times, values = read_chunk(cur, kind, source_id, stationId, month)
+		stationdir = os.path.join(outdir, kind, source_name, str(stationId))
+		if not os.path.isdir(stationdir):
+			os.makedirs(stationdir)
+		write_chunk(os.path.join(stationdir, month), kind, source_name, stationId, month, times, values)
+		state[key] = {'version' : version, 'stats' : chunk_stats(times, values)}
+		stations.add(stationId)
+		written += 1
+	for key in removed:
+		for ext in ('.json', '.bin'):
+			path = os.path.join(outdir, *key.split('/')) + ext
+			if os.path.exists(path):
+				os.remove(path)
+		del state[key]
+		stations.add(int(key.split('/')[-2]))
+	return written, len(removed), stations
+
+
+# Define a procedure that writes the summary.json files of the
+# stations and the index.json of a source from the state:
+def write_summaries(cur, outdir, state, kind, source_name, stations):
+	prefix = '/'.join((kind, source_name)) + '/'
+	months = {}
+	for key in sorted(state):
+		if key.startswith(prefix):
+			stationId, month = key[len(prefix):].split('/')
+			months.setdefault(int(stationId), {})[month] = state[key]['stats']
+	for stationId in stations:
+		path = os.path.join(outdir, kind, source_name, str(stationId), 'summary.json')
+		if stationId in months:
+			write_json(path, {'source' : source_name, 'station' : stationId, 'months' : months[stationId]})
+		elif os.path.exists(path):
+			os.remove(path)
+
+	cur.execute("select ID, Name, Country from STATION")
+	names = dict((row[0], (row[1], row[2])) for row in cur.fetchall())
+	index = []
+	for stationId in sorted(months):
+		name, country = names.get(stationId, (None, None))
+		index.append({'id' : stationId, 'name' : name, 'country' : country, 'months' : sorted(months[stationId])})
+	sourcedir = os.path.join(outdir, kind, source_name)
+	if not os.path.isdir(sourcedir):
+		os.makedirs(sourcedir)
+	write_json(os.path.join(sourcedir, 'index.json'), {'source' : source_name, 'kind' : kind, 'columns' : list(series[kind][2]), 'stations' : index})
+
+
+def usage():
+	print('webcache.py -d <env> -w <outdir> -s <source_name>[,...] -g <gnss_source>[,...] -c <country> [All] -f <from> [YYYY-MM] --full')
+
+
+def main(argv):
+	# -d <env> - database ('dev' or 'prod'),
+	# -w <outdir> - directory served by the web server,
+	# -s <source_name> - model sources (NWP_OUT),
+	# -g <gnss_source> - GNSS sources (GNSS_OUT),
+	# -c <country> - stations of one country only,
+	# -f <from> - first exported month,
+	# --full - rewrite all chunks.
+	env = ''
+	outdir = ''
+	targets = []
+	country = 'All'
+	date_from = datetime.datetime(1970, 1, 1)
+	full = False
+	try:
+		opts, args = getopt.getopt(argv, "hd:w:s:g:c:f:", ["env=", "outdir=", "source_name=", "gnss_source=", "country=", "from=", "full"])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ("-d", "--env"):
+			env = arg
+		elif opt in ("-w", "--outdir"):
+			outdir = arg
+		elif opt in ("-s", "--source_name"):
+			targets.extend(('nwp', name) for name in arg.split(',') if name)
+		elif opt in ("-g", "--gnss_source"):
+			targets.extend(('gnss', name) for name in arg.split(',') if name)
+		elif opt in ("-c", "--country"):
+			country = arg
+		elif opt in ("-f", "--from"):
+			date_from = datetime.datetime.strptime(arg, '%Y-%m')
+		elif opt == "--full":
+			full = True
+
+	if env == '' or outdir == '' or not len(targets):
+		print('Error: You must specify the database, the output directory and the sources! (-d <env> -w <outdir> -s <source_name> | -g <gnss_source>)')
+		sys.exit(2)
+	if not os.path.isdir(outdir):
+		os.makedirs(outdir)
+
+	try:
+		db = suadadb.connect(env)
+		cur = db.cursor()
+	except Exception as e:
+		print('Failed to establish connection: {0}'.format(e))
+		sys.exit(1)
+
+	source_ids = suadadb.get_source_ids(cur, [name for kind, name in targets])
+	station_ids = None if country == 'All' else set(suadadb.get_station_ids(cur, country))
+	state = {} if full else read_state(outdir)
+	for kind, source_name in targets:
+		if not source_name in source_ids:
+			print('Error: Can not find source_id for source_name: {}'.format(source_name))
+			continue
+		written, removed, stations = refresh_source(cur, outdir, state, kind, source_name, source_ids[source_name],
+			None if station_ids is None else sorted(station_ids), date_from)
+		if len(stations) or not os.path.exists(os.path.join(outdir, kind, source_name, 'index.json')):
+			write_summaries(cur, outdir, state, kind, source_name, stations)
+		write_state(outdir, state)
+		print('{} {}: {} chunks written, {} removed'.format(kind, source_name, written, removed))
+
+	sources = sorted(set(tuple(key.split('/')[:2]) for key in state))
+	write_json(os.path.join(outdir, 'index.json'), {'sources' : [{'kind' : kind, 'source' : name} for kind, name in sources]})
+	cur.close()
+	db.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])